@@ -0,0 +1,308 @@
+import argparse
+import time
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+from torch.distributions import MultivariateNormal, Categorical, MixtureSameFamily, LKJCholesky
+
+from models.set import MultiSetTransformer, MultiSetTransformerEncoderDecoder, StreamingMultiSetTransformer
+from datasets.distributions import GaussianMixture, sample_lkj_cholesky
+from export import export_model, save_exported, load_exported
+from profiling import time_fct, count_kernels
+from utils import knn_dist, kl_knn, kraskov_mi1, kraskov_mi2, KNN_BACKENDS, get_dists, whiten_split, Whitener
+
+
+def bench_csab(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    X = torch.randn(args.batch_size, args.set_size, args.n, device=device)
+    Y = torch.randn(args.batch_size, args.set_size + args.size_diff, args.n, device=device)
+    target = torch.randn(args.batch_size, 1, device=device)
+
+    print("weight_sharing=%s  bs=%d  N=%d  M=%d" % (args.weight_sharing, args.batch_size, X.size(1), Y.size(1)))
+    print("%8s %8s %12s %12s" % ("latent", "fused", "fwd kernels", "step (ms)"))
+    for latent_size in args.latent_sizes:
+        for fused in (False, True):
+            model = MultiSetTransformer(args.n, latent_size, 2*latent_size, 1, num_heads=args.num_heads, num_blocks=args.num_blocks,
+                ln=True, weight_sharing=args.weight_sharing, attn_backend=args.attn_backend, fused=fused).to(device)
+            opt = torch.optim.Adam(model.parameters(), lr=1e-4)
+            def step():
+                opt.zero_grad()
+                loss = nn.functional.mse_loss(model(X, Y), target)
+                loss.backward()
+                opt.step()
+            n_kernels = count_kernels(lambda: model(X, Y))
+            step_time = time_fct(step, args.steps)
+            print("%8d %8s %12d %12.2f" % (latent_size, fused, n_kernels, step_time * 1000))
+
+
+def bench_gmm(args):
+    # old path: whole-batch LKJ rejection + MixtureSameFamily; new path: nan-row LKJ resampling + GaussianMixture
+    def lkj_rejection(n, nu, shape):
+        c = LKJCholesky(n, concentration=nu).sample(shape)
+        while c.isnan().any():
+            c = LKJCholesky(n, concentration=nu).sample(shape)
+        return c
+
+    print("bs=%d  N=%d  n=%d  components=%d" % (args.batch_size, args.set_size, args.n, args.n_components))
+    print("%24s %12s" % ("", "ms"))
+    shape = (args.batch_size, args.n_components)
+    logits = torch.randn(*shape)
+    loc = torch.rand(*shape, args.n)
+    for name, fct in [('lkj (rejection)', lambda: lkj_rejection(args.n, args.nu, shape)), ('lkj (nan rows)', lambda: sample_lkj_cholesky(args.n, args.nu, shape))]:
+        print("%24s %12.3f" % (name, time_fct(fct, args.steps) * 1000))
+
+    L = sample_lkj_cholesky(args.n, args.nu, shape)
+    def old():
+        dist = MixtureSameFamily(Categorical(logits=logits), MultivariateNormal(loc, scale_tril=L))
+        X = dist.sample((args.set_size,))
+        return dist.log_prob(X)
+    def new():
+        dist = GaussianMixture(logits, loc, L)
+        return dist.sample_with_log_prob((args.set_size,))[1]
+    for name, fct in [('MixtureSameFamily', old), ('GaussianMixture', new)]:
+        print("%24s %12.3f" % (name + ' sample+lp', time_fct(fct, args.steps) * 1000))
+
+
+def bench_knn(args):
+    # reference: the previous chunked broadcast-difference implementation
+    def knn_dist_ref(X, k, Y=None, bs=32):
+        if Y is None:
+            Y = X
+            k += 1
+        dists = torch.zeros(Y.size(0), Y.size(1), device=X.device)
+        for j in range(0, Y.size(1), bs):
+            all_dists = (Y[:,j:j+bs].unsqueeze(2) - X.unsqueeze(1)).norm(dim=-1)
+            dists[:,j:j+bs] = all_dists.topk(k, dim=-1, largest=False)[0][:,:,k-1]
+        return dists
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("bs=%d  n=%d  k=%d" % (args.batch_size, args.n, args.k))
+    print("%8s %12s %12s %12s %12s" % ("N", "ref (ms)", "tiled (ms)", "max err", "kraskov (ms)"))
+    for N in args.set_sizes:
+        X = torch.randn(args.batch_size, N, args.n, device=device)
+        Y = torch.randn(args.batch_size, N, args.n, device=device)
+        err = max((knn_dist_ref(X, args.k, Y) - knn_dist(X, args.k, Y)).abs().max().item(),
+            (knn_dist_ref(X, args.k) - knn_dist(X, args.k)).abs().max().item())
+        ref_time = time_fct(lambda: (knn_dist_ref(Y, args.k, X), knn_dist_ref(X, args.k)), args.steps, warmup=1)
+        new_time = time_fct(lambda: kl_knn(X, Y, k=args.k), args.steps, warmup=1)
+        mi_time = time_fct(lambda: kraskov_mi1(X, Y, k=args.k), args.steps, warmup=1)
+        print("%8d %12.2f %12.2f %12.2e %12.2f" % (N, ref_time * 1000, new_time * 1000, err, mi_time * 1000))
+
+
+def bench_ann(args):
+    # accuracy vs speed of the approximate knn_dist backends against the exact one, on kl_knn between two gaussians
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("bs=%d  k=%d" % (args.batch_size, args.k))
+    print("%8s %4s %8s %12s %12s %12s" % ("N", "d", "backend", "time (ms)", "exact knn", "kl rel err"))
+    for N in args.set_sizes:
+        for d in args.dims:
+            X = torch.randn(args.batch_size, N, d, device=device)
+            Y = torch.randn(args.batch_size, N, d, device=device) + 0.5
+            exact_dists = knn_dist(X, args.k, Y)
+            exact_kl = kl_knn(X, Y, k=args.k)
+            for backend in args.backends:
+                dists = knn_dist(X, args.k, Y, backend=backend).to(exact_dists.device)
+                kl = kl_knn(X, Y, k=args.k, backend=backend).to(exact_kl.device)
+                frac_exact = ((dists - exact_dists).abs() < 1e-4).float().mean().item()
+                rel_err = ((kl - exact_kl).abs() / exact_kl.abs()).mean().item()
+                elapsed = time_fct(lambda: kl_knn(X, Y, k=args.k, backend=backend), args.steps, warmup=0)
+                print("%8d %4d %8s %12.1f %12.4f %12.2e" % (N, d, backend, elapsed * 1000, frac_exact, rel_err))
+
+
+def bench_kraskov(args):
+    # reference: the previous dense implementation (three bs x N x N matrices), with the k-th neighbour fix
+    def kraskov_mi1_ref(X, Y, k=1):
+        N = X.size(1)
+        mask = torch.eye(N, device=X.device)
+        mask[mask==1] = float('inf')
+        Xdists = get_dists(X, X) + mask
+        Ydists = get_dists(Y, Y) + mask
+        eps = torch.maximum(Xdists, Ydists).topk(k, dim=-1, largest=False)[0][:,:,k-1:]
+        n_x = (Xdists < eps).float().sum(dim=-1)
+        n_y = (Ydists < eps).float().sum(dim=-1)
+        return torch.digamma(torch.tensor(float(k))) + torch.digamma(torch.tensor(float(N))) - (torch.digamma(n_x+1) + torch.digamma(n_y+1)).mean(dim=1).cpu()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("bs=%d  n=%d  k=%d" % (args.batch_size, args.n, args.k))
+    print("%8s %12s %12s %12s %12s %12s" % ("N", "dense (ms)", "ksg1 (ms)", "ksg2 (ms)", "max diff", "dense MB"))
+    for N in args.set_sizes:
+        X = torch.randn(args.batch_size, N, args.n, device=device)
+        Y = 0.5 * X + torch.randn(args.batch_size, N, args.n, device=device)
+        diff = (kraskov_mi1_ref(X, Y, k=args.k) - kraskov_mi1(X, Y, k=args.k).cpu()).abs().max().item()
+        dense_time = time_fct(lambda: kraskov_mi1_ref(X, Y, k=args.k), args.steps, warmup=1)
+        ksg1_time = time_fct(lambda: kraskov_mi1(X, Y, k=args.k), args.steps, warmup=1)
+        ksg2_time = time_fct(lambda: kraskov_mi2(X, Y, k=args.k), args.steps, warmup=1)
+        dense_mb = 3 * args.batch_size * N * N * 4 / 2**20
+        print("%8d %12.1f %12.1f %12.1f %12.2e %12.1f" % (N, dense_time * 1000, ksg1_time * 1000, ksg2_time * 1000, diff, dense_mb))
+
+
+def bench_whiten(args):
+    # reference: the previous whiten_split, through the general (complex) eigendecomposition
+    def whiten_split_ref(X, Y):
+        n = X.size(1)
+        D = torch.cat([X,Y], dim=1)
+        Dc = D - D.mean(dim=1, keepdim=True)
+        evals, evecs = torch.linalg.eig(Dc.transpose(1,2).matmul(Dc) / (D.size(1)-1))
+        W = (evecs.matmul(torch.diag_embed(evals.pow(-1./2))).matmul(evecs.transpose(1,2))).real
+        Dp = Dc.matmul(W.transpose(1,2))
+        return Dp[:, :n], Dp[:, n:]
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("bs=%d  N=%d" % (args.batch_size, args.set_size))
+    print("%6s %12s %12s %12s %12s" % ("n", "eig (ms)", "zca (ms)", "chol (ms)", "cached (ms)"))
+    for n in args.dims:
+        A = torch.randn(args.batch_size, n, n, device=device)
+        X = torch.randn(args.batch_size, args.set_size, n, device=device).matmul(A)
+        Y = torch.randn(args.batch_size, args.set_size, n, device=device).matmul(A)
+        whitener = Whitener()
+        whitener.training = False
+        times = [time_fct(fct, args.steps) * 1000 for fct in (lambda: whiten_split_ref(X, Y), lambda: whiten_split(X, Y),
+            lambda: whiten_split(X, Y, method='cholesky'), lambda: whitener(X, Y))]
+        print("%6d %12.3f %12.3f %12.3f %12.3f" % (n, *times))
+
+
+def bench_score(args):
+    # scoring many query sets against one reference pair: one forward per set vs encoding once and batched decoding
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = MultiSetTransformerEncoderDecoder(args.n, args.n, 64, 128, 1, num_heads=args.num_heads, enc_blocks=args.num_blocks, 
+        dec_blocks=1, ln=True, attn_backend=args.attn_backend).to(device).eval()
+    A = torch.randn(1, args.set_size, args.n, device=device)
+    B = torch.randn(1, args.set_size + args.size_diff, args.n, device=device)
+    sets = [torch.randn(n, args.n, device=device) for n in torch.randint(args.min_query_size, args.max_query_size, (args.num_queries,)).tolist()]
+    def per_set():
+        with torch.no_grad():
+            for X in sets:
+                model(A, B, X.unsqueeze(0))
+    def batched():
+        model.score(model.encode(A, B), sets, batch_size=args.batch_size)
+    print("N=%d  queries=%d  query sizes=[%d,%d)  bs=%d" % (args.set_size, args.num_queries, args.min_query_size, args.max_query_size, args.batch_size))
+    print("%14s %14s" % ("per set (ms)", "batched (ms)"))
+    print("%14.1f %14.1f" % (time_fct(per_set, args.steps, warmup=1) * 1000, time_fct(batched, args.steps, warmup=1) * 1000))
+
+
+def bench_stream(args):
+    # sets growing by append_size elements per update: drift vs the full forward and time per update, per max_stale
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = MultiSetTransformer(args.n, 64, 128, 1, num_heads=args.num_heads, num_blocks=args.num_blocks, ln=True,
+        attn_backend=args.attn_backend).to(device)
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location=device))
+    model.eval()
+    X = torch.randn(args.batch_size, args.set_size, args.n, device=device)
+    Y = torch.randn(args.batch_size, args.set_size + args.size_diff, args.n, device=device)
+    X_new = torch.randn(args.batch_size, args.num_appends * args.append_size, args.n, device=device)
+    Y_new = torch.randn(args.batch_size, args.num_appends * args.append_size, args.n, device=device)
+    with torch.no_grad():
+        full = [model(torch.cat([X, X_new[:, :i*args.append_size]], dim=1), torch.cat([Y, Y_new[:, :i*args.append_size]], dim=1)) 
+            for i in range(1, args.num_appends+1)]
+        full_time = time_fct(lambda: model(X, Y), args.steps, warmup=1)
+    print("N=%d  +%d per set per update  updates=%d  bs=%d  full forward %.2f ms" % (args.set_size, args.append_size, args.num_appends, 
+        args.batch_size, full_time * 1000))
+    print("%10s %14s %14s %14s" % ("max_stale", "max drift", "mean rel drift", "update (ms)"))
+    for max_stale in args.max_stale:
+        stream = StreamingMultiSetTransformer(model, max_stale=max_stale)
+        stream.reset(X, Y)
+        max_drift, rel_drift, elapsed = 0, 0, 0
+        for i in range(args.num_appends):
+            sl = slice(i*args.append_size, (i+1)*args.append_size)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            out = stream.append(X_new[:, sl], Y_new[:, sl])
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+            diff = (out - full[i]).abs()
+            max_drift = max(max_drift, diff.max().item())
+            rel_drift += (diff.mean() / full[i].abs().mean()).item() / args.num_appends
+        print("%10g %14.2e %14.2e %14.2f" % (max_stale, max_drift, rel_drift, elapsed / args.num_appends * 1000))
+
+
+def bench_export(args):
+    # cpu latency (batch of 1) and throughput (set pairs/s at batch_size) of the eager model vs its exported versions
+    torch.set_num_threads(args.num_threads) if args.num_threads > 0 else None
+    if args.model_path is not None:
+        model = torch.load(args.model_path, map_location='cpu', weights_only=False)
+    else:
+        model = MultiSetTransformer(args.n, 64, 128, 1, num_heads=args.num_heads, num_blocks=args.num_blocks, ln=True, 
+            equi=args.equi, attn_backend=args.attn_backend)
+    model.eval()
+    runners = {'eager': model}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for format, suffix in [('torchscript', '.ts'), ('export', '.pt2'), ('onnx', '.onnx')]:
+            path = os.path.join(tmp_dir, "model" + suffix)
+            save_exported(export_model(model, args.n, format=format), path)
+            runners[format] = load_exported(path)
+    print("threads=%d  bs=%d  equi=%s" % (torch.get_num_threads(), args.batch_size, args.equi))
+    print("%6s %12s %14s %16s" % ("N", "runtime", "latency (ms)", "throughput (/s)"))
+    for N in args.set_sizes:
+        X1, Y1 = torch.randn(1, N, args.n), torch.randn(1, N + args.size_diff, args.n)
+        X, Y = torch.randn(args.batch_size, N, args.n), torch.randn(args.batch_size, N + args.size_diff, args.n)
+        for name, runner in runners.items():
+            with torch.no_grad():
+                latency = time_fct(lambda: runner(X1, Y1), args.steps, warmup=2)
+                throughput = args.batch_size / time_fct(lambda: runner(X, Y), max(args.steps // 4, 1), warmup=1)
+            print("%6d %12s %14.2f %16.1f" % (N, name, latency * 1000, throughput))
+
+
+BENCHMARKS = {
+    'csab': bench_csab,
+    'gmm': bench_gmm,
+    'knn': bench_knn,
+    'ann': bench_ann,
+    'kraskov': bench_kraskov,
+    'whiten': bench_whiten,
+    'score': bench_score,
+    'stream': bench_stream,
+    'export': bench_export,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, choices=BENCHMARKS.keys())
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--set_size', type=int, default=100)
+    parser.add_argument('--size_diff', type=int, default=0)
+    parser.add_argument('--n', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=20)
+
+    # csab args
+    parser.add_argument('--latent_sizes', type=int, nargs='+', default=[16, 32, 64, 128, 256])
+    parser.add_argument('--num_blocks', type=int, default=2)
+    parser.add_argument('--num_heads', type=int, default=4)
+    parser.add_argument('--weight_sharing', type=str, choices=['none', 'cross', 'sym'], default='none')
+    parser.add_argument('--attn_backend', type=str, choices=['naive', 'sdpa', 'chunked'], default='sdpa')
+
+    # gmm args
+    parser.add_argument('--n_components', type=int, default=5)
+    parser.add_argument('--nu', type=float, default=5)
+
+    # knn args
+    parser.add_argument('--set_sizes', type=int, nargs='+', default=[100, 500, 1000, 2000])
+    parser.add_argument('--k', type=int, default=1)
+    parser.add_argument('--dims', type=int, nargs='+', default=[2, 8, 32])
+    parser.add_argument('--backends', type=str, nargs='+', choices=KNN_BACKENDS, default=['exact', 'kdtree', 'ivf'])
+
+    # score args
+    parser.add_argument('--num_queries', type=int, default=256)
+    parser.add_argument('--min_query_size', type=int, default=20)
+    parser.add_argument('--max_query_size', type=int, default=100)
+
+    # stream args
+    parser.add_argument('--append_size', type=int, default=1)
+    parser.add_argument('--num_appends', type=int, default=50)
+    parser.add_argument('--max_stale', type=float, nargs='+', default=[0, 0.01, 0.05, 0.1, 0.25])
+    parser.add_argument('--checkpoint', type=str, default=None)
+
+    # export args
+    parser.add_argument('--model_path', type=str, default=None)     # model.pt written by main.py, with --n its input size
+    parser.add_argument('--equi', action='store_true')
+    parser.add_argument('--num_threads', type=int, default=-1)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)
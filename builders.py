@@ -16,6 +16,9 @@ def _build_mst(args):
         'equi':args.equi,
         'decoder_layers': args.decoder_layers,
         'merge': 'sum' if args.model == 'sum-merge' else 'concat',
+        'attn_backend': getattr(args, 'attn_backend', 'naive'),
+        'num_inds': args.num_inds if args.model == 'induced-multi-set-transformer' else -1,
+        'fused': getattr(args, 'fused_csab', False),
     }
     set_model = MultiSetTransformer(args.input_size, args.latent_size, args.hidden_size, 1, **model_kwargs)
     return set_model
@@ -107,7 +110,8 @@ SET_MODEL_BUILDERS = {
     'multi-set-transformer': _build_mst,
     'multi-set-rn': _build_msrn,
     'cross-only': _build_crossonly,
-    'sum-merge': _build_mst
+    'sum-merge': _build_mst,
+    'induced-multi-set-transformer': _build_mst
 }
 
 
@@ -0,0 +1,128 @@
+import torch
+
+import os
+import re
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+def to_cpu(obj):
+    # copies every tensor in a (nested) state dict, so training can keep updating the originals while it is written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter():
+    '''
+    Each checkpoint is a directory step-<step> holding one shard per component (model.pt, optimizer.pt, state.pt),
+    written by a background thread into a temporary directory which is then renamed, so a crash can never leave a
+    partial checkpoint behind. Only the last keep checkpoints are retained. The metrics history is not part of the
+    checkpoints: the values logged since the previous save are appended to metrics.jsonl, tagged with the step.
+    '''
+    STEP_DIR = re.compile(r"^step-(\d+)$")
+
+    def __init__(self, checkpoint_dir, keep=3, main_process=True):
+        # with several processes, only the main process saves or rewrites files, the others only load
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.main_process = main_process
+        self.metrics_path = os.path.join(checkpoint_dir, "metrics.jsonl")
+        self.written = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def steps(self):
+        matches = [self.STEP_DIR.match(name) for name in os.listdir(self.checkpoint_dir)]
+        return sorted(int(m.group(1)) for m in matches if m is not None)
+
+    def latest(self):
+        steps = self.steps()
+        if len(steps) > 0:
+            return os.path.join(self.checkpoint_dir, "step-%08d" % steps[-1])
+        legacy_path = os.path.join(self.checkpoint_dir, "checkpoint.pt")
+        return legacy_path if os.path.exists(legacy_path) else None
+
+    def save(self, step, shards, metrics):
+        # shards: name -> state dict. copying to the host is the only part done on the caller's thread
+        self.wait()
+        shards = {name: to_cpu(state) for name, state in shards.items()}
+        new_metrics = {name: values[self.written.get(name, 0):] for name, values in metrics.items()}
+        self.written = {name: len(values) for name, values in metrics.items()}
+        self.pending = self.executor.submit(self._write, step, shards, new_metrics)
+
+    def _write(self, step, shards, new_metrics):
+        step_dir = os.path.join(self.checkpoint_dir, "step-%08d" % step)
+        tmp_dir = step_dir + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name, state in shards.items():
+            torch.save(state, os.path.join(tmp_dir, name + ".pt"))
+        if os.path.exists(step_dir):
+            shutil.rmtree(step_dir)
+        os.replace(tmp_dir, step_dir)
+
+        # the checkpoint is written first, so metrics.jsonl never holds steps past the latest checkpoint
+        with open(self.metrics_path, 'a') as outfile:
+            outfile.write(json.dumps({'step': step, 'metrics': new_metrics}) + "\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+        for old_step in self.steps()[:-self.keep] if self.keep > 0 else []:
+            shutil.rmtree(os.path.join(self.checkpoint_dir, "step-%08d" % old_step))
+
+    def load(self, map_location=None):
+        path = self.latest()
+        if path is None:
+            return None, None
+        if not os.path.isdir(path):
+            # single-file checkpoint.pt from before sharding, with the scheduler pickled whole
+            load_dict = torch.load(path, map_location=map_location)
+            scheduler = load_dict['scheduler']
+            shards = {
+                'model': load_dict['model'],
+                'optimizer': load_dict['optimizer'],
+                'state': {'step': load_dict['step'], 'scheduler': scheduler.state_dict() if scheduler is not None else None}
+            }
+            metrics = load_dict['metrics']
+            # nothing is in metrics.jsonl yet, so the next save writes the whole history
+            self.written = {}
+        else:
+            shards = {name[:-3]: torch.load(os.path.join(path, name), map_location=map_location) for name in os.listdir(path)}
+            metrics = self._load_metrics(shards['state']['step'])
+            self.written = {name: len(values) for name, values in metrics.items()}
+        return shards, metrics
+
+    def _load_metrics(self, step):
+        metrics, lines = {}, []
+        if os.path.exists(self.metrics_path):
+            with open(self.metrics_path, 'r') as infile:
+                lines = [json.loads(line) for line in infile if line.strip() != ""]
+        # drop entries past the checkpoint being resumed from, since they will be logged again
+        lines = [line for line in lines if line['step'] <= step]
+        for line in lines:
+            for name, values in line['metrics'].items():
+                metrics.setdefault(name, []).extend(values)
+        if not self.main_process:
+            return metrics
+        tmp_path = self.metrics_path + ".tmp"
+        with open(tmp_path, 'w') as outfile:
+            outfile.writelines(json.dumps(line) + "\n" for line in lines)
+        os.replace(tmp_path, self.metrics_path)
+        return metrics
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
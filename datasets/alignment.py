@@ -162,10 +162,10 @@ def split_pairs(pairs, val_frac, test_frac):
     r2 = int(round(test_frac * N))
     return shuffled_pairs[:N-r1-r2], shuffled_pairs[N-r1-r2:N-r2], shuffled_pairs[N-r2:]
 
-import fasttext
 class EmbeddingAlignmentGenerator():
     @classmethod
     def from_files(cls, src_file, tgt_file, dict_file, **kwargs):
+        import fasttext
         src_emb = fasttext.load_model(src_file)
         tgt_emb = fasttext.load_model(tgt_file)
         pairs=load_pairs(dict_file)
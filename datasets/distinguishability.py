@@ -1,27 +1,28 @@
 import torch
 from torch.distributions import MultivariateNormal, LKJCholesky, Categorical, MixtureSameFamily, Dirichlet, LogNormal
 
+from datasets.distributions import sample_lengths, pad_samples, sample_lkj_cholesky, GaussianMixture
+
 class DistinguishabilityGenerator():
     def __init__(self, device=torch.device('cpu')):
         self.device=device
 
-    def _generate_gmm(self, batch_size, n, p=0.5, set_size=(100,150), component_range=(1,5), nu=5, mu0=0, s0=0.3):
+    def _generate_gmm(self, batch_size, n, p=0.5, set_size=(100,150), component_range=(1,5), nu=5, mu0=0, s0=0.3, variable_size=False):
         def _generate_mixture(batch_size, n, component_range, nu, mu0, s0):
             n_components = torch.randint(*component_range,(1,)).item()
             mus= torch.rand(size=(batch_size, n_components, n))
-            c = LKJCholesky(n, concentration=nu).sample((batch_size, n_components))
-            while c.isnan().any():
-                c = LKJCholesky(n, concentration=nu).sample((batch_size, n_components))
+            c = sample_lkj_cholesky(n, nu, (batch_size, n_components))
             s = torch.diag_embed(LogNormal(mu0,s0).sample((batch_size, n_components, n)))
             sigmas = torch.matmul(s, c)
             mus = mus.to(self.device)
             sigmas = sigmas.to(self.device)
             logits = Dirichlet(torch.ones(n_components).to(self.device)/n_components).sample((batch_size,))
-            base_dist = MultivariateNormal(mus, scale_tril=sigmas)
-            mixing_dist = Categorical(logits=logits)
-            dist = MixtureSameFamily(mixing_dist, base_dist)
-            return dist
-        n_samples = torch.randint(*set_size,(1,))
+            return GaussianMixture(logits, mus, sigmas)
+        if variable_size:
+            X_lengths, Y_lengths = sample_lengths(batch_size, set_size), sample_lengths(batch_size, set_size)
+            n_samples = torch.maximum(X_lengths.max(), Y_lengths.max()).view(1)
+        else:
+            n_samples = torch.randint(*set_size,(1,))
         aligned = (torch.rand(batch_size) < p).to(self.device)
         X_dists = _generate_mixture(batch_size, n, component_range, nu, mu0, s0)
         Y_dists = _generate_mixture(batch_size, n, component_range, nu, mu0, s0)
@@ -31,6 +32,9 @@ class DistinguishabilityGenerator():
         Y_unaligned = Y_dists.sample(n_samples).transpose(0,1).float()
         Y = torch.where(aligned.view(-1, 1, 1), Y_aligned, Y_unaligned)
 
+        if variable_size:
+            X, Y = pad_samples(X, X_lengths)[:, :X_lengths.max()], pad_samples(Y, Y_lengths)[:, :Y_lengths.max()]
+            return (X, Y), aligned.float(), (X_lengths, Y_lengths)
         return (X, Y), aligned.float()
 
     def __call__(self, *args, **kwargs):
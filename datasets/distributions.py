@@ -1,14 +1,97 @@
 import torch
+import math
 from torch.distributions import MultivariateNormal, LKJCholesky, Categorical, MixtureSameFamily, Dirichlet, LogNormal, Bernoulli, Distribution
 from scipy.stats import invwishart
 import numpy as np
 
 import os
 import string
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 use_cuda = torch.cuda.is_available()
 
 
+def sample_lengths(batch_size, set_size):
+    # per-example set sizes for padded variable-size batches
+    return torch.randint(*set_size, (batch_size,))
+
+def sample_mask(lengths, max_len, device=None):
+    # bs x max_len mask of the samples within each example's length
+    return torch.arange(max_len, device=device)[None, :] < lengths.to(device)[:, None]
+
+def pad_samples(samples, lengths):
+    # zeroes out samples past each example's length; samples: bs x N x ...
+    mask = sample_mask(lengths, samples.size(1), device=samples.device)
+    return samples * mask.view(*mask.size(), *[1 for _ in samples.size()[2:]]).to(samples.dtype)
+
+def sample_lkj_cholesky(n, concentration, sample_shape):
+    # resamples only the factors that came out nan rather than the whole batch
+    lkj = LKJCholesky(n, concentration=concentration)
+    c = lkj.sample(sample_shape)
+    nans = c.isnan().flatten(-2).any(-1)
+    while nans.any():
+        c[nans] = lkj.sample((int(nans.sum()),))
+        nans = c.isnan().flatten(-2).any(-1)
+    return c
+
+
+class GaussianMixture(Distribution):
+    '''
+    Batched mixture of full-covariance gaussians with mixing logits (bs x k), means (bs x k x n) and cholesky factors
+    (bs x k x n x n); equivalent to MixtureSameFamily(Categorical(logits), MultivariateNormal(loc, scale_tril=scale_tril))
+    without its per-call construction and validation. Components for all samples come from one draw of uniforms (inverse
+    cdf); each sample's mean and cholesky factor are gathered and applied to standard normals with one batched matmul.
+    The uniforms and normals can also be supplied pre-drawn (transform).
+    '''
+    arg_constraints = {}
+
+    def __init__(self, logits, loc, scale_tril):
+        self.log_weights = torch.log_softmax(logits, dim=-1)
+        self.loc = loc
+        self.scale_tril = scale_tril
+        super().__init__(batch_shape=logits.shape[:-1], event_shape=loc.shape[-1:], validate_args=False)
+
+    def transform(self, z, u):
+        # maps standard normals z (bs x S x n) and uniforms u (bs x S) to samples (S x bs x n)
+        bs, k, n = self.loc.size()
+        n_samples = z.size(1)
+        cdf = self.log_weights.exp().cumsum(dim=-1)
+        components = torch.searchsorted(cdf, u.contiguous()).clamp(max=k-1)     # bs x S
+        batch_idx = torch.arange(bs, device=components.device).unsqueeze(-1)
+        loc, scale_tril = self.loc[batch_idx, components], self.scale_tril[batch_idx, components]     # bs x S x n (x n)
+        samples = loc + scale_tril.matmul(z.unsqueeze(-1)).squeeze(-1)
+        return samples.transpose(0, 1)
+
+    def _sample(self, n_samples):
+        bs, k, n = self.loc.size()
+        z = torch.randn(bs, n_samples, n, device=self.loc.device, dtype=self.loc.dtype)
+        u = torch.rand(bs, n_samples, device=self.loc.device, dtype=self.loc.dtype)
+        return self.transform(z, u)
+
+    def sample(self, sample_shape=torch.Size()):
+        sample_shape = torch.Size(sample_shape)
+        samples = self._sample(max(1, sample_shape.numel()))
+        return samples.reshape(*sample_shape, *samples.shape[1:])
+
+    def sample_with_log_prob(self, sample_shape=torch.Size()):
+        samples = self.sample(sample_shape)
+        log_prob = self.log_prob(samples)
+        return samples, log_prob
+
+    def log_prob(self, x):
+        bs, k, n = self.loc.size()
+        shape = x.size()[:-1]
+        x = x.reshape(-1, bs, n)
+        diff = (x.unsqueeze(-2) - self.loc).permute(1, 2, 3, 0)       # bs x k x n x S
+        z = torch.linalg.solve_triangular(self.scale_tril, diff, upper=False)
+        maha = z.pow(2).sum(dim=-2).permute(2, 0, 1)      # S x bs x k
+        half_log_det = self.scale_tril.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+        component_log_prob = -0.5 * (n * math.log(2 * math.pi) + maha) - half_log_det
+        return torch.logsumexp(component_log_prob + self.log_weights, dim=-1).view(shape)
+
+
 class GaussianGenerator():
     def __init__(self, num_outputs=1, mixture=True, normalize=False, scaleinv=False, return_params=False, variable_dim=False):
         self.num_outputs = num_outputs
@@ -19,12 +102,10 @@ class GaussianGenerator():
         self.mixture = mixture
         self.device = torch.device('cpu') if not use_cuda else torch.device('cuda')
 
-    def _generate(self, batch_size, n, return_params=False, set_size=(100,150), scale=None, nu=3, mu0=0, s0=1):
-        n_samples = torch.randint(*set_size,(1,))
+    def _generate(self, batch_size, n, return_params=False, set_size=(100,150), scale=None, nu=3, mu0=0, s0=1, lengths=None):
+        n_samples = torch.randint(*set_size,(1,)) if lengths is None else (lengths.max().item(),)
         mus= torch.rand(size=(batch_size, n))
-        c = LKJCholesky(n, concentration=nu).sample((batch_size,))
-        while c.isnan().any():
-            c = LKJCholesky(n, concentration=nu).sample((batch_size,))
+        c = sample_lkj_cholesky(n, nu, (batch_size,))
         #s = torch.diag_embed(LogNormal(mu0,s0).sample((batch_size, n)))
         sigmas = c#torch.matmul(s, c)
         if scale is not None:
@@ -34,6 +115,8 @@ class GaussianGenerator():
         sigmas = sigmas.to(self.device)
         dist = MultivariateNormal(mus, scale_tril=sigmas)
         samples = dist.sample(n_samples).transpose(0,1)
+        if lengths is not None:
+            samples = pad_samples(samples, lengths)
         if return_params:
             return samples.float().contiguous(), dist
         else:
@@ -62,13 +145,11 @@ class GaussianGenerator():
         else:
             return samples.float().contiguous()
 
-    def _generate_mixture(self, batch_size, n, return_params=False, set_size=(100,150), component_range=(1,10), scale=None, nu=5, mu0=0, s0=0.3):
-        n_samples = torch.randint(*set_size,(1,))
+    def _generate_mixture(self, batch_size, n, return_params=False, set_size=(100,150), component_range=(1,10), scale=None, nu=5, mu0=0, s0=0.3, lengths=None):
+        n_samples = torch.randint(*set_size,(1,)) if lengths is None else (lengths.max().item(),)
         n_components = torch.randint(*component_range,(1,)).item()
         mus= torch.rand(size=(batch_size, n_components, n))
-        c = LKJCholesky(n, concentration=nu).sample((batch_size, n_components))
-        while c.isnan().any():
-            c = LKJCholesky(n, concentration=nu).sample((batch_size, n_components))
+        c = sample_lkj_cholesky(n, nu, (batch_size, n_components))
         s = torch.diag_embed(LogNormal(mu0,s0).sample((batch_size, n_components, n)))
         sigmas = torch.matmul(s, c)
         if scale is not None:
@@ -77,33 +158,45 @@ class GaussianGenerator():
         mus = mus.to(self.device)
         sigmas = sigmas.to(self.device)
         logits = Dirichlet(torch.ones(n_components).to(self.device)/n_components).sample((batch_size,))
-        base_dist = MultivariateNormal(mus, scale_tril=sigmas)
-        mixing_dist = Categorical(logits=logits)
-        dist = MixtureSameFamily(mixing_dist, base_dist)
+        dist = GaussianMixture(logits, mus, sigmas)
         samples = dist.sample(n_samples).transpose(0,1)
+        if lengths is not None:
+            samples = pad_samples(samples, lengths)
         if return_params:
             return samples.float().contiguous(), dist
         else:
             return samples.float().contiguous()
         
     
-    def __call__(self, batch_size, dims=(2,6), sample_groups=1, **kwargs):
+    def __call__(self, batch_size, dims=(2,6), sample_groups=1, variable_size=False, **kwargs):
         if self.variable_dim:
             n = torch.randint(*dims,(1,)).item()
             kwargs['n'] = n
         scale = torch.exp(torch.rand(batch_size)*9 - 6) if self.scaleinv else None
         gen_fct = self._generate_mixture if self.mixture else self._generate
+        set_size = kwargs.get('set_size', (100,150))
+        lengths = [sample_lengths(batch_size, set_size) if variable_size else None for _ in range(self.num_outputs)]
         if self.return_params:
-            outputs, dists = zip(*[gen_fct(batch_size, scale=scale, return_params=True, **kwargs) for _ in range(self.num_outputs)])
+            outputs, dists = zip(*[gen_fct(batch_size, scale=scale, return_params=True, lengths=lengths[i], **kwargs) for i in range(self.num_outputs)])
         else:
-            outputs = [gen_fct(batch_size, scale=scale, **kwargs) for _ in range(self.num_outputs)]
+            outputs = [gen_fct(batch_size, scale=scale, lengths=lengths[i], **kwargs) for i in range(self.num_outputs)]
         if self.normalize:
-            avg_norm = torch.cat(outputs, dim=1).norm(dim=-1,keepdim=True).mean(dim=1,keepdim=True)
+            norms = torch.cat(outputs, dim=1).norm(dim=-1,keepdim=True)
+            if variable_size:
+                # the average is over the valid samples only, not the padding
+                mask = torch.cat([sample_mask(l, out.size(1), device=out.device) for out, l in zip(outputs, lengths)], dim=1)
+                mask = mask.unsqueeze(-1).to(norms.dtype)
+                avg_norm = (norms * mask).sum(dim=1,keepdim=True) / mask.sum(dim=1,keepdim=True)
+            else:
+                avg_norm = norms.mean(dim=1,keepdim=True)
             for i in range(len(outputs)):
                 outputs[i] /= avg_norm
             if self.return_params:
                 for dist in dists:
                     dist.base_dist = MultivariateNormal(dist.loc/avg_norm, dist.covariance_matrix/avg_norm/avg_norm)
+        if variable_size:
+            lengths = tuple(lengths)
+            return (outputs, dists, lengths) if self.return_params else (outputs, lengths)
         if self.return_params:
             return outputs, dists
         else:
@@ -169,8 +262,13 @@ class CorrelatedGaussianGenerator():
         cov = torch.cat([torch.cat([I, rhoI], dim=1), torch.cat([rhoI, I], dim=1)], dim=2)
         return MultivariateNormal(mu, covariance_matrix=cov)
 
-    def _generate(self, batch_size, n, set_size=(100,150), sample_groups=1, corr=None):
-        n_samples = torch.randint(*set_size,(1,))
+    def _generate(self, batch_size, n, set_size=(100,150), sample_groups=1, corr=None, variable_size=False):
+        if variable_size:
+            # X and Y are paired samples, so both sets of an example share one length
+            lengths = sample_lengths(batch_size, set_size)
+            n_samples = lengths.max().view(1)
+        else:
+            n_samples = torch.randint(*set_size,(1,))
         if corr is None:
             corr = self.max_rho-2*self.max_rho*(torch.rand((batch_size,)))
             if use_cuda:
@@ -178,6 +276,10 @@ class CorrelatedGaussianGenerator():
         dists = self._build_dist(batch_size, corr, n)
         X, Y = dists.sample(n_samples*sample_groups).transpose(0,1).chunk(2, dim=-1)
 
+        if variable_size:
+            lengths = lengths * sample_groups
+            X, Y = pad_samples(X, lengths), pad_samples(Y, lengths)
+            return ((X, Y), (corr,), (lengths, lengths)) if self.return_params else ((X, Y), (lengths, lengths))
         if self.return_params:
             return (X, Y), (corr,)
         else:
@@ -487,3 +589,96 @@ class RandomEncoderGenerator():
             kwargs['n'] = n
         return self._generate(batch_size, sample_groups=sample_groups, **kwargs)
 
+
+
+def batch_to(obj, device):
+    # moves a generated batch to device, including the tensors held by the distributions returned with return_params
+    if torch.is_tensor(obj) or isinstance(obj, torch.nn.Module):
+        return obj.to(device)
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(batch_to(x, device) for x in obj)
+    if isinstance(obj, dict):
+        return obj.__class__((k, batch_to(v, device)) for k, v in obj.items())
+    if isinstance(obj, Distribution):
+        for name, value in vars(obj).items():
+            setattr(obj, name, batch_to(value, device))
+    return obj
+
+
+_prefetch_generator = None
+
+def _init_prefetch_worker(generator, num_threads):
+    global _prefetch_generator, use_cuda
+    _prefetch_generator = generator
+    use_cuda = False
+    if hasattr(generator, 'device'):
+        generator.device = torch.device('cpu')
+    torch.set_num_threads(num_threads)
+
+def _prefetch_batch(seed, batch_size, kwargs):
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2**32)
+    return _prefetch_generator(batch_size, **kwargs)
+
+class PrefetchGenerator():
+    '''
+    Wraps a generator so batches are produced ahead of time by a pool of workers, keeping up to depth batches in flight
+    for each of the most recently requested argument sets (e.g. the current training set size and the eval set size).
+    In process mode each batch is seeded with seed + its index, so the stream of batches for a given sequence of calls
+    does not depend on which worker produced them; worker processes generate on the cpu, and batches (with their
+    distributions) are moved to device when they are handed out. Thread mode shares the global RNG with the training
+    loop and is not reproducible.
+    '''
+    def __init__(self, generator, depth=4, num_workers=1, mode='process', seed=0, max_keys=4, device=None):
+        self.generator = generator
+        self.device = device
+        self.depth = depth
+        self.seed = seed
+        self.max_keys = max_keys
+        self.mode = mode
+        self.n_submitted = 0
+        self.pending = collections.OrderedDict()
+        if mode == 'process':
+            num_threads = max(1, torch.get_num_threads() // num_workers)
+            self.pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_prefetch_worker, initargs=(generator, num_threads))
+        elif mode == 'thread':
+            self.pool = ThreadPoolExecutor(num_workers)
+        else:
+            raise NotImplementedError("process or thread")
+
+    def _submit(self, batch_size, kwargs):
+        if self.mode == 'process':
+            future = self.pool.submit(_prefetch_batch, self.seed + self.n_submitted, batch_size, kwargs)
+        else:
+            future = self.pool.submit(self.generator, batch_size, **kwargs)
+        self.n_submitted += 1
+        return future
+
+    def __call__(self, batch_size, **kwargs):
+        key = repr((batch_size, sorted(kwargs.items())))
+        if key not in self.pending:
+            self.pending[key] = collections.deque()
+            if len(self.pending) > self.max_keys:
+                _, stale = self.pending.popitem(last=False)
+                for future in stale:
+                    future.cancel()
+        self.pending.move_to_end(key)
+        queue = self.pending[key]
+        if len(queue) == 0:
+            queue.append(self._submit(batch_size, kwargs))
+        future = queue.popleft()
+        while len(queue) < self.depth:
+            queue.append(self._submit(batch_size, kwargs))
+        return batch_to(future.result(), self.device) if self.device is not None else future.result()
+
+    def __getattr__(self, name):
+        if name == 'generator':
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+    def close(self):
+        for queue in self.pending.values():
+            for future in queue:
+                future.cancel()
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,56 @@
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+import os
+import contextlib
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_distributed(rank, world_size, backend='gloo', master_addr='localhost', master_port=29500):
+    # under torchrun, MASTER_ADDR/MASTER_PORT are already set and take precedence
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def wrap_model(model, device, find_unused_parameters=False):
+    # find_unused_parameters is needed by models with parameters that some configs never use in the loss
+    if not is_distributed():
+        return model
+    device_ids = [device] if torch.device(device).type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+def unwrap_model(model):
+    return model.module if isinstance(model, (DistributedDataParallel, nn.DataParallel)) else model
+
+def sync_gradients(model, sync):
+    # skips the gradient all-reduce on backward passes that are only accumulated
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def all_reduce_mean(metrics):
+    # averages a dict of scalar metrics over the ranks, which must all pass the same keys
+    if not is_distributed():
+        return metrics
+    keys = sorted(metrics.keys())
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    values = torch.tensor([float(metrics[k]) for k in keys], dtype=torch.float64, device=device)
+    dist.all_reduce(values)
+    return dict(zip(keys, (values / get_world_size()).tolist()))
@@ -0,0 +1,78 @@
+import torch
+import numpy as np
+
+import os
+import json
+import inspect
+import hashlib
+import collections
+
+
+def describe(obj):
+    # a json-able description of the objects an eval set depends on (generators, label functions, sampling args): their
+    # class or function name and the plain attributes named after constructor arguments, i.e. their configuration
+    if isinstance(obj, (int, float, str, bool, type(None))):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [describe(x) for x in obj]
+    if isinstance(obj, dict):
+        return {str(k): describe(v) for k, v in obj.items()}
+    if hasattr(obj, '__qualname__'):
+        return obj.__module__ + "." + obj.__qualname__
+    attrs = vars(obj) if hasattr(obj, '__dict__') else {}
+    params = inspect.signature(type(obj).__init__).parameters
+    return {'class': type(obj).__name__, **{k: describe(v) for k, v in attrs.items()
+        if k in params and isinstance(v, (int, float, str, bool, type(None), list, tuple))}}
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(describe(config), sort_keys=True).encode()).hexdigest()[:16]
+
+
+def generate_seeded(seed, build_fct):
+    # runs build_fct from a fixed torch (cpu and current cuda device)/numpy rng state, restoring the callers' state
+    # afterwards. torch.manual_seed would also reseed the other cuda devices, which the fork doesn't restore
+    np_state = np.random.get_state()
+    devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+    with torch.random.fork_rng(devices=devices):
+        torch.random.default_generator.manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed(seed)
+        np.random.seed(seed % 2**32)
+        out = build_fct()
+    np.random.set_state(np_state)
+    return out
+
+
+class EvalSetCache():
+    '''
+    Materializes eval sets (batches, labels and anything else that doesn't depend on the model) once per config. Sets
+    are kept in a small in-memory LRU and, given a cache_dir, saved to <config hash>.pt files which later evaluations
+    and runs load memory-mapped instead of generating them again.
+    '''
+    def __init__(self, cache_dir=None, max_sets=4):
+        self.cache_dir = cache_dir
+        self.max_sets = max_sets
+        self.sets = collections.OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, config, build_fct):
+        key = config_hash(config)
+        if key in self.sets:
+            self.sets.move_to_end(key)
+            return self.sets[key]
+
+        path = os.path.join(self.cache_dir, key + ".pt") if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            eval_set = torch.load(path, mmap=True)['data']
+        else:
+            eval_set = build_fct()
+            if path is not None:
+                tmp_path = "%s.%d.tmp" % (path, os.getpid())
+                torch.save({'config': describe(config), 'data': eval_set}, tmp_path)
+                os.replace(tmp_path, path)
+
+        self.sets[key] = eval_set
+        if len(self.sets) > self.max_sets:
+            self.sets.popitem(last=False)
+        return eval_set
@@ -0,0 +1,171 @@
+import torch
+import torch.nn as nn
+from torch.export import Dim
+
+import os
+import copy
+import argparse
+
+from models.set import MHA, MAB, CSAB, RNBlock, MultiSetTransformer, MultiSetTransformerEncoder, UnionTransformer
+
+
+EXPORT_FORMATS = ['torchscript', 'export', 'onnx']
+EXPORT_SUFFIXES = {'torchscript': '.ts', 'export': '.pt2', 'onnx': '.onnx'}
+
+# attributes that forward() looks up with getattr for models pickled before they existed, and the values the fallbacks
+# imply. freeze_config writes them onto the modules so an exported graph never depends on a missing attribute
+CONFIG_DEFAULTS = {
+    MHA: {'attn_backend': 'naive', 'equi': False},
+    MAB: {'alpha0': 1, 'alpha1': 1, 'dropout': None, 'ln0': None, 'ln1': None},
+    CSAB: {'alpha_x': 1, 'alpha_y': 1, 'ln_x': None, 'ln_y': None, 'fused': False},
+    RNBlock: {'dropout': None, 'ln0': None, 'ln1': None},
+    MultiSetTransformer: {'pool_method': 'pma'},
+    UnionTransformer: {'pool_method': 'pma'},
+}
+
+
+def freeze_config(model):
+    '''
+    Makes every config option the forward passes branch on an explicit attribute, and swaps the two options whose
+    branching depends on the set sizes for equivalent ones, so a single trace is valid for any batch and set size:
+    fused CSABs pad both sets to a common length (the same MABs are run unfused instead) and chunked attention loops
+    over the number of query chunks (sdpa is used instead).
+    '''
+    model.eval()
+    for module in model.modules():
+        for cls, defaults in CONFIG_DEFAULTS.items():
+            if isinstance(module, cls):
+                for name, value in defaults.items():
+                    if not hasattr(module, name):
+                        setattr(module, name, value)
+        if isinstance(module, MHA) and module.attn_backend == 'chunked':
+            module.attn_backend = 'sdpa'
+        if isinstance(module, CSAB):
+            if getattr(module, 'remove_diag', False):
+                raise NotImplementedError("Exporting CSAB with remove_diag is not supported.")
+            module.fused = False
+    return model
+
+
+class PairInputs(nn.Module):
+    # fixes the signature to forward(X, Y) for models taking *sets (PINE), so both inputs get dynamic shapes
+    def __init__(self, model):
+        super(PairInputs, self).__init__()
+        self.model = model
+
+    def forward(self, X, Y):
+        return self.model(X, Y)
+
+
+def example_inputs(input_size, batch_size=2, set_sizes=(10, 12), device='cpu'):
+    # input_size: feature size of both sets, or an (x_size, y_size) pair
+    input_sizes = input_size if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+    return tuple(torch.randn(batch_size, n, d, device=device) for n, d in zip(set_sizes, input_sizes))
+
+def paired_sets(model):
+    # encoders merging their output sets concatenate X and Y elementwise, so both sets must have the same size
+    return getattr(model, 'merge_output_sets', False)
+
+def dynamic_shapes(model):
+    # batch and set sizes are free; so is the number of features for equivariant models, which must match across sets
+    batch, n = Dim('batch'), Dim('n', min=2)
+    m = n if paired_sets(model) else Dim('m', min=2)
+    if getattr(model, 'equi', False):
+        features = Dim('features', min=2)
+        return ({0: batch, 1: n, 2: features}, {0: batch, 1: m, 2: features})
+    return ({0: batch, 1: n}, {0: batch, 1: m})
+
+
+def export_model(model, input_size, format='torchscript'):
+    model = freeze_config(copy.deepcopy(model))
+    inputs = example_inputs(input_size, set_sizes=(10, 10) if paired_sets(model) else (10, 12))
+    with torch.no_grad():
+        if format == 'torchscript':
+            return torch.jit.freeze(torch.jit.trace(model, inputs, check_trace=False))
+        elif format == 'export':
+            return torch.export.export(PairInputs(model), inputs, dynamic_shapes=dynamic_shapes(model))
+        elif format == 'onnx':
+            return torch.onnx.export(PairInputs(model), inputs, input_names=['X', 'Y'], dynamic_shapes=dynamic_shapes(model), 
+                dynamo=True, verbose=False)
+        else:
+            raise NotImplementedError("Supported export formats are %s." % ", ".join(EXPORT_FORMATS))
+
+
+class OnnxRuntimeModel():
+    # runs an exported .onnx model on onnxruntime's CPU provider, taking and returning torch tensors
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, X, Y):
+        outputs = [torch.from_numpy(out) for out in self.session.run(None, {'X': X.cpu().numpy(), 'Y': Y.cpu().numpy()})]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+def save_exported(exported, path):
+    if isinstance(exported, torch.export.ExportedProgram):
+        torch.export.save(exported, path)
+    elif isinstance(exported, torch.onnx.ONNXProgram):
+        exported.save(path)
+    else:
+        torch.jit.save(exported, path)
+
+def load_exported(path, compile=False):
+    # .pt2 files hold a torch.export program, which can additionally be compiled for the host it is loaded on
+    if path.endswith(".onnx"):
+        return OnnxRuntimeModel(path, num_threads=torch.get_num_threads())
+    if path.endswith(".pt2"):
+        module = torch.export.load(path).module()
+        return torch.compile(module, dynamic=True) if compile else module
+    return torch.jit.load(path)
+
+
+def check_parity(model, exported, input_size, batch_sizes=(1, 3), set_sizes=((7, 7), (50, 20), (200, 300)), device='cpu'):
+    # max abs difference between the eager and exported models, at batch and set sizes other than the traced ones
+    # (and at other feature sizes for equivariant models)
+    input_sizes = [input_size] + ([3, 9] if getattr(model, 'equi', False) else [])
+    max_diff = 0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            for sizes in set_sizes:
+                sizes = (sizes[0], sizes[0]) if paired_sets(model) else sizes
+                for input_size in input_sizes:
+                    X, Y = example_inputs(input_size, batch_size, sizes, device=device)
+                    out, out_exported = model(X, Y), exported(X, Y)
+                    for a, b in zip(*[o if isinstance(o, tuple) else (o,) for o in (out, out_exported)]):
+                        max_diff = max(max_diff, (a - b).abs().max().item())
+    return max_diff
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_path', type=str)     # model.pt written by main.py
+    parser.add_argument('--out', type=str, default=None)     # defaults to model.ts / model.pt2 / model.onnx next to model_path
+    parser.add_argument('--format', type=str, choices=EXPORT_FORMATS, default='torchscript')
+    parser.add_argument('--input_size', type=int, nargs='+', default=None)     # one size, or x and y sizes. read from the run's out.pt if not given
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    model = torch.load(args.model_path, map_location='cpu', weights_only=False).eval()
+    input_size = args.input_size[0] if args.input_size is not None and len(args.input_size) == 1 else args.input_size
+    if isinstance(model, MultiSetTransformerEncoder) and input_size is None:
+        # equivariant encoders take any number of features, x_size and y_size are 1
+        input_size = (model.x_size, model.y_size) if not model.equi else 4
+    if input_size is None:
+        out_path = os.path.join(os.path.dirname(args.model_path), "out.pt")
+        if not os.path.exists(out_path):
+            raise ValueError("No out.pt found next to the model, --input_size must be given.")
+        input_size = torch.load(out_path, weights_only=False)['args'].input_size
+
+    exported = export_model(model, input_size, format=args.format)
+    out = args.out if args.out is not None else os.path.splitext(args.model_path)[0] + EXPORT_SUFFIXES[args.format]
+    save_exported(exported, out)
+
+    max_diff = check_parity(model, load_exported(out), input_size)
+    print("Exported %s to %s, max abs difference to eager %.2e" % (type(model).__name__, out, max_diff))
+    assert max_diff <= args.tolerance, "Exported model differs from the eager model by more than %g" % args.tolerance
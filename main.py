@@ -2,7 +2,8 @@
 
 import torch
 import torch.nn as nn
-from torch.utils.tensorboard import SummaryWriter
+import torch.multiprocessing as mp
+import numpy as np
 
 #import apex
 
@@ -13,8 +14,10 @@ from datetime import date
 
 from tasks import TASKS
 from builders import SET_MODEL_BUILDERS
-
-import wandb
+from datasets.distributions import PrefetchGenerator
+from metrics import LOGGERS, build_metric_logger
+from checkpoint import CheckpointWriter
+from distributed import init_distributed, cleanup_distributed, wrap_model, unwrap_model
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -23,6 +26,7 @@ def parse_args():
     parser.add_argument('--basedir', type=str, default="./runs")
     parser.add_argument('--dataset_dir', type=str, default='./data')
     parser.add_argument('--checkpoint_dir', type=str, default=None)
+    parser.add_argument('--keep_checkpoints', type=int, default=3)     # <=0 keeps every checkpoint
 
     # Run config
     parser.add_argument('--model', type=str, default='multi-set-transformer', choices=SET_MODEL_BUILDERS.keys())
@@ -37,13 +41,26 @@ def parse_args():
     parser.add_argument('--grad_steps', type=int, default=1)
     parser.add_argument('--set_size', type=int, nargs=2, default=[6,10])
     parser.add_argument('--ss_schedule', type=int, choices=[-1, 15, 30, 50, 75], default=-1)
+    parser.add_argument('--ss_buckets', type=int, default=0)    # >0: bucket each schedule stage, keeping tokens per batch constant
     parser.add_argument('--eval_every', type=int, default=500)
+    parser.add_argument('--eval_batch_size', type=int, default=None)     # stat tasks: chunk size of the cached eval sets
+    parser.add_argument('--eval_seed', type=int, default=0)
+    parser.add_argument('--eval_cache_dir', type=str, default=None)     # eval sets are saved here by config hash and reused across runs
     parser.add_argument('--save_every', type=int, default=2000)
     parser.add_argument('--train_steps', type=int, default=5000)
     parser.add_argument('--val_steps', type=int, default=200)
     parser.add_argument('--test_steps', type=int, default=500)
     parser.add_argument('--use_amp', action="store_true")
     #parser.add_argument('--use_apex', action="store_true")
+    parser.add_argument('--seed', type=int, default=0)     # each rank seeds with seed + rank
+
+    # Distributed args (gloo works on cpu-only nodes). --batch_size is the global batch size, split over all ranks
+    parser.add_argument('--nprocs', type=int, default=1)     # processes per node
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node_rank', type=int, default=0)
+    parser.add_argument('--master_addr', type=str, default='localhost')
+    parser.add_argument('--master_port', type=int, default=29500)
+    parser.add_argument('--dist_backend', type=str, choices=('gloo', 'nccl'), default='gloo')
     parser.add_argument('--clip', type=float, default=-1)
     
     # Model args
@@ -54,6 +71,19 @@ def parse_args():
     parser.add_argument('--dropout', type=float, default=0)
     parser.add_argument('--decoder_layers', type=int, default=1)
     parser.add_argument('--weight_sharing', type=str, choices=['none', 'cross', 'sym'], default='none')
+    parser.add_argument('--attn_backend', type=str, choices=['naive', 'sdpa', 'chunked'], default='naive')
+    parser.add_argument('--num_inds', type=int, default=32)     # for induced-multi-set-transformer
+    parser.add_argument('--fused_csab', action='store_true')
+    parser.add_argument('--variable_size', action='store_true')     # pad sets to the largest in each batch and mask
+    parser.add_argument('--token_budget', type=int, default=-1)     # >0: batch size per step from batch_size * (N+M) <= token_budget
+    parser.add_argument('--max_memory', type=float, default=-1)     # GB, caps the token budget using a fitted memory model (cuda only)
+    parser.add_argument('--logger', type=str, nargs='+', choices=LOGGERS, default=['tensorboard', 'wandb'])
+    parser.add_argument('--offline', action='store_true')     # no network: wandb logs offline, huggingface only reads its local cache
+    parser.add_argument('--log_every', type=int, default=50)     # train metrics are averaged on device and written every log_every steps
+    parser.add_argument('--prefetch', type=int, default=0)     # >0: number of batches generated ahead by background workers
+    parser.add_argument('--prefetch_workers', type=int, default=1)
+    parser.add_argument('--prefetch_mode', type=str, choices=['process', 'thread'], default='process')
+    parser.add_argument('--prefetch_seed', type=int, default=0)
 
     # Pretraining args
     parser.add_argument('--pretrain_steps', type=int, default=0)
@@ -80,12 +110,18 @@ def parse_args():
 
     # Statistical distance args
     parser.add_argument('--normalize', type=str, choices=('none', 'scale-linear', 'scale-inv', 'whiten'))
+    parser.add_argument('--whiten_method', type=str, choices=('zca', 'cholesky'), default='zca')
+    parser.add_argument('--whiten_momentum', type=float, default=-1)   # >0: whiten with running statistics over all sets
     parser.add_argument('--scaling', type=float, default=0.5)
     parser.add_argument('--blur', type=float, default=0.05)
     parser.add_argument('--equi', action='store_true')
     parser.add_argument('--vardim', action='store_true')
     parser.add_argument('--max_rho', type=float, default=0.999)
     parser.add_argument('--criterion', type=str, default=None, choices=('l1', 'mse'))
+    parser.add_argument('--kl_labels', type=str, choices=('set', 'mc', 'analytic', 'variational'), default='set')
+    parser.add_argument('--kl_samples', type=int, default=500)
+    parser.add_argument('--kl_reuse_samples', action='store_true')
+    parser.add_argument('--single_gaussian', action='store_true')
 
     # Donsker Varadhan args
     parser.add_argument('--split_inputs', action='store_true')
@@ -102,34 +138,34 @@ def parse_args():
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-    args = parse_args()
-
-    if args.dataset is not None:
-        run_dir = os.path.join(args.basedir, args.task, args.dataset, args.run_name) 
+def run(local_rank, args, run_dir, log_dir):
+    # one training process. with --nprocs/--nnodes (or under torchrun) there is one per rank, each seeded differently
+    # so the ranks sample different batches
+    world_size = args.nprocs * args.nnodes
+    if 'WORLD_SIZE' in os.environ:
+        local_rank, rank, world_size = int(os.environ['LOCAL_RANK']), int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
     else:
-        run_dir = os.path.join(args.basedir, args.task, args.run_name) 
-
-    if not os.path.exists(run_dir):
-        os.makedirs(run_dir)
-    log_dir = os.path.join(run_dir, "logs")
-    if not os.path.exists(log_dir):
-        os.mkdir(log_dir)
-
-    args_file = os.path.join(run_dir, "args.pt")
-    if not os.path.exists(args_file):
-        torch.save({'args':args}, args_file)
+        rank = args.node_rank * args.nprocs + local_rank
+    if world_size > 1:
+        init_distributed(rank, world_size, backend=args.dist_backend, master_addr=args.master_addr, master_port=args.master_port)
+        if not torch.cuda.is_available():
+            torch.set_num_threads(max(1, os.cpu_count() // args.nprocs))
+    torch.manual_seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
 
     if args.checkpoint_dir is not None:
-        checkpoint_file = os.path.join(args.checkpoint_dir, 'checkpoint.pt')
-        resume = os.path.exists(checkpoint_file)
+        resume = CheckpointWriter(args.checkpoint_dir, main_process=False).latest() is not None
     else:
         resume = False
 
-    device = torch.device("cuda")
+    device = torch.device("cuda", local_rank % torch.cuda.device_count()) if torch.cuda.is_available() else torch.device("cpu")
 
     task = TASKS[args.task](args)
     train_dataset, val_dataset, test_dataset = task.build_dataset()
+    if args.prefetch > 0:
+        # batch seeds are prefetch_seed + batch index, so the ranks are spaced far enough apart not to overlap
+        train_dataset = PrefetchGenerator(train_dataset, depth=args.prefetch, num_workers=args.prefetch_workers, 
+            mode=args.prefetch_mode, seed=args.prefetch_seed + rank * 2**24, device=device)
 
     if task.pretraining_task is not None and not resume and args.pretrain_steps > 0:
         pretraining_task = task.pretraining_task(args)
@@ -143,29 +179,45 @@ if __name__ == '__main__':
         pretrained_model = None
 
     model = task.build_model(pretrained_model=pretrained_model).to(device)
-
-    if torch.cuda.device_count() > 1:
-        n_gpus = torch.cuda.device_count()
-        print("Using", n_gpus, "GPUs.")
-        model = nn.DataParallel(model)
-        args.batch_size *= n_gpus
-        args.train_steps = args.train_steps // n_gpus 
-        args.val_steps = args.val_steps // n_gpus 
-        args.test_steps = args.test_steps // n_gpus 
+    model = wrap_model(model, device, find_unused_parameters=task.trainer_cls.find_unused_parameters)
 
     opt = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     scaler = torch.cuda.amp.GradScaler(enabled=args.use_amp)
 
-    logger = SummaryWriter(log_dir)
-    wandb.init(project=args.run_name)
+    loggers = args.logger if rank == 0 else ['none']
+    logger = build_metric_logger(loggers, log_dir, project=args.run_name, flush_every=args.log_every, offline=args.offline)
 
     trainer = task.build_trainer(model, opt, None, train_dataset, val_dataset, test_dataset, device, logger, checkpoint_dir=args.checkpoint_dir)
     all_metrics = trainer.train(args.train_steps, args.val_steps, args.test_steps)
+    if args.prefetch > 0:
+        train_dataset.close()
     
-    model_out = model._modules['module'] if torch.cuda.device_count() > 1 else model
-    torch.save(model_out, os.path.join(run_dir, "model.pt"))
-    torch.save({'metrics':all_metrics, 'args':args}, os.path.join(run_dir, "out.pt"))
-    
+    if rank == 0:
+        torch.save(unwrap_model(model), os.path.join(run_dir, "model.pt"))
+        torch.save({'metrics':all_metrics, 'args':args}, os.path.join(run_dir, "out.pt"))
+    cleanup_distributed()
 
 
+if __name__ == '__main__':
+    args = parse_args()
+    if args.offline:
+        os.environ['WANDB_MODE'] = 'offline'
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        os.environ['TRANSFORMERS_OFFLINE'] = '1'
+
+    if args.dataset is not None:
+        run_dir = os.path.join(args.basedir, args.task, args.dataset, args.run_name) 
+    else:
+        run_dir = os.path.join(args.basedir, args.task, args.run_name) 
 
+    log_dir = os.path.join(run_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    args_file = os.path.join(run_dir, "args.pt")
+    if not os.path.exists(args_file):
+        torch.save({'args':args}, args_file)
+
+    if args.nprocs > 1 and 'WORLD_SIZE' not in os.environ:
+        mp.spawn(run, args=(args, run_dir, log_dir), nprocs=args.nprocs)
+    else:
+        run(0, args, run_dir, log_dir)
@@ -0,0 +1,129 @@
+import torch
+
+import os
+import json
+import queue
+import threading
+
+
+class TensorBoardSink():
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, scalars, step):
+        if step < 0:
+            return
+        for name, value in scalars.items():
+            self.writer.add_scalar(name, value, step)
+
+    def close(self):
+        self.writer.flush()
+
+
+class WandbSink():
+    def __init__(self, project=None, mode=None):
+        import wandb
+        self.wandb = wandb
+        if project is not None:
+            wandb.init(project=project, mode=mode)
+
+    def write(self, scalars, step):
+        if step < 0:
+            self.wandb.log(scalars)
+        else:
+            self.wandb.log(scalars, step)
+
+    def close(self):
+        if self.wandb.run is not None:
+            self.wandb.finish()
+
+
+class JSONLSink():
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, scalars, step):
+        self.file.write(json.dumps({'step': step, **scalars}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MetricLogger():
+    '''
+    Accumulates per-step scalars (e.g. the training loss) on their device and every flush_every steps hands the means
+    to a background thread, which copies them to the host and writes them to the sinks, so the training loop never
+    waits on a device sync. Scalars logged with log_scalars (eval metrics) are written as they are. history keeps every
+    written value per name, as Trainer.train used to return.
+    '''
+    def __init__(self, sinks=(), flush_every=50, history=None):
+        self.sinks = list(sinks)
+        self.flush_every = flush_every
+        self.history = history if history is not None else {}
+        self.sums, self.counts = {}, {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            scalars, step = item
+            scalars = {name: value.item() if torch.is_tensor(value) else value for name, value in scalars.items()}
+            with self.lock:
+                for name, value in scalars.items():
+                    self.history.setdefault(name, []).append(value)
+            for sink in self.sinks:
+                sink.write(scalars, step)
+            self.queue.task_done()
+
+    def log(self, name, value, step):
+        value = value.detach() if torch.is_tensor(value) else value
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self.counts[name] >= self.flush_every:
+            self.flush(step)
+
+    def log_scalars(self, scalars, step=-1):
+        self.queue.put((dict(scalars), step))
+
+    def flush(self, step):
+        if len(self.sums) > 0:
+            self.queue.put(({name: self.sums[name] / self.counts[name] for name in self.sums}, step))
+        self.sums, self.counts = {}, {}
+
+    def snapshot(self):
+        # copy of the history for checkpoints, once the worker has written everything queued so far
+        self.queue.join()
+        with self.lock:
+            return {name: list(values) for name, values in self.history.items()}
+
+    def close(self, step=-1):
+        self.flush(step)
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+        return self.snapshot()
+
+
+LOGGERS = ['tensorboard', 'wandb', 'jsonl', 'none']
+
+def build_metric_logger(loggers, log_dir, project=None, flush_every=50, offline=False):
+    sinks = []
+    for name in loggers:
+        if name == 'tensorboard':
+            from torch.utils.tensorboard import SummaryWriter
+            sinks.append(TensorBoardSink(SummaryWriter(log_dir)))
+        elif name == 'wandb':
+            sinks.append(WandbSink(project, mode='offline' if offline else None))
+        elif name == 'jsonl':
+            sinks.append(JSONLSink(os.path.join(log_dir, "metrics.jsonl")))
+        elif name != 'none':
+            raise NotImplementedError("Supported loggers are %s." % ", ".join(LOGGERS))
+    return MetricLogger(sinks, flush_every=flush_every)
@@ -1,21 +1,64 @@
 import torch
 import torch.nn as nn
 import torch.nn.init
+import torch.nn.functional as F
 import math
 
-from utils import linear_block
+from utils import linear_block, masked_softmax, use_cuda, length_mask
+
+
 
 
 
 
 
+ATTN_BACKENDS = ('naive', 'sdpa', 'chunked')
+
+def chunked_attention(Q, K, V, mask=None, scale=None, chunk_size=256):
+    # Q: ... x N x d, K,V: ... x M x d, mask: broadcastable to ... x N x M (nonzero = attend)
+    scale = scale if scale is not None else 1 / math.sqrt(Q.size(-1))
+    outputs = []
+    for i in range(0, Q.size(-2), chunk_size):
+        E = Q[..., i:i+chunk_size, :].matmul(K.transpose(-1, -2)) * scale
+        if mask is not None:
+            mask_i = mask[..., i:i+chunk_size, :]
+            E = E.masked_fill(mask_i == 0, -float("inf"))
+            A = torch.softmax(E, -1).nan_to_num(0.)
+        else:
+            A = torch.softmax(E, -1)
+        outputs.append(A.matmul(V))
+    return torch.cat(outputs, dim=-2)
+
+# scaled_dot_product_attention exists from torch 2.0, its scale argument from 2.1
+SDPA_HAS_SCALE = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1)
+
+def _sdpa(Q, K, V, attn_mask=None, scale=None):
+    if SDPA_HAS_SCALE:
+        return F.scaled_dot_product_attention(Q, K, V, attn_mask=attn_mask, scale=scale)
+    if scale is not None:
+        # the kernel always scales by 1/sqrt(d), so the queries are rescaled to get scale instead
+        Q = Q * (scale * math.sqrt(Q.size(-1)))
+    return F.scaled_dot_product_attention(Q, K, V, attn_mask=attn_mask)
+
+def fused_attention(Q, K, V, mask=None, scale=None):
+    # routes through the fused kernel when available; rows with no valid keys return zeros, matching masked_softmax
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        return chunked_attention(Q, K, V, mask=mask, scale=scale)
+    if mask is None:
+        return _sdpa(Q, K, V, scale=scale)
+    mask = mask.bool()
+    valid_rows = mask.any(dim=-1, keepdim=True)
+    O = _sdpa(Q, K, V, attn_mask=mask | ~valid_rows, scale=scale)
+    return O * valid_rows
 
 
 class MHA(nn.Module):
-    def __init__(self, dim_Q, dim_K, dim_V, num_heads, bias=None, equi=False, nn_attn=False):
+    def __init__(self, dim_Q, dim_K, dim_V, num_heads, bias=None, equi=False, nn_attn=False, attn_backend='naive'):
         super(MHA, self).__init__()
         if bias is None:
             bias = not equi
+        if attn_backend not in ATTN_BACKENDS:
+            raise NotImplementedError("attn_backend must be one of %s" % (ATTN_BACKENDS,))
         self.latent_size = dim_V
         self.num_heads = num_heads
         self.w_q = nn.Linear(dim_Q, dim_V, bias=bias)
@@ -24,6 +67,7 @@ class MHA(nn.Module):
         self.w_o = nn.Linear(dim_V, dim_V, bias=bias)
         self.equi = equi
         self.nn_attn = nn_attn
+        self.attn_backend = attn_backend
 
     def _mha(self, Q, K, mask=None):
         Q_ = self.w_q(Q)
@@ -41,6 +85,35 @@ class MHA(nn.Module):
             A = torch.softmax(E, 3)
         O = self.w_o(torch.cat((A.matmul(V_)).split(1, 0), 3).squeeze(0))
         return O
+
+    def _attend(self, Q_, K_, V_, mask=None):
+        mask = mask.unsqueeze(1) if mask is not None else None
+        scale = 1/math.sqrt(self.latent_size)
+        if self.attn_backend == 'chunked':
+            return chunked_attention(Q_, K_, V_, mask=mask, scale=scale)
+        return fused_attention(Q_, K_, V_, mask=mask, scale=scale)
+
+    def _split_heads(self, X):
+        # bs x N x [d x] latent -> bs x heads x N x ([d *] dim_split)
+        bs, N = X.size(0), X.size(1)
+        X = X.view(*X.size()[:-1], self.num_heads, self.latent_size // self.num_heads)
+        if X.dim() == 5:
+            return X.permute(0, 3, 1, 2, 4).reshape(bs, self.num_heads, N, -1)
+        return X.transpose(1,2)
+
+    def _merge_heads(self, O, size):
+        if len(size) == 4:
+            bs, N, d = size[:3]
+            return O.view(bs, self.num_heads, N, d, -1).permute(0, 2, 3, 1, 4).reshape(size)
+        return O.transpose(1,2).reshape(size)
+
+    def _fused_mha(self, Q, K, mask=None):
+        # in the equivariant case the score sums over both the feature dim and the head dim, so flattening them gives a
+        # standard attention problem whose score tensor is bs x heads x N x M regardless of the number of features
+        Q_ = self.w_q(Q)
+        K_, V_ = self.w_k(K), self.w_v(K)
+        O = self._attend(self._split_heads(Q_), self._split_heads(K_), self._split_heads(V_), mask=mask)
+        return self.w_o(self._merge_heads(O, Q_.size()))
     
     def _equi_mha(self, Q, K, mask=None):
         # band-aid fix for backwards compat:
@@ -63,17 +136,29 @@ class MHA(nn.Module):
         return O
 
     def forward(self, *args, **kwargs):
-        if getattr(self, 'equi', False):
+        if getattr(self, 'attn_backend', 'naive') != 'naive':
+            return self._fused_mha(*args, **kwargs)
+        elif getattr(self, 'equi', False):
             return self._equi_mha(*args, **kwargs)
         else:
             return self._mha(*args, **kwargs)
 
+def set_attn_backend(model, attn_backend):
+    # switch the attention implementation of an already built (or loaded) model; parameters are unaffected
+    if attn_backend not in ATTN_BACKENDS:
+        raise NotImplementedError("attn_backend must be one of %s" % (ATTN_BACKENDS,))
+    for module in model.modules():
+        if isinstance(module, MHA):
+            module.attn_backend = attn_backend
+    return model
+
 
 class MAB(nn.Module):
-    def __init__(self, input_size, latent_size, hidden_size, num_heads, attn_size=None, ln=False, rezero=False, equi=False, nn_attn=False, dropout=0.1):
+    def __init__(self, input_size, latent_size, hidden_size, num_heads, attn_size=None, ln=False, rezero=False, equi=False, nn_attn=False, dropout=0.1,
+            attn_backend='naive'):
         super(MAB, self).__init__()
         attn_size = attn_size if attn_size is not None else input_size
-        self.attn = MHA(input_size, attn_size, latent_size, num_heads, equi=equi, nn_attn=nn_attn)
+        self.attn = MHA(input_size, attn_size, latent_size, num_heads, equi=equi, nn_attn=nn_attn, attn_backend=attn_backend)
         if dropout > 0:
             self.dropout = nn.Dropout(dropout)
         self.fc = nn.Sequential(nn.Linear(latent_size, hidden_size), nn.ReLU(), nn.Linear(hidden_size, latent_size))
@@ -96,10 +181,69 @@ class MAB(nn.Module):
         X = X if getattr(self, 'ln1', None) is None else self.ln1(X)
         return X
 
+def _grouped_linear(X, layers):
+    # X: G x ... x in_features, with G a multiple of len(layers); consecutive blocks of G / len(layers) entries share a layer
+    if len(layers) == 1:
+        return F.linear(X, layers[0].weight, layers[0].bias)
+    W = torch.stack([layer.weight for layer in layers], 0).transpose(1,2)
+    X_ = X.reshape(len(layers), -1, X.size(-1))
+    if layers[0].bias is not None:
+        out = torch.baddbmm(torch.stack([layer.bias for layer in layers], 0).unsqueeze(1), X_, W)
+    else:
+        out = X_.bmm(W)
+    return out.view(*X.size()[:-1], W.size(-1))
+
+def _grouped_layer_norm(X, layers):
+    if len(layers) == 1:
+        return layers[0](X)
+    X_ = F.layer_norm(X, layers[0].normalized_shape, eps=layers[0].eps).reshape(len(layers), -1, X.size(-1))
+    weight = torch.stack([layer.weight for layer in layers], 0).unsqueeze(1)
+    bias = torch.stack([layer.bias for layer in layers], 0).unsqueeze(1)
+    return torch.addcmul(bias, X_, weight).view(X.size())
+
+def _grouped_alpha(mabs, name, X):
+    alphas = [getattr(mab, name, 1) for mab in mabs]
+    if all(not torch.is_tensor(a) and a == 1 for a in alphas):
+        return 1
+    alphas = [a if torch.is_tensor(a) else torch.tensor(float(a), device=X.device, dtype=X.dtype) for a in alphas]
+    return torch.stack(alphas, 0).repeat_interleave(X.size(0) // len(alphas)).view(-1, *([1] * (X.dim() - 1)))
+
+def _distinct_mabs(mabs):
+    # collapses runs of shared modules, e.g. [A, A, B, B] -> [A, B], so shared weights are applied with one matmul
+    for k in range(1, len(mabs) + 1):
+        r = len(mabs) // k
+        if len(mabs) % k == 0 and all(mabs[i] is mabs[(i // r) * r] for i in range(len(mabs))):
+            return mabs[::r]
+    return mabs
+
+def grouped_mab(mabs, Q, K, mask=None):
+    # runs G structurally identical MABs (possibly sharing weights) on stacked inputs Q, K: G x bs x N x ...
+    # with one batched projection/attention/FFN pipeline instead of G separate ones
+    mabs = _distinct_mabs(mabs)
+    attns = [mab.attn for mab in mabs]
+    Q_ = _grouped_linear(Q, [a.w_q for a in attns])
+    K_ = _grouped_linear(K, [a.w_k for a in attns])
+    V_ = _grouped_linear(K, [a.w_v for a in attns])
+    mha = attns[0]
+    O = mha._attend(mha._split_heads(Q_.flatten(0,1)), mha._split_heads(K_.flatten(0,1)), mha._split_heads(V_.flatten(0,1)),
+        mask=mask.flatten(0,1) if mask is not None else None)
+    O = mha._merge_heads(O, Q_.flatten(0,1).size()).view(Q_.size())
+    A = _grouped_linear(O, [a.w_o for a in attns])
+
+    dropout = getattr(mabs[0], 'dropout', None)
+    X = Q + _grouped_alpha(mabs, 'alpha0', Q) * A
+    X = X if dropout is None else dropout(X)
+    X = X if getattr(mabs[0], 'ln0', None) is None else _grouped_layer_norm(X, [mab.ln0 for mab in mabs])
+    FC = _grouped_linear(F.relu(_grouped_linear(X, [mab.fc[0] for mab in mabs])), [mab.fc[2] for mab in mabs])
+    X = X + _grouped_alpha(mabs, 'alpha1', X) * FC
+    X = X if dropout is None else dropout(X)
+    X = X if getattr(mabs[0], 'ln1', None) is None else _grouped_layer_norm(X, [mab.ln1 for mab in mabs])
+    return X
+
 class SAB(nn.Module):
-    def __init__(self, input_size, latent_size, hidden_size, num_heads, ln=False, remove_diag=False, equi=False, nn=False, dropout=0.1):
+    def __init__(self, input_size, latent_size, hidden_size, num_heads, ln=False, remove_diag=False, equi=False, nn=False, dropout=0.1, attn_backend='naive'):
         super(SAB, self).__init__()
-        self.mab = MAB(input_size, latent_size, hidden_size, num_heads, ln=ln, equi=equi, dropout=dropout)
+        self.mab = MAB(input_size, latent_size, hidden_size, num_heads, ln=ln, equi=equi, dropout=dropout, attn_backend=attn_backend)
 
     def forward(self, X, mask=None):
         return self.mab(X, X, mask=mask)
@@ -140,12 +284,18 @@ class CSABSimple(nn.Module):
         Y_out = Y_out if getattr(self, 'ln_y', None) is None else self.ln_y(Y_out)
         return (X_out, Y_out)
 
+def pad_set(Z, L):
+    # zero-pads bs x N x ... to bs x L x ...
+    return torch.cat([Z, Z.new_zeros(Z.size(0), L - Z.size(1), *Z.size()[2:])], dim=1) if Z.size(1) < L else Z
+
 class CSAB(nn.Module):
-    def __init__(self, input_size, latent_size, hidden_size, num_heads, remove_diag=False, nn_attn=False, residual='base', weight_sharing='none', merge='concat', ln=False, lambda0=0.5, **kwargs):
+    def __init__(self, input_size, latent_size, hidden_size, num_heads, remove_diag=False, nn_attn=False, residual='base', weight_sharing='none', merge='concat', ln=False, lambda0=0.5, 
+            fused=False, **kwargs):
         super(CSAB, self).__init__()
         self._init_blocks(input_size, latent_size, hidden_size, num_heads, remove_diag, nn_attn, weight_sharing, ln=ln, merge=merge, **kwargs)
         self.merge = merge
         self.remove_diag = remove_diag
+        self.fused = fused
 
     def _init_blocks(self, input_size, latent_size, hidden_size, num_heads, remove_diag=False, nn_attn=False, weight_sharing='none', ln=False, merge='concat', **kwargs):
         if weight_sharing == 'sym':
@@ -206,13 +356,38 @@ class CSAB(nn.Module):
                 mask_xx, mask_xy, mask_yx, mask_yy = None,None,None,None
         return mask_xx, mask_xy, mask_yx, mask_yy
 
+    def _fused_forward(self, X, Y, masks=None):
+        # pads both sets to a common length and runs the XX, XY, YX and YY branches as one grouped MAB
+        N, M = X.size(1), Y.size(1)
+        L = max(N, M)
+        branch_masks = self._get_masks(N, M, masks)
+        Xp, Yp = pad_set(X, L), pad_set(Y, L)
+        # branch order XX, YY, XY, YX keeps shared modules adjacent
+        Q = torch.stack([Xp, Yp, Xp, Yp], 0)
+        K = torch.stack([Xp, Yp, Yp, Xp], 0)
+        mask_xx, mask_xy, mask_yx, mask_yy = branch_masks
+        if N != M or any(mask is not None for mask in branch_masks):
+            sizes = [(N, N), (M, M), (N, M), (M, N)]
+            mask = torch.zeros(4, X.size(0), L, L, dtype=torch.bool, device=X.device)
+            for g, ((n, m), mask_g) in enumerate(zip(sizes, [mask_xx, mask_yy, mask_xy, mask_yx])):
+                mask[g, :, :n, :m] = True if mask_g is None else mask_g.bool()
+        else:
+            mask = None
+        Z = grouped_mab([self.MAB_XX, self.MAB_YY, self.MAB_XY, self.MAB_YX], Q, K, mask=mask)
+        return self._merge(X, Y, Z[0, :, :N], Z[2, :, :N], Z[3, :, :M], Z[1, :, :M])
+
     def forward(self, inputs, masks=None, neighbours=None):
         X, Y = inputs
+        if getattr(self, 'fused', False):
+            return self._fused_forward(X, Y, masks=masks)
         mask_xx, mask_xy, mask_yx, mask_yy = self._get_masks(X.size(1), Y.size(1), masks)
         XX = self.MAB_XX(X, X, mask=mask_xx)
         XY = self.MAB_XY(X, Y, mask=mask_xy)
         YX = self.MAB_YX(Y, X, mask=mask_yx)
         YY = self.MAB_YY(Y, Y, mask=mask_yy)
+        return self._merge(X, Y, XX, XY, YX, YY)
+
+    def _merge(self, X, Y, XX, XY, YX, YY):
         if self.merge == "concat":
             X_merge = self.fc_X(torch.cat([XX, XY], dim=-1))
             Y_merge = self.fc_Y(torch.cat([YY, YX], dim=-1))
@@ -225,6 +400,49 @@ class CSAB(nn.Module):
         Y_out = Y_out if getattr(self, 'ln_y', None) is None else self.ln_y(Y_out)
         return (X_out, Y_out)
 
+def element_masks(masks):
+    # recovers the bs x N and bs x M validity masks of X and Y from the (xx, xy, yx, yy) attention masks
+    if masks is None:
+        return None, None
+    mask_xx, _, _, mask_yy = masks
+    return mask_xx.bool().any(dim=1), mask_yy.bool().any(dim=1)
+
+class InducedCSAB(CSAB):
+    # ISAB-style cross-set block: each set is summarized by num_inds learned seeds and every element attends to the
+    # summaries of both sets, so a block costs O((N+M) * num_inds) instead of O(N^2 + NM + M^2)
+    def __init__(self, input_size, latent_size, hidden_size, num_heads, num_inds=32, weight_sharing='none', merge='concat', ln=False, fused=False, 
+            **kwargs):
+        super(InducedCSAB, self).__init__(input_size, latent_size, hidden_size, num_heads, weight_sharing=weight_sharing, merge=merge, ln=ln, 
+            fused=fused, **kwargs)
+        if weight_sharing == 'sym':
+            ind = PMA(input_size, hidden_size, num_heads, num_inds, ln=ln, **kwargs)
+            self.ind_x = ind
+            self.ind_y = ind
+        else:
+            self.ind_x = PMA(input_size, hidden_size, num_heads, num_inds, ln=ln, **kwargs)
+            self.ind_y = PMA(input_size, hidden_size, num_heads, num_inds, ln=ln, **kwargs)
+        self.num_inds = num_inds
+
+    def forward(self, inputs, masks=None):
+        X, Y = inputs
+        x_valid, y_valid = element_masks(masks)
+        H_X = self.ind_x(X, mask=x_valid)
+        H_Y = self.ind_y(Y, mask=y_valid)
+        if getattr(self, 'fused', False):
+            # every branch attends to num_inds keys, so only the queries are padded and no mask is needed; the outputs
+            # of padded queries are dropped
+            N, M = X.size(1), Y.size(1)
+            L = max(N, M)
+            Xp, Yp = pad_set(X, L), pad_set(Y, L)
+            Z = grouped_mab([self.MAB_XX, self.MAB_YY, self.MAB_XY, self.MAB_YX], torch.stack([Xp, Yp, Xp, Yp], 0), 
+                torch.stack([H_X, H_Y, H_Y, H_X], 0))
+            return self._merge(X, Y, Z[0, :, :N], Z[2, :, :N], Z[3, :, :M], Z[1, :, :M])
+        XX = self.MAB_XX(X, H_X)
+        XY = self.MAB_XY(X, H_Y)
+        YX = self.MAB_YX(Y, H_X)
+        YY = self.MAB_YY(Y, H_Y)
+        return self._merge(X, Y, XX, XY, YX, YY)
+
 class RFFBlock(nn.Module):
     def __init__(self, latent_size, hidden_size, num_layers=2, ln=False, dropout=0):
         super().__init__()
@@ -411,14 +629,32 @@ class PINE(nn.Module):
 
 
 class PMA(nn.Module):
-    def __init__(self, latent_size, hidden_size, num_heads, num_seeds, ln=False):
+    def __init__(self, latent_size, hidden_size, num_heads, num_seeds, ln=False, **kwargs):
         super(PMA, self).__init__()
         self.S = nn.Parameter(torch.Tensor(1, num_seeds, latent_size))
         nn.init.xavier_uniform_(self.S)
-        self.mab = MAB(latent_size, latent_size, hidden_size, num_heads, ln=ln)
+        self.mab = MAB(latent_size, latent_size, hidden_size, num_heads, ln=ln, **kwargs)
 
-    def forward(self, X):
-        return self.mab(self.S.repeat(X.size(0), 1, 1), X)
+    def forward(self, X, mask=None):
+        # mask: bs x N, nonzero for valid elements of X
+        S = self.S.repeat(X.size(0), 1, 1)
+        if X.dim() == 4:
+            #equivariant inputs: the same seeds are shared across every feature dimension
+            S = S.unsqueeze(2).expand(-1, -1, X.size(2), -1)
+        if mask is not None:
+            mask = mask.unsqueeze(1).expand(-1, S.size(1), -1)
+        return self.mab(S, X, mask=mask)
+
+def masked_max(X, mask=None, dim=1):
+    if mask is not None:
+        X = X.masked_fill(~mask.view(*mask.size(), *[1 for _ in X.size()[2:]]), -float("inf"))
+    return X.max(dim=dim)[0]
+
+def masked_mean(X, mask=None, dim=1):
+    if mask is None:
+        return X.mean(dim=dim)
+    mask = mask.view(*mask.size(), *[1 for _ in X.size()[2:]]).to(X.dtype)
+    return (X * mask).sum(dim=dim) / mask.sum(dim=dim)
 
 class EncoderStack(nn.Sequential):
     def __init__(self,*args, **kwargs):
@@ -453,18 +689,22 @@ class SetTransformer(nn.Module):
 
 class MultiSetTransformer(nn.Module):
     def __init__(self, input_size, latent_size, hidden_size, output_size, num_heads=4, num_blocks=2, remove_diag=False, ln=False, equi=False, 
-            weight_sharing='none', dropout=0.1, decoder_layers=0, pool='pma', merge='concat'):
+            weight_sharing='none', dropout=0.1, decoder_layers=0, pool='pma', merge='concat', attn_backend='naive', num_inds=-1, fused=False):
         super(MultiSetTransformer, self).__init__()
         if equi:
             input_size = 1
         self.input_size = input_size
         self.proj = None if input_size == latent_size else nn.Linear(input_size, latent_size) 
-        self.enc = EncoderStack(*[CSAB(latent_size, latent_size, hidden_size, num_heads, ln=ln, remove_diag=remove_diag, 
-                equi=equi, weight_sharing=weight_sharing, dropout=dropout, merge='concat') for i in range(num_blocks)])
+        if num_inds > 0:
+            self.enc = EncoderStack(*[InducedCSAB(latent_size, latent_size, hidden_size, num_heads, num_inds=num_inds, ln=ln, 
+                    equi=equi, weight_sharing=weight_sharing, dropout=dropout, merge='concat', attn_backend=attn_backend, fused=fused) for i in range(num_blocks)])
+        else:
+            self.enc = EncoderStack(*[CSAB(latent_size, latent_size, hidden_size, num_heads, ln=ln, remove_diag=remove_diag, 
+                    equi=equi, weight_sharing=weight_sharing, dropout=dropout, merge='concat', attn_backend=attn_backend, fused=fused) for i in range(num_blocks)])
         self.pool_method = pool
         if self.pool_method == "pma":
-            self.pool_x = PMA(latent_size, hidden_size, num_heads, 1, ln=ln)
-            self.pool_y = PMA(latent_size, hidden_size, num_heads, 1, ln=ln)
+            self.pool_x = PMA(latent_size, hidden_size, num_heads, 1, ln=ln, attn_backend=attn_backend)
+            self.pool_y = PMA(latent_size, hidden_size, num_heads, 1, ln=ln, attn_backend=attn_backend)
         self.dec = self._make_decoder(latent_size, hidden_size, output_size, decoder_layers)
         self.remove_diag = remove_diag
         self.equi=equi
@@ -483,36 +723,99 @@ class MultiSetTransformer(nn.Module):
                 nn.Linear(hidden_size, output_size)
             )
 
-    def forward(self, X, Y, masks=None):
+    def _embed(self, X, Y):
         ZX, ZY = X, Y
         if self.equi:
             ZX, ZY = ZX.unsqueeze(-1), ZY.unsqueeze(-1)
         if self.proj is not None:
             ZX, ZY = self.proj(ZX), self.proj(ZY)
-            
+        return ZX, ZY
+
+    def forward(self, X, Y, masks=None):
+        ZX, ZY = self._embed(X, Y)
         ZX, ZY = self.enc((ZX, ZY), masks=masks)
-            
+        return self._decode(ZX, ZY, masks=masks)
+
+    def _decode(self, ZX, ZY, masks=None):
         if self.equi:
             ZX = ZX.max(dim=2)[0]
             ZY = ZY.max(dim=2)[0]
         
+        x_mask, y_mask = element_masks(masks)
         #backwards compatibility
         if getattr(self, "pool_method", None) is None or self.pool_method == "pma":
-            ZX = self.pool_x(ZX)
-            ZY = self.pool_y(ZY)
+            ZX = self.pool_x(ZX, mask=x_mask)
+            ZY = self.pool_y(ZY, mask=y_mask)
         elif self.pool_method == "max":
-            ZX = torch.max(ZX, dim=1)
-            ZY = torch.max(ZY, dim=1)
+            ZX = masked_max(ZX, x_mask)
+            ZY = masked_max(ZY, y_mask)
         elif self.pool_method == "mean":
-            ZX = torch.mean(ZX, dim=1)
-            ZY = torch.mean(ZY, dim=1)
+            ZX = masked_mean(ZX, x_mask)
+            ZY = masked_mean(ZY, y_mask)
 
         out = self.dec(torch.cat([ZX, ZY], dim=-1))
         return out.squeeze(-1)
 
+
+class StreamingMultiSetTransformer():
+    '''
+    Incremental encoding of growing sets for a (non-masked) MultiSetTransformer. The input of every encoder block is
+    cached for all elements; appended elements are encoded exactly against the cached representations of both sets,
+    while the cached elements keep their representations rather than also attending to the new ones, which is where
+    the error comes from. Pooling and the decoder run over the updated caches. An append costs O(k * N) per block
+    instead of the O(N^2) of a full forward, and once more than max_stale of the elements have been appended since the
+    last full forward, the caches are recomputed, which bounds the drift (max_stale=0 recomputes on every append).
+    '''
+    def __init__(self, model, max_stale=0.1):
+        if any(getattr(block, 'remove_diag', False) for block in model.enc):
+            raise NotImplementedError("Streaming is not supported with remove_diag.")
+        self.model = model
+        self.max_stale = max_stale
+
+    @torch.no_grad()
+    def reset(self, X, Y):
+        self.X, self.Y = X, Y
+        ZX, ZY = self.model._embed(X, Y)
+        self.cache = []
+        for block in self.model.enc:
+            self.cache.append((ZX, ZY))
+            ZX, ZY = block((ZX, ZY))
+        self.outputs = (ZX, ZY)
+        self.n_stale = 0
+        return self.model._decode(ZX, ZY)
+
+    def _append_block(self, block, ZX, ZY, X_new, Y_new):
+        # X_new, Y_new: block inputs of the appended elements; ZX, ZY: cached block inputs including them
+        if isinstance(block, InducedCSAB):
+            H_X, H_Y = block.ind_x(ZX), block.ind_y(ZY)
+            return block._merge(X_new, Y_new, block.MAB_XX(X_new, H_X), block.MAB_XY(X_new, H_Y), 
+                block.MAB_YX(Y_new, H_X), block.MAB_YY(Y_new, H_Y))
+        return block._merge(X_new, Y_new, block.MAB_XX(X_new, ZX), block.MAB_XY(X_new, ZY), 
+            block.MAB_YX(Y_new, ZX), block.MAB_YY(Y_new, ZY))
+
+    @torch.no_grad()
+    def append(self, X_new=None, Y_new=None):
+        # X_new: bs x k x d elements appended to X (likewise Y_new); returns the model output for the grown sets
+        X_new = X_new if X_new is not None else self.X[:, :0]
+        Y_new = Y_new if Y_new is not None else self.Y[:, :0]
+        self.X, self.Y = torch.cat([self.X, X_new], dim=1), torch.cat([self.Y, Y_new], dim=1)
+        self.n_stale += X_new.size(1) + Y_new.size(1)
+        if self.n_stale > self.max_stale * (self.X.size(1) + self.Y.size(1)):
+            return self.reset(self.X, self.Y)
+
+        ZX_new, ZY_new = self.model._embed(X_new, Y_new)
+        for i, block in enumerate(self.model.enc):
+            ZX, ZY = self.cache[i]
+            ZX, ZY = torch.cat([ZX, ZX_new], dim=1), torch.cat([ZY, ZY_new], dim=1)
+            self.cache[i] = (ZX, ZY)
+            ZX_new, ZY_new = self._append_block(block, ZX, ZY, ZX_new, ZY_new)
+        self.outputs = tuple(torch.cat([Z, Z_new], dim=1) for Z, Z_new in zip(self.outputs, (ZX_new, ZY_new)))
+        return self.model._decode(*self.outputs)
+
+
 class MultiSetTransformerEncoder(nn.Module):
     def __init__(self, x_size, y_size, latent_size, hidden_size, output_size, num_heads=4, num_blocks=2, remove_diag=False, ln=False, equi=False, 
-            weight_sharing='none', dropout=0.1, decoder_layers=0, merge='concat', merge_output_sets=False):
+            weight_sharing='none', dropout=0.1, decoder_layers=0, merge='concat', merge_output_sets=False, attn_backend='naive', fused=False):
         super(MultiSetTransformerEncoder, self).__init__()
         if equi:
             x_size = 1
@@ -524,7 +827,7 @@ class MultiSetTransformerEncoder(nn.Module):
         self.proj_x = None if x_size == latent_size else nn.Linear(x_size, latent_size) 
         self.proj_y = None if y_size == latent_size else nn.Linear(y_size, latent_size) 
         self.enc = EncoderStack(*[CSAB(latent_size, latent_size, hidden_size, num_heads, ln=ln, remove_diag=remove_diag, 
-                equi=equi, weight_sharing=weight_sharing, dropout=dropout, merge='concat') for i in range(num_blocks)])
+                equi=equi, weight_sharing=weight_sharing, dropout=dropout, merge='concat', attn_backend=attn_backend, fused=fused) for i in range(num_blocks)])
         self.dec = self._make_decoder(decoder_input_size, hidden_size, output_size, decoder_layers)
         self.remove_diag = remove_diag
         self.equi=equi
@@ -547,8 +850,8 @@ class MultiSetTransformerEncoder(nn.Module):
         ZX, ZY = X, Y
         if self.equi:
             ZX, ZY = ZX.unsqueeze(-1), ZY.unsqueeze(-1)
-        if self.proj is not None:
-            ZX, ZY = self.proj_x(ZX), self.proj_y(ZY)
+        ZX = ZX if self.proj_x is None else self.proj_x(ZX)
+        ZY = ZY if self.proj_y is None else self.proj_y(ZY)
             
         ZX, ZY = self.enc((ZX, ZY), masks=masks)
             
@@ -777,9 +1080,10 @@ class MultiSetDecoderBlock(nn.Module):
             self.ln1 = None
             self.ln2 = None
 
-    def forward(self, X, A, B, **kwargs):
+    def forward(self, X, A, B, mask=None, **kwargs):
+        # mask: bs x N x N self-attention mask of X (e.g. for padded sets); attention to A and B is unmasked
         if self.self_attn:
-            A1 = self.MHA_X(X, X, **kwargs)
+            A1 = self.MHA_X(X, X, mask=mask, **kwargs)
             A1 = A1 if self.dropout is None else self.dropout(A1)
             Z_X = X + A1
             Z_X = Z_X if self.ln0 is None else self.ln0(Z_X)
@@ -806,7 +1110,7 @@ class MultiSetDecoderBlock(nn.Module):
 class MultiSetTransformerEncoderDecoder(nn.Module):
     def __init__(self, x_size, ab_size, latent_size, hidden_size, output_size, 
             num_heads=4, enc_blocks=2, dec_blocks=2, output_layers=1, equi=False, weight_sharing='none', 
-            ln=False, dropout=0, decoder_self_attn=True, **kwargs):
+            ln=False, dropout=0, decoder_self_attn=True, attn_backend='naive', **kwargs):
         super().__init__()
         if equi:
             x_size, ab_size = 1,1
@@ -823,13 +1127,15 @@ class MultiSetTransformerEncoderDecoder(nn.Module):
                 self.proj_b = nn.Linear(ab_size, latent_size) if ab_size != latent_size else None
         self.encoder_blocks = nn.ModuleList(
             [
-                CSAB(latent_size, latent_size, hidden_size, num_heads, equi=equi, weight_sharing=weight_sharing, ln=ln, dropout=dropout, **kwargs)
+                CSAB(latent_size, latent_size, hidden_size, num_heads, equi=equi, weight_sharing=weight_sharing, ln=ln, dropout=dropout, 
+                    attn_backend=attn_backend, **kwargs)
                 for _ in range(enc_blocks)
             ]
         )
         self.decoder_blocks = nn.ModuleList(
             [
-                MultiSetDecoderBlock(latent_size, hidden_size, latent_size, num_heads, equi=equi, ln=ln, dropout=dropout, self_attn=decoder_self_attn)
+                MultiSetDecoderBlock(latent_size, hidden_size, latent_size, num_heads, equi=equi, ln=ln, dropout=dropout, self_attn=decoder_self_attn, 
+                    attn_backend=attn_backend)
                 for _ in range(dec_blocks)
             ]
         )
@@ -850,7 +1156,9 @@ class MultiSetTransformerEncoderDecoder(nn.Module):
                 nn.Linear(hidden_size, output_size)
             )
 
-    def forward(self, A, B, *sets):
+    def encode(self, A, B):
+        # the encoded (A, B) context, which any number of decode calls can reuse. a context with batch size 1 is
+        # broadcast against query batches of any size
         ZA, ZB = A, B
         if self.equi:
             ZA, ZB = ZA.unsqueeze(-1), ZB.unsqueeze(-1)
@@ -859,22 +1167,45 @@ class MultiSetTransformerEncoderDecoder(nn.Module):
 
         for i in range(len(self.encoder_blocks)):
             ZA, ZB = self.encoder_blocks[i]((ZA, ZB))
+        return ZA, ZB
+
+    def decode(self, context, X, lengths=None):
+        # X: bs x N x d query sets; with lengths, sets are padded to N and padding is masked out of the self-attention,
+        # so the outputs of valid elements don't depend on it
+        ZA, ZB = context
+        mask = None
+        if lengths is not None:
+            mask = length_mask(lengths, X.size(1))[:, None, :].expand(-1, X.size(1), -1)
+        if self.equi:
+            X = X.unsqueeze(-1)
+        X = X if getattr(self, 'proj_x', None) is None else self.proj_x(X)
 
-        outputs = []
-        for s in sets:
-            X = s
-            if self.equi:
-                X = X.unsqueeze(-1)
-            X = X if getattr(self, 'proj_x', None) is None else self.proj_x(X)
+        for i in range(len(self.decoder_blocks)):
+            X = self.decoder_blocks[i](X, ZA, ZB, mask=mask)
 
-            for i in range(len(self.decoder_blocks)):
-                X = self.decoder_blocks[i](X, ZA, ZB)
+        if self.equi:
+            X = X.max(dim=2)[0]
+        
+        return self.output_head(X).squeeze(-1)
+
+    @torch.no_grad()
+    def score(self, context, sets, batch_size=64):
+        # scores a list of query sets (each N_i x d) against one encoded reference pair (batch size 1), in padded batches
+        # of up to batch_size sets of similar size. returns the per-element outputs of each set, in order
+        order = sorted(range(len(sets)), key=lambda i: sets[i].size(0))
+        outputs = [None] * len(sets)
+        for start in range(0, len(order), batch_size):
+            batch = [sets[i] for i in order[start:start+batch_size]]
+            lengths = torch.tensor([X.size(0) for X in batch], device=batch[0].device)
+            X = nn.utils.rnn.pad_sequence(batch, batch_first=True)
+            out = self.decode(context, X, lengths=lengths if lengths.min() < X.size(1) else None)
+            for i, n, o in zip(order[start:start+batch_size], lengths.tolist(), out):
+                outputs[i] = o[:n]
+        return outputs
 
-            if self.equi:
-                X = X.max(dim=2)[0]
-            
-            out = self.output_head(X).squeeze(-1)
-            outputs.append(out)
+    def forward(self, A, B, *sets):
+        context = self.encode(A, B)
+        outputs = [self.decode(context, X) for X in sets]
         
         if len(outputs) == 1:
             outputs = outputs[0]
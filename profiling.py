@@ -0,0 +1,28 @@
+import torch
+from torch.autograd import DeviceType
+from torch.profiler import profile, ProfilerActivity
+
+import time
+
+
+def count_kernels(fct):
+    # number of device kernels launched (CUDA) or top-level aten ops dispatched (CPU) by one call of fct
+    use_cuda = torch.cuda.is_available()
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if use_cuda else [])
+    with profile(activities=activities) as prof:
+        fct()
+    if use_cuda:
+        return sum(1 for evt in prof.events() if evt.device_type == DeviceType.CUDA)
+    return sum(1 for evt in prof.events() if evt.name.startswith('aten::') and evt.cpu_parent is None)
+
+def time_fct(fct, steps, warmup=3):
+    for _ in range(warmup):
+        fct()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fct()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
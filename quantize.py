@@ -0,0 +1,108 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+
+import os
+import copy
+import argparse
+
+from models.set import MAB, CSAB, RNBlock
+from tasks import TASKS
+from checkpoint import CheckpointWriter
+from export import freeze_config, example_inputs
+from profiling import time_fct
+
+
+QUANTIZED_BLOCKS = (MAB, RNBlock)
+DECODER_HEADS = ('dec', 'decoder', 'output_head')
+
+
+def quantizable_linears(model):
+    # names of the nn.Linear layers inside MABs and RNBlocks, of the CSAB merge layers and of the decoder heads
+    blocks = [name for name, module in model.named_modules() if isinstance(module, QUANTIZED_BLOCKS)]
+    merge_layers = [name + "." + fc for name, module in model.named_modules() if isinstance(module, CSAB)
+        for fc in ('fc_X', 'fc_Y') if isinstance(getattr(module, fc, None), nn.Linear)]
+    prefixes = blocks + list(DECODER_HEADS)
+    return [name for name, module in model.named_modules() if isinstance(module, nn.Linear) and
+        (name in merge_layers or any(name.startswith(prefix + ".") or name == prefix for prefix in prefixes))]
+
+def final_decoder_layer(model):
+    # the last linear layer of the decoder head, which outputs the estimate itself
+    layers = [name for name in quantizable_linears(model) if name.split(".")[0] in DECODER_HEADS]
+    return layers[-1] if len(layers) > 0 else None
+
+
+def quantize_model(model, exclude=(), keep_final_decoder=False):
+    '''
+    Returns a copy of the model with dynamic int8 quantization (int8 weights, activations quantized per batch) applied
+    to the layers given by quantizable_linears, except those under the module names in exclude and, with
+    keep_final_decoder, the final decoder layer. Fused CSABs read the MAB weights directly, so they are run unfused.
+    '''
+    model = freeze_config(copy.deepcopy(model).cpu())
+    exclude = list(exclude) + ([final_decoder_layer(model)] if keep_final_decoder else [])
+    names = [name for name in quantizable_linears(model)
+        if not any(name == prefix or name.startswith(prefix + ".") for prefix in exclude if prefix is not None)]
+    return quantize_dynamic(model, {name: default_dynamic_qconfig for name in names}, dtype=torch.qint8)
+
+
+def load_run(run_dir, checkpoint_dir=None):
+    # the model saved at the end of a run, or the latest checkpoint in checkpoint_dir
+    out_path = os.path.join(run_dir, "out.pt")
+    args_path = out_path if os.path.exists(out_path) else os.path.join(run_dir, "args.pt")
+    args = torch.load(args_path, weights_only=False)['args']
+    task = TASKS[args.task](args)
+    if checkpoint_dir is not None:
+        model = task.build_model()
+        shards, _ = CheckpointWriter(checkpoint_dir, main_process=False).load(map_location='cpu')
+        model.load_state_dict(shards['model'])
+    else:
+        model = torch.load(os.path.join(run_dir, "model.pt"), map_location='cpu', weights_only=False)
+    return args, task, model.cpu().eval()
+
+
+def compare_metrics(task, models, steps):
+    # val metrics of each model on the same eval sets, which the trainer's eval cache generates once
+    train_dataset, val_dataset, test_dataset = task.build_dataset()
+    dataset = next(d for d in (val_dataset, test_dataset, train_dataset) if d is not None)
+    trainer = task.build_trainer(None, None, None, train_dataset, val_dataset, test_dataset, torch.device('cpu'), None)
+    metrics = {}
+    for name, model in models.items():
+        trainer.model = model
+        metrics[name] = trainer.evaluate(steps, dataset)
+    return metrics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('run_dir', type=str)     # run directory written by main.py
+    parser.add_argument('--checkpoint_dir', type=str, default=None)     # load the latest checkpoint here instead of model.pt
+    parser.add_argument('--out', type=str, default=None)     # defaults to model_int8.pt in run_dir
+    parser.add_argument('--exclude', type=str, nargs='+', default=[])     # module names to keep in fp32, e.g. dec
+    parser.add_argument('--keep_final_decoder', action='store_true')
+    parser.add_argument('--val_steps', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--set_sizes', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--steps', type=int, default=10)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    run_args, task, model = load_run(args.run_dir, args.checkpoint_dir)
+    qmodel = quantize_model(model, exclude=args.exclude, keep_final_decoder=args.keep_final_decoder)
+    out = args.out if args.out is not None else os.path.join(args.run_dir, "model_int8.pt")
+    torch.save(qmodel, out)
+    n_quantized = sum(1 for module in qmodel.modules() if isinstance(module, torch.ao.nn.quantized.dynamic.Linear))
+    print("Saved %s with %d quantized linear layers" % (out, n_quantized))
+
+    metrics = compare_metrics(task, {'fp32': model, 'int8': qmodel}, args.val_steps)
+    print("%20s %14s %14s %14s" % ("val metric", "fp32", "int8", "drift"))
+    for name, value in metrics['fp32'].items():
+        print("%20s %14.5f %14.5f %14.5f" % (name, value, metrics['int8'][name], metrics['int8'][name] - value))
+
+    input_size = getattr(run_args, 'input_size', run_args.n)
+    print("%6s %12s %12s %8s" % ("N", "fp32 (ms)", "int8 (ms)", "speedup"))
+    for N in args.set_sizes:
+        X, Y = example_inputs(input_size, args.batch_size, (N, N))
+        with torch.no_grad():
+            fp32_time, int8_time = [time_fct(lambda: m(X, Y), args.steps, warmup=2) for m in (model, qmodel)]
+        print("%6d %12.2f %12.2f %8.2f" % (N, fp32_time * 1000, int8_time * 1000, fp32_time / int8_time))
@@ -1,18 +1,12 @@
 
 from builders import SET_MODEL_BUILDERS, CONV_MODEL_BUILDERS
 from trainer import Trainer, CountingTrainer, CaptionTrainer, MetaDatasetTrainer, StatisticalDistanceTrainer, Pretrainer, DonskerVaradhanTrainer, DonskerVaradhanMITrainer#, DonskerVaradhanTrainer2
-from datasets.counting import OmniglotCooccurenceGenerator, ImageCooccurenceGenerator, DatasetByClass, load_cifar, load_mnist, load_omniglot
-from datasets.alignment import EmbeddingAlignmentGenerator, CaptionGenerator, load_coco_data, load_flickr_data, bert_tokenize_batch, fasttext_tokenize_batch, load_pairs, split_pairs
 from datasets.distinguishability import DistinguishabilityGenerator
-from datasets.meta_dataset import MetaDatasetGenerator, Split
 from datasets.distributions import CorrelatedGaussianGenerator, GaussianGenerator, NFGenerator, StandardGaussianGenerator, CorrelatedGaussianGenerator2, LabelledGaussianGenerator, RandomEncoderGenerator, ProtectedDatasetGenerator
 from models.task import ImageEncoderWrapper, BertEncoderWrapper, EmbeddingEncoderWrapper, MultiSetImageModel, MultiSetModel
 from models.set import MultiSetTransformerEncoder, MultiSetTransformerEncoderDecoder
-from utils import kl_mc, kl_mc_mixture, mi_corr_gaussian, kl_knn, kraskov_mi1, whiten_split, normalize_sets
+from utils import kl_mc, KLLabels, kl_mc_mixture, mi_corr_gaussian, kl_knn, kraskov_mi1, whiten_split, normalize_sets
 
-import fasttext
-from transformers import BertTokenizer, BertModel
-import torchvision
 import torch.nn as nn
 import torch
 
@@ -37,11 +31,19 @@ class Task():
         train_args = {
             'batch_size': self.args.batch_size,
             'grad_steps': self.args.grad_steps,
-            'data_kwargs': {'set_size': self.args.set_size}
+            'data_kwargs': {'set_size': self.args.set_size},
+            'variable_size': getattr(self.args, 'variable_size', False),
+            'ss_buckets': getattr(self.args, 'ss_buckets', 0),
+            'token_budget': getattr(self.args, 'token_budget', -1),
+            'max_memory': getattr(self.args, 'max_memory', -1),
+            'log_every': getattr(self.args, 'log_every', 50),
+            'keep_checkpoints': getattr(self.args, 'keep_checkpoints', 3)
         }
         eval_args = {
             'batch_size': self.args.batch_size,
-            'data_kwargs': {'set_size': self.args.set_size}
+            'data_kwargs': {'set_size': self.args.set_size},
+            'eval_seed': getattr(self.args, 'eval_seed', 0),
+            'eval_cache_dir': getattr(self.args, 'eval_cache_dir', None)
         }
         return train_args, eval_args
 
@@ -89,6 +91,8 @@ class ImageClassificationTask(Task):
 
 class EmbeddingTask(Task):
     def build_dataset(self):
+        import fasttext
+        from datasets.alignment import EmbeddingAlignmentGenerator, load_pairs, split_pairs
         src_emb = fasttext.load_model(os.path.join(self.args.dataset_dir, "fasttext", "cc.en.300.bin"))
         tgt_emb = fasttext.load_model(os.path.join(self.args.dataset_dir, "fasttext", "cc.fr.300.bin"))
         pairs = load_pairs(os.path.join(self.args.dataset_dir, "fasttext", "valid_en-fr.txt"))
@@ -105,11 +109,14 @@ class EmbeddingTask(Task):
 class CaptionTask(Task):
     trainer_cls = CaptionTrainer
     def build_dataset(self):
+        from datasets.alignment import CaptionGenerator, load_coco_data, load_flickr_data, bert_tokenize_batch, fasttext_tokenize_batch
         if self.args.text_model == 'bert':
+            from transformers import BertTokenizer
             tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
             tokenize_fct = bert_tokenize_batch
             tokenize_args = (tokenizer,)
         elif self.args.text_model == 'ft':
+            import fasttext
             ft = fasttext.load_model(self.args.embed_path)
             tokenize_fct = fasttext_tokenize_batch
             tokenize_args = (ft,)
@@ -135,12 +142,14 @@ class CaptionTask(Task):
         self.args.input_size = self.args.latent_size
         set_model = super().build_model()
         if self.args.text_model == 'bert':
+            from transformers import BertModel
             model = BertModel.from_pretrained("bert-base-uncased")
             text_encoder = BertEncoderWrapper(model)
         else:
             text_encoder = EmbeddingEncoderWrapper(self.args.embed_dim)
 
         if self.args.img_model == 'resnet':
+            import torchvision
             resnet = torchvision.models.resnet101(pretrained=True)
             resnet.fc = nn.Identity()
             img_encoder = ImageEncoderWrapper(resnet, 2048)
@@ -159,6 +168,7 @@ class CountingTask(Task):
     pretraining_task = ImageClassificationTask
     trainer_cls = CountingTrainer
     def build_dataset(self):
+        from datasets.counting import OmniglotCooccurenceGenerator, ImageCooccurenceGenerator, DatasetByClass, load_cifar, load_mnist, load_omniglot
         if self.args.dataset.lower() == "mnist":
             trainval_dataset, test_dataset = load_mnist(self.args.dataset_dir)
             n_val = int(len(trainval_dataset) * self.args.val_split)
@@ -236,6 +246,7 @@ class MetaDatasetTask(Task):
         if self.args.img_encoder == "cnn":
             encoder = CONV_MODEL_BUILDERS[self.args.dataset](self.args)
         else:
+            import torchvision
             encoder = torchvision.models.resnet101(pretrained=False)
             encoder.fc = nn.Linear(2048, self.args.latent_size)
         discriminator = MultiSetImageModel(encoder, set_model)
@@ -243,6 +254,7 @@ class MetaDatasetTask(Task):
         return model
 
     def build_dataset(self):
+        from datasets.meta_dataset import MetaDatasetGenerator, Split
         image_size = 84 if self.args.img_encoder == "cnn" else 224
         train_generator = MetaDatasetGenerator(root_dir=self.args.dataset_path, image_size=image_size, split=Split.TRAIN)
         val_generator = MetaDatasetGenerator(root_dir=self.args.dataset_path, image_size=image_size, split=Split.VALID)
@@ -302,12 +314,23 @@ class StatisticalDistanceTask(Task):
             'grad_steps': self.args.grad_steps,
             'sample_kwargs': sample_kwargs,
             'label_kwargs': {},
-            'clip': getattr(self.args, 'clip', -1)
+            'clip': getattr(self.args, 'clip', -1),
+            'whiten_method': getattr(self.args, 'whiten_method', 'zca'),
+            'whiten_momentum': getattr(self.args, 'whiten_momentum', -1),
+            'variable_size': getattr(self.args, 'variable_size', False),
+            'ss_buckets': getattr(self.args, 'ss_buckets', 0),
+            'token_budget': getattr(self.args, 'token_budget', -1),
+            'max_memory': getattr(self.args, 'max_memory', -1),
+            'log_every': getattr(self.args, 'log_every', 50),
+            'keep_checkpoints': getattr(self.args, 'keep_checkpoints', 3)
         }
         eval_args = {
             'batch_size': self.args.batch_size,
             'sample_kwargs': sample_kwargs,
-            'label_kwargs': {}
+            'label_kwargs': {},
+            'eval_batch_size': getattr(self.args, 'eval_batch_size', None) or self.args.batch_size,
+            'eval_seed': getattr(self.args, 'eval_seed', 0),
+            'eval_cache_dir': getattr(self.args, 'eval_cache_dir', None)
         }
         return train_args, eval_args
 
@@ -315,7 +338,8 @@ class StatisticalDistanceTask(Task):
 class KLTask(StatisticalDistanceTask):
     def build_dataset(self):
         if self.args.dataset == 'gmm':
-            generator = GaussianGenerator(num_outputs=2, variable_dim=self.args.equi, return_params=True, mixture=True)
+            generator = GaussianGenerator(num_outputs=2, variable_dim=self.args.equi, return_params=True, 
+                mixture=not getattr(self.args, 'single_gaussian', False))
         elif self.args.dataset == 'nf':
             generator = NFGenerator(32, 2, num_outputs=2, use_maf=False, variable_dim=self.args.equi, return_params=True)
         else:
@@ -332,7 +356,9 @@ class KLTask(StatisticalDistanceTask):
         trainer_kwargs = {
             'eval_every': self.args.eval_every,
             'save_every': self.args.save_every,
-            'label_fct': kl_mc,
+            'ss_schedule': self.args.ss_schedule,
+            'label_fct': KLLabels(mode=getattr(self.args, 'kl_labels', 'set'), N=getattr(self.args, 'kl_samples', 500), 
+                reuse_samples=getattr(self.args, 'kl_reuse_samples', False)),
             'exact_loss': True,
             'criterion': nn.L1Loss(),
             'baselines': {'knn': kl_knn}
@@ -356,6 +382,7 @@ class MITask(StatisticalDistanceTask):
         trainer_kwargs = {
             'eval_every': self.args.eval_every,
             'save_every': self.args.save_every,
+            'ss_schedule': self.args.ss_schedule,
             'label_fct': mi_corr_gaussian,
             'exact_loss': True,
             'criterion': nn.MSELoss(),
@@ -393,6 +420,7 @@ class DVTask(StatisticalDistanceTask):
         trainer_kwargs = {
             'eval_every': self.args.eval_every,
             'save_every': self.args.save_every,
+            'ss_schedule': self.args.ss_schedule,
             'label_fct': kl_mc,
             'criterion': nn.L1Loss(),
             'split_inputs': self.args.split_inputs,
@@ -413,6 +441,8 @@ class DVTask(StatisticalDistanceTask):
             'decoder_layers': self.args.decoder_layers,
             'merge': 'concat',
             'weight_sharing': 'sym',     #IMPORTANT
+            'attn_backend': getattr(self.args, 'attn_backend', 'naive'),
+            'fused': getattr(self.args, 'fused_csab', False),
         }
         set_model = MultiSetTransformerEncoder(self.args.n, self.args.n, self.args.latent_size, self.args.hidden_size, 1, **model_kwargs)
         return set_model
@@ -428,7 +458,9 @@ class DVTask(StatisticalDistanceTask):
             'equi':self.args.equi,
             'output_layers': self.args.decoder_layers,
             'merge': 'concat',
-            'decoder_self_attn': self.args.decoder_self_attn
+            'decoder_self_attn': self.args.decoder_self_attn,
+            'attn_backend': getattr(self.args, 'attn_backend', 'naive'),
+            'fused': getattr(self.args, 'fused_csab', False)
         }
         n = self.args.n * 2 if self.args.dataset == 'corr'else self.args.n
         set_model = MultiSetTransformerEncoderDecoder(n, n, self.args.latent_size, self.args.hidden_size, 1, **model_kwargs)
@@ -474,6 +506,7 @@ class DVMITask(StatisticalDistanceTask):
         trainer_kwargs = {
             'eval_every': self.args.eval_every,
             'save_every': self.args.save_every,
+            'ss_schedule': self.args.ss_schedule,
             'criterion': nn.L1Loss(),
             'estimate_size': getattr(self.args, 'estimate_size', -1),
             'scale': getattr(self.args, 'scale', 'none'),
@@ -517,7 +550,9 @@ class DVMITask(StatisticalDistanceTask):
             'decoder_layers': self.args.decoder_layers,
             'merge': 'concat',
             'weight_sharing': 'sym',     #IMPORTANT?? Not sure if necessary or not for MI but probably helpful
-            'merge_output_sets': True
+            'merge_output_sets': True,
+            'attn_backend': getattr(self.args, 'attn_backend', 'naive'),
+            'fused': getattr(self.args, 'fused_csab', False)
         }
         if self.args.dataset == 'corr':
             x_size, y_size = self.args.n, self.args.n
@@ -539,7 +574,9 @@ class DVMITask(StatisticalDistanceTask):
             'equi':self.args.equi,
             'output_layers': self.args.decoder_layers,
             'merge': 'concat',
-            'decoder_self_attn': self.args.decoder_self_attn
+            'decoder_self_attn': self.args.decoder_self_attn,
+            'attn_backend': getattr(self.args, 'attn_backend', 'naive'),
+            'fused': getattr(self.args, 'fused_csab', False)
         }
         if self.args.dataset == 'corr':
             input_size = self.args.n * 2
@@ -591,6 +628,7 @@ class DVTask2(StatisticalDistanceTask):
         trainer_kwargs = {
             'eval_every': self.args.eval_every,
             'save_every': self.args.save_every,
+            'ss_schedule': self.args.ss_schedule,
             'criterion': nn.L1Loss(),
             'split_inputs': False,
             'dataset': self.args.dataset,
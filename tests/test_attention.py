@@ -0,0 +1,104 @@
+import copy
+import pytest
+import torch
+
+from models.set import MHA, CSAB, MultiSetTransformer, chunked_attention, fused_attention, set_attn_backend
+
+
+def random_mask(bs, N, M, empty_rows=True):
+    mask = torch.rand(bs, N, M) > 0.3
+    mask[:, :, 0] = True
+    if empty_rows:
+        mask[:, 1] = False      # fully masked query rows
+    return mask
+
+
+@pytest.mark.parametrize('chunk_size', [3, 256])
+@pytest.mark.parametrize('use_mask', [False, True])
+def test_chunked_matches_sdpa(chunk_size, use_mask):
+    torch.manual_seed(0)
+    Q, K, V = torch.randn(2, 4, 10, 8), torch.randn(2, 4, 7, 8), torch.randn(2, 4, 7, 8)
+    mask = random_mask(2, 10, 7).unsqueeze(1) if use_mask else None
+    out = chunked_attention(Q, K, V, mask=mask, chunk_size=chunk_size)
+    assert torch.allclose(out, fused_attention(Q, K, V, mask=mask), atol=1e-5)
+    if use_mask:
+        assert (out[:, :, 1] == 0).all()
+
+
+@pytest.mark.parametrize('equi,d', [(False, None), (True, 1), (True, 3), (True, 6)])
+@pytest.mark.parametrize('use_mask', [False, True])
+@pytest.mark.parametrize('N,M', [(9, 13), (300, 20)])
+def test_mha_backends_match_naive(equi, d, use_mask, N, M):
+    # the naive backend is _equi_mha for equivariant inputs (bs x N x d x latent) and _mha otherwise
+    torch.manual_seed(0)
+    latent, bs = 16, 2
+    naive = MHA(latent, latent, latent, 4, equi=equi, attn_backend='naive')
+    shape = (d, latent) if equi else (latent,)
+    Q, K = torch.randn(bs, N, *shape), torch.randn(bs, M, *shape)
+    mask = random_mask(bs, N, M) if use_mask else None
+    with torch.no_grad():
+        ref = naive(Q, K, mask=mask)
+        for backend in ('sdpa', 'chunked'):
+            out = set_attn_backend(copy.deepcopy(naive), backend)(Q, K, mask=mask)
+            assert torch.allclose(out, ref, atol=1e-5), backend
+
+
+@pytest.mark.parametrize('equi', [False, True])
+@pytest.mark.parametrize('weight_sharing', ['none', 'cross', 'sym'])
+@pytest.mark.parametrize('use_mask', [False, True])
+def test_fused_csab_matches_unfused(equi, weight_sharing, use_mask):
+    torch.manual_seed(0)
+    latent, bs, N, M = 16, 2, 9, 13
+    block = CSAB(latent, latent, 32, 4, ln=True, equi=equi, weight_sharing=weight_sharing, dropout=0, attn_backend='sdpa').eval()
+    fused = copy.deepcopy(block)
+    fused.fused = True
+    shape = (3, latent) if equi else (latent,)
+    X, Y = torch.randn(bs, N, *shape), torch.randn(bs, M, *shape)
+    masks = (random_mask(bs, N, N, False), random_mask(bs, N, M, False), random_mask(bs, M, N, False), 
+        random_mask(bs, M, M, False)) if use_mask else None
+    with torch.no_grad():
+        for out, ref in zip(fused((X, Y), masks=masks), block((X, Y), masks=masks)):
+            assert torch.allclose(out, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize('equi', [False, True])
+def test_model_backends_match(equi):
+    torch.manual_seed(0)
+    model = MultiSetTransformer(4, 16, 32, 1, num_heads=4, num_blocks=2, ln=True, equi=equi, dropout=0, attn_backend='naive').eval()
+    X, Y = torch.randn(2, 20, 4), torch.randn(2, 15, 4)
+    with torch.no_grad():
+        ref = model(X, Y)
+        for backend in ('sdpa', 'chunked'):
+            assert torch.allclose(set_attn_backend(copy.deepcopy(model), backend)(X, Y), ref, atol=1e-5), backend
+
+
+@pytest.mark.parametrize('equi', [False, True])
+@pytest.mark.parametrize('weight_sharing', ['none', 'sym'])
+@pytest.mark.parametrize('N,M', [(9, 13), (13, 9), (10, 10)])
+def test_fused_induced_csab_matches_unfused(equi, weight_sharing, N, M):
+    torch.manual_seed(0)
+    model = MultiSetTransformer(4, 16, 32, 1, num_heads=4, num_blocks=2, ln=True, equi=equi, weight_sharing=weight_sharing, 
+        dropout=0, attn_backend='sdpa', num_inds=5).eval()
+    fused = copy.deepcopy(model)
+    for block in fused.enc:
+        block.fused = True
+    X, Y = torch.randn(2, N, 4), torch.randn(2, M, 4)
+    with torch.no_grad():
+        assert torch.allclose(fused(X, Y), model(X, Y), atol=1e-5)
+
+
+@pytest.mark.parametrize('use_mask', [False, True])
+def test_sdpa_without_scale_argument(monkeypatch, use_mask):
+    # torch 2.0 has scaled_dot_product_attention but not its scale argument
+    import models.set
+    torch.manual_seed(0)
+    Q, K, V = torch.randn(2, 4, 10, 8), torch.randn(2, 4, 7, 8), torch.randn(2, 4, 7, 8)
+    mask = random_mask(2, 10, 7).unsqueeze(1) if use_mask else None
+    ref = fused_attention(Q, K, V, mask=mask, scale=0.1)
+    sdpa = torch.nn.functional.scaled_dot_product_attention
+    def sdpa_2_0(Q, K, V, attn_mask=None, dropout_p=0.0, is_causal=False):
+        return sdpa(Q, K, V, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
+    monkeypatch.setattr(models.set, 'SDPA_HAS_SCALE', False)
+    monkeypatch.setattr(torch.nn.functional, 'scaled_dot_product_attention', sdpa_2_0)
+    assert torch.allclose(fused_attention(Q, K, V, mask=mask, scale=0.1), ref, atol=1e-5)
+    assert torch.allclose(chunked_attention(Q, K, V, mask=mask, scale=0.1), ref, atol=1e-5)
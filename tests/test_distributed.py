@@ -0,0 +1,34 @@
+import pytest
+
+import os
+import socket
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SMALL_MODEL = ['--n', '2', '--batch_size', '4', '--latent_size', '16', '--hidden_size', '32', '--num_heads', '2',
+    '--enc_blocks', '1', '--train_steps', '4', '--eval_every', '2', '--val_steps', '2', '--test_steps', '1']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize('task_args', [
+    ['--task', 'stat/DV', '--dataset', 'gmm', '--set_size', '10', '20'],
+    ['--task', 'stat/DV', '--dataset', 'gmm', '--set_size', '10', '20', '--split_inputs', '--decoder_self_attn'],
+    ['--task', 'stat/DV-MI', '--dataset', 'corr', '--set_size', '10', '20', '--normalize', 'none', '--estimate_size', '-1'],
+    ['--task', 'stat/DV-MI', '--dataset', 'corr', '--set_size', '64', '80', '--normalize', 'none', '--sample_marg', '--split_inputs'],
+])
+def test_dv_trainers_under_ddp(tmp_path, task_args):
+    # two gloo processes on cpu, run to the end including the val and test evaluations
+    cmd = [sys.executable, 'main.py', 'ddp', '--basedir', str(tmp_path), '--logger', 'none', '--nprocs', '2',
+        '--master_port', str(free_port())] + SMALL_MODEL + task_args
+    result = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True, timeout=600,
+        env=dict(os.environ, CUDA_VISIBLE_DEVICES=''))
+    assert result.returncode == 0, result.stderr[-3000:]
+    task, dataset = task_args[1], task_args[3]
+    assert os.path.exists(os.path.join(tmp_path, task, dataset, 'ddp', 'out.pt'))
@@ -0,0 +1,45 @@
+import torch
+from torch.distributions import MultivariateNormal, MixtureSameFamily, Categorical
+
+from datasets.distributions import GaussianMixture, GaussianGenerator
+
+
+def random_mixture(bs=3, k=4, n=5):
+    logits = torch.randn(bs, k)
+    loc = torch.randn(bs, k, n)
+    A = torch.randn(bs, k, n, n)
+    scale_tril = torch.linalg.cholesky(A.matmul(A.transpose(-1, -2)) + torch.eye(n))
+    return logits, loc, scale_tril
+
+
+def test_transform_matches_selected_component():
+    torch.manual_seed(0)
+    logits, loc, scale_tril = random_mixture()
+    dist = GaussianMixture(logits, loc, scale_tril)
+    z, u = torch.randn(3, 50, 5), torch.rand(3, 50)
+    components = torch.searchsorted(dist.log_weights.exp().cumsum(-1), u).clamp(max=3)
+    ref = torch.stack([torch.stack([loc[b, c] + scale_tril[b, c].matmul(z[b, s]) for s, c in enumerate(components[b])]) 
+        for b in range(3)])
+    assert torch.allclose(dist.transform(z, u), ref.transpose(0, 1), atol=1e-5)
+
+
+def test_log_prob_and_moments_match_mixture_same_family():
+    torch.manual_seed(0)
+    logits, loc, scale_tril = random_mixture()
+    dist = GaussianMixture(logits, loc, scale_tril)
+    ref = MixtureSameFamily(Categorical(logits=logits), MultivariateNormal(loc, scale_tril=scale_tril))
+    x = ref.sample((20,))
+    assert torch.allclose(dist.log_prob(x), ref.log_prob(x), atol=1e-4)
+    samples = dist.sample((20000,))
+    assert samples.shape == (20000, 3, 5)
+    assert torch.allclose(samples.mean(0), ref.mean, atol=0.15)
+
+
+def test_normalize_ignores_padding():
+    torch.manual_seed(0)
+    generator = GaussianGenerator(num_outputs=2, normalize=True, mixture=False)
+    (X, Y), (X_lengths, Y_lengths) = generator(6, n=3, set_size=(5, 40), variable_size=True)
+    norms = torch.cat([X, Y], dim=1).norm(dim=-1)
+    valid = torch.cat([torch.arange(X.size(1))[None] < X_lengths[:, None], torch.arange(Y.size(1))[None] < Y_lengths[:, None]], dim=1)
+    avg_norm = (norms * valid).sum(dim=1) / valid.sum(dim=1)
+    assert torch.allclose(avg_norm, torch.ones(6), atol=1e-5)
@@ -0,0 +1,25 @@
+import torch
+import numpy as np
+
+from evalsets import generate_seeded
+
+
+def build():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.randn(4, device=device).cpu(), torch.rand(3), np.random.rand(2)
+
+
+def test_generate_seeded_is_reproducible():
+    a, b = generate_seeded(3, build), generate_seeded(3, build)
+    assert all(np.allclose(x, y) for x, y in zip(a, b))
+    assert not np.allclose(generate_seeded(4, build)[1], a[1])
+
+
+def test_generate_seeded_leaves_training_rng():
+    torch.manual_seed(0)
+    np.random.seed(0)
+    expected = build()
+    torch.manual_seed(0)
+    np.random.seed(0)
+    generate_seeded(3, build)
+    assert all(np.allclose(x, y) for x, y in zip(build(), expected))
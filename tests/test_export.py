@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from models.set import MultiSetTransformer
+from export import EXPORT_SUFFIXES, export_model, save_exported, load_exported, check_parity
+
+
+def small_mst(**kwargs):
+    torch.manual_seed(0)
+    return MultiSetTransformer(3, 16, 32, 1, num_heads=2, num_blocks=2, dropout=0, **kwargs).eval()
+
+
+@pytest.mark.parametrize('format', ['torchscript', 'export'])
+@pytest.mark.parametrize('model_kwargs', [
+    {},
+    {'attn_backend': 'chunked', 'fused': True, 'weight_sharing': 'sym'},
+    {'equi': True, 'attn_backend': 'sdpa', 'ln': True},
+])
+def test_exported_matches_eager(tmp_path, format, model_kwargs):
+    # traced at batch size 2 and set sizes (10, 12), checked at other batch, set and (equivariant) feature sizes
+    model = small_mst(**model_kwargs)
+    path = str(tmp_path / ("model" + EXPORT_SUFFIXES[format]))
+    save_exported(export_model(model, 3, format=format), path)
+    assert check_parity(model, load_exported(path), 3) < 1e-4
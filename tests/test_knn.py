@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from utils import knn, knn_ivf
+
+
+@pytest.mark.parametrize('exclude_self', [False, True])
+def test_ivf_probing_every_cell_is_exact(exclude_self):
+    torch.manual_seed(0)
+    X = torch.randn(3, 200, 5)
+    Y = X if exclude_self else torch.randn(3, 150, 5)
+    exact = knn(X, Y, 4, exclude_self=exclude_self)
+    approx = knn_ivf(X, Y, 4, exclude_self=exclude_self, n_cells=10, n_probe=10)
+    assert torch.allclose(approx, exact, atol=1e-4)
+
+
+@pytest.mark.parametrize('exclude_self', [False, True])
+def test_ivf_widens_probes_to_k_candidates(exclude_self):
+    # one point per cell, so a single probed cell never holds k candidates
+    torch.manual_seed(0)
+    X = torch.randn(2, 50, 3)
+    dists = knn_ivf(X, X, 5, exclude_self=exclude_self, n_cells=50, n_probe=1)
+    assert torch.isfinite(dists).all()
+    assert (dists.pow(2) >= knn(X, X, 5, exclude_self=exclude_self).pow(2) - 1e-4).all()
@@ -0,0 +1,36 @@
+import torch
+from torch.distributions import MultivariateNormal
+
+from utils import KLLabels
+
+
+class FakeEvent():
+    def __init__(self, done, ms=0):
+        self.done, self.ms = done, ms
+
+    def query(self):
+        return self.done
+
+    def elapsed_time(self, end):
+        return end.ms
+
+
+def gaussians(bs=3, n=2):
+    return MultivariateNormal(torch.zeros(bs, n), torch.eye(n)), MultivariateNormal(torch.ones(bs, n), torch.eye(n))
+
+
+def test_cost_averages_and_resets():
+    label_fct = KLLabels(mode='analytic')
+    for _ in range(3):
+        label_fct(*gaussians())
+    assert label_fct.calls == 3
+    assert label_fct.cost() > 0
+    assert label_fct.calls == 0 and label_fct.cost() == 0
+
+
+def test_cost_leaves_running_device_calls():
+    label_fct = KLLabels()
+    label_fct.events = [(FakeEvent(True), FakeEvent(True, 2.)), (FakeEvent(True), FakeEvent(True, 4.)),
+        (FakeEvent(True), FakeEvent(False, 8.))]
+    assert label_fct.cost() == 3.
+    assert len(label_fct.events) == 1
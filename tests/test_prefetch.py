@@ -0,0 +1,22 @@
+import torch
+from torch.distributions import MultivariateNormal, MixtureSameFamily, Categorical
+
+from datasets.distributions import PrefetchGenerator, GaussianGenerator, batch_to
+
+
+def test_batch_to_moves_distributions():
+    dist = MixtureSameFamily(Categorical(logits=torch.zeros(2, 3)), 
+        MultivariateNormal(torch.zeros(2, 3, 4), scale_tril=torch.eye(4).expand(2, 3, 4, 4)))
+    dist.log_prob(torch.zeros(5, 2, 4))     # populates lazily computed tensors
+    X, (moved,) = batch_to((torch.zeros(2, 5, 4), (dist,)), torch.device('meta'))
+    assert X.device.type == 'meta'
+    assert moved.mixture_distribution.logits.device.type == 'meta'
+    assert all(v.device.type == 'meta' for v in vars(moved.component_distribution).values() if torch.is_tensor(v))
+
+
+def test_prefetched_batches_on_device():
+    generator = PrefetchGenerator(GaussianGenerator(num_outputs=2, return_params=True), depth=2, mode='thread', 
+        device=torch.device('meta'))
+    (X, Y), dists = generator(4, n=3, set_size=(10, 12))
+    generator.close()
+    assert X.device.type == 'meta' and Y.device.type == 'meta'
@@ -0,0 +1,72 @@
+import torch
+
+from utils import Whitener, whiten_split
+
+
+def test_fresh_batches_not_served_from_cache():
+    # freed batches of the same shape often get the same address, which must not hit the previous batch's transform
+    torch.manual_seed(0)
+    for training in (True, False):
+        whitener = Whitener()
+        whitener.training = training
+        for _ in range(50):
+            X, Y = torch.randn(8, 30, 3) * 5 + 2, torch.randn(8, 40, 3)
+            for out, ref in zip(whitener(X, Y), whiten_split(X, Y)):
+                assert torch.allclose(out, ref, atol=1e-4)
+            del X, Y
+
+
+def test_reused_sets_are_cached():
+    torch.manual_seed(0)
+    whitener = Whitener()
+    whitener.training = False
+    X, Y = torch.randn(4, 20, 3), torch.randn(4, 25, 3)
+    whitener(X, Y)
+    assert len(whitener.cache) == 1
+    whitener(X, Y)
+    assert len(whitener.cache) == 1
+
+    # in-place updates change the key
+    X.mul_(3)
+    for out, ref in zip(whitener(X, Y), whiten_split(X, Y)):
+        assert torch.allclose(out, ref, atol=1e-4)
+    assert len(whitener.cache) == 2
+
+
+def test_no_cache_in_training_mode():
+    whitener = Whitener()
+    X, Y = torch.randn(4, 20, 3), torch.randn(4, 25, 3)
+    whitener(X, Y)
+    assert len(whitener.cache) == 0
+
+
+def build_kl_trainer(*extra):
+    import sys
+    from main import parse_args
+    from tasks import TASKS
+    argv = sys.argv
+    sys.argv = ['main.py', 'test', '--task', 'stat/KL', '--dataset', 'gmm', '--n', '2', '--batch_size', '4', 
+        '--set_size', '10', '20', '--latent_size', '16', '--hidden_size', '32', '--num_heads', '2', '--num_blocks', '1', 
+        '--eval_batch_size', '2'] + list(extra)
+    try:
+        args = parse_args()
+    finally:
+        sys.argv = argv
+    task = TASKS[args.task](args)
+    model = task.build_model().eval()
+    train_dataset, _, _ = task.build_dataset()
+    return task.build_trainer(model, None, None, train_dataset, None, None, torch.device('cpu'), None)
+
+
+def test_eval_sets_whitened_once():
+    # an evaluation walks more chunks than the Whitener cache holds, so the eval sets are stored whitened
+    torch.manual_seed(0)
+    trainer = build_kl_trainer()
+    loss = trainer.evaluate(6, trainer.train_dataset)['loss']
+    assert len(trainer.whitener.cache) == 0
+
+    reference = build_kl_trainer()
+    reference.model.load_state_dict(trainer.model.state_dict())
+    reference._eval_whiten_method = lambda normalize: None
+    assert abs(reference.evaluate(6, reference.train_dataset)['loss'] - loss) < 1e-4
+    assert len(reference.whitener.cache) > 0
@@ -3,38 +3,125 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from einops import rearrange
+import numpy as np
 
 import tqdm
 import os
+import math
+import bisect
+import collections
 
-import wandb
-
-from utils import whiten_split, batched_cov, batched_shuffle
+from metrics import MetricLogger, TensorBoardSink
+from checkpoint import CheckpointWriter
+from evalsets import EvalSetCache, generate_seeded
+from distributed import get_rank, get_world_size, unwrap_model, sync_gradients, all_reduce_mean
+from utils import Whitener, whiten_split, batched_cov, batched_shuffle, normalize_sets, poisson_loss, length_mask, generate_masks
 
 SS_SCHEDULE_15=[{'set_size':(1,5), 'steps':20000}, {'set_size':(3,10), 'steps':5000}, {'set_size':(8,15), 'steps':5000}]
 SS_SCHEDULE_30=[{'set_size':(1,5), 'steps':20000}, {'set_size':(3,10), 'steps':5000}, {'set_size':(8,15), 'steps':5000}, {'set_size':(10,30), 'steps':5000}]
 SS_SCHEDULE_50=[{'set_size':(1,5), 'steps':20000}, {'set_size':(3,10), 'steps':5000}, {'set_size':(8,15), 'steps':5000}, {'set_size':(10,30), 'steps':5000}, {'set_size':(25,50), 'steps':10000}]
 SS_SCHEDULE_75=[{'set_size':(1,5), 'steps':20000}, {'set_size':(3,10), 'steps':5000}, {'set_size':(8,15), 'steps':5000}, {'set_size':(10,30), 'steps':5000}, {'set_size':(25,50), 'steps':5000}, {'set_size':(50,75), 'steps':5000}]
-SS_SCHEDULES={15:SS_SCHEDULE_15, 30:SS_SCHEDULE_30, 75:SS_SCHEDULE_75}
+SS_SCHEDULES={15:SS_SCHEDULE_15, 30:SS_SCHEDULE_30, 50:SS_SCHEDULE_50, 75:SS_SCHEDULE_75}
 
 class SetSizeScheduler():
     def __init__(self, schedule, step_mult=1):
         self.schedule=schedule
-        self.N = sum([entry['steps'] for entry in schedule])
+        self.boundaries = []
+        step = 0
+        for entry in schedule:
+            step += entry['steps']
+            self.boundaries.append(step)
+        self.N = step
         self.step_mult=step_mult
 
+    def get_stage(self, iter_id):
+        if iter_id < 0:     #return last stage for iter_id -1
+            return len(self.schedule) - 1
+        return min(bisect.bisect_right(self.boundaries, self.step_mult * iter_id), len(self.schedule) - 1)
+
     def get_set_size(self, iter_id):
-        if iter_id >= 0:    #return last set size for iter_id -1
-            step=0
-            for entry in self.schedule:
-                step += entry['steps']
-                if self.step_mult * iter_id < step:
-                    return entry['set_size']
-        return self.schedule[-1]['set_size']    #fallback for now
+        return self.schedule[self.get_stage(iter_id)]['set_size']
+
+class SetSizeBucketSampler():
+    '''
+    Pre-plans the set size range and batch size of every step of a set size schedule. Each stage's range is split into
+    num_buckets narrower ranges, each step draws one bucket (weighted by width, so the marginal distribution over set sizes
+    is unchanged), and the batch size of a bucket is chosen so that batch_size * max_set_size stays at the token budget of
+    the configured batch size on the largest sets of the schedule.
+    '''
+    def __init__(self, schedule, batch_size, num_buckets=4, step_mult=1, seed=0):
+        self.scheduler = SetSizeScheduler(schedule, step_mult=step_mult)
+        self.token_budget = batch_size * max(entry['set_size'][1] - 1 for entry in schedule)
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self.buckets, self.weights = [], []
+        for entry in schedule:
+            lo, hi = entry['set_size']
+            bounds = sorted(set(torch.linspace(lo, hi, num_buckets + 1).round().long().tolist()))
+            buckets = [(bounds[j], bounds[j+1]) for j in range(len(bounds)-1)]
+            self.buckets.append([(bucket, max(1, self.token_budget // (bucket[1] - 1))) for bucket in buckets])
+            self.weights.append(torch.tensor([float(b - a) for a, b in buckets]))
+
+        self.plan = torch.cat([
+            torch.multinomial(weights, entry['steps'], replacement=True, generator=self.generator)
+            for entry, weights in zip(schedule, self.weights)
+        ])
+
+    def get_batch_args(self, iter_id):
+        # returns (set_size, batch_size) for step iter_id
+        stage = self.scheduler.get_stage(iter_id)
+        step = self.scheduler.step_mult * iter_id
+        if 0 <= step < self.scheduler.N:
+            bucket = self.plan[step].item()
+        else:
+            bucket = torch.multinomial(self.weights[stage], 1, generator=self.generator).item()
+        return self.buckets[stage][bucket]
+
+class TokenBudgetPlanner():
+    '''
+    Picks the batch size of each step from an element budget, batch_size * (N+M) <= token_budget. Given a memory budget
+    (bytes, CUDA only), it also fits peak memory ~ c0 + c1*B*(N+M) + c2*B*N*M to the peaks observed on recent steps and
+    keeps the predicted peak of each step under the budget.
+    '''
+    def __init__(self, token_budget, max_memory=-1, window=100, min_observations=5):
+        self.token_budget = token_budget
+        self.max_memory = max_memory
+        self.min_observations = min_observations
+        self.observations = collections.deque(maxlen=window)
+        self.coefs = None
+
+    @staticmethod
+    def _features(batch_size, n, m):
+        return [1., batch_size * (n + m), batch_size * n * m]
+
+    def get_batch_size(self, n, m):
+        batch_size = max(1, self.token_budget // (n + m))
+        if self.max_memory > 0 and self.coefs is not None:
+            c0, c1, c2 = self.coefs
+            per_example = c1 * (n + m) + c2 * n * m
+            if per_example > 0:
+                batch_size = min(batch_size, max(1, int((self.max_memory - c0) / per_example)))
+        return batch_size
+
+    def observe(self, batch_size, n, m, peak_memory):
+        self.observations.append((self._features(batch_size, n, m), peak_memory))
+        if len(self.observations) >= self.min_observations:
+            A = torch.tensor([x for x, _ in self.observations], dtype=torch.float64)
+            b = torch.tensor([y for _, y in self.observations], dtype=torch.float64)
+            self.coefs = torch.linalg.lstsq(A, b.unsqueeze(-1)).solution.squeeze(-1).clamp(min=0).tolist()
 
 class Trainer():
+    find_unused_parameters = False
+
     def __init__(self, model, optimizer, train_dataset, val_dataset, test_dataset, train_args, eval_args, device, logger=None,
             eval_every=500, save_every=2000, criterion=nn.BCEWithLogitsLoss(), scheduler=None, checkpoint_dir=None, ss_schedule=-1):
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        if self.world_size > 1:
+            # train_args['batch_size'] is the global batch size, which is split over the ranks. eval batches are not split,
+            # the eval steps are
+            assert train_args['batch_size'] % self.world_size == 0
+            train_args = dict(train_args, batch_size=train_args['batch_size'] // self.world_size)
         self.model = model
         self.optimizer = optimizer
         self.train_dataset = train_dataset
@@ -44,115 +131,200 @@ class Trainer():
         self.eval_args = eval_args
         self.device = device
         self.logger = logger
+        if not isinstance(logger, MetricLogger):
+            self.logger = MetricLogger([TensorBoardSink(logger)] if logger is not None else [], flush_every=train_args.get('log_every', 50))
         self.eval_every = eval_every
         self.save_every = save_every
         self.criterion = criterion
         self.scheduler = scheduler
         self.checkpoint_dir = checkpoint_dir
+        self.checkpointer = CheckpointWriter(checkpoint_dir, keep=train_args.get('keep_checkpoints', 3), main_process=self.rank == 0) \
+            if checkpoint_dir is not None else None
         self.ss_schedule = SetSizeScheduler(SS_SCHEDULES[ss_schedule]) if ss_schedule > 0 else None
+        ss_buckets = train_args.get('ss_buckets', 0)
+        self.ss_sampler = SetSizeBucketSampler(SS_SCHEDULES[ss_schedule], train_args['batch_size'], num_buckets=ss_buckets) \
+            if ss_schedule > 0 and ss_buckets > 0 else None
+        self.batch_size = train_args['batch_size']
+        token_budget = train_args.get('token_budget', -1)
+        if token_budget > 0 and self.world_size > 1:
+            # the ranks would plan different batch sizes and step the optimizer at different times
+            raise NotImplementedError("Token budgets are not supported with distributed training.")
+        self.batch_planner = TokenBudgetPlanner(token_budget, max_memory=int(train_args.get('max_memory', -1) * 2**30)) \
+            if token_budget > 0 else None
+        self.last_plan = None
+        self.accum_examples = 0
+        whiten_momentum = train_args.get('whiten_momentum', -1)
+        self.whitener = Whitener(method=train_args.get('whiten_method', 'zca'), momentum=whiten_momentum if whiten_momentum > 0 else None)
+        self.eval_cache = EvalSetCache(eval_args.get('eval_cache_dir', None))
+        self.whitener.training = False
 
     def save_checkpoint(self, step, metrics):
-        save_dict = {
-            'model': self.model.state_dict(),
+        shards = {
+            'model': unwrap_model(self.model).state_dict(),
             'optimizer': self.optimizer.state_dict(), 
-            'scheduler': self.scheduler, 
-            'step': step, 
-            'metrics': metrics
+            'state': {
+                'step': step,
+                'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None
+            }
         }
-        checkpoint_path = os.path.join(self.checkpoint_dir, "checkpoint.pt")
-        torch.save(save_dict, checkpoint_path)
+        self.checkpointer.save(step, shards, metrics)
 
     def load_checkpoint(self):
-        checkpoint_path = os.path.join(self.checkpoint_dir, "checkpoint.pt")
-        load_dict = torch.load(checkpoint_path)
-        self.model.load_state_dict(load_dict['model'])
-        self.optimizer.load_state_dict(load_dict['optimizer'])
-        if self.scheduler is not None:
-            self.scheduler.load_state_dict(load_dict['scheduler'])
-        step, metrics = load_dict['step'], load_dict['metrics']
-        return step, metrics
+        shards, metrics = self.checkpointer.load(map_location=self.device)
+        unwrap_model(self.model).load_state_dict(shards['model'])
+        self.optimizer.load_state_dict(shards['optimizer'])
+        if self.scheduler is not None and shards['state']['scheduler'] is not None:
+            self.scheduler.load_state_dict(shards['state']['scheduler'])
+        return shards['state']['step'], metrics
     
-    def train(self, train_steps, val_steps, test_steps):
-        all_metrics={
-            'train/loss': [],
-        }
+    def update_set_size(self, i):
+        # sets the set size (and, with bucketing, the batch size) of step i. the data kwargs dicts are replaced rather
+        # than mutated since some tasks share them between train_args and eval_args
+        if self.ss_schedule is None:
+            return
+        set_size = self.ss_schedule.get_set_size(i)
+        batch_size = self.batch_size
+        if self.ss_sampler is not None:
+            set_size, batch_size = self.ss_sampler.get_batch_args(i)
+        key = 'data_kwargs' if 'data_kwargs' in self.train_args else 'sample_kwargs'
+        self.train_args[key] = dict(self.train_args[key], set_size=set_size)
+        self.train_args['batch_size'] = batch_size
+        self.eval_args[key] = dict(self.eval_args[key], set_size=self.ss_schedule.get_set_size(i))
+
+    def _plan_batch(self, args, kwargs):
+        # under a token budget, fixes the set size of this step so the batch size can be picked from it
+        if self.batch_planner is None:
+            return args['batch_size'], kwargs
+        n = torch.randint(*kwargs['set_size'], (1,)).item()
+        self.last_plan = (self.batch_planner.get_batch_size(n, n), n, n)
+        return self.last_plan[0], dict(kwargs, set_size=(n, n+1))
+
+    def _accumulate(self, loss, batch_size, i, steps, clip=-1):
+        # backward + optimizer step every grad_steps steps. with dynamic batch sizes, losses are weighted by their number
+        # of examples and the optimizer steps once batch_size * grad_steps examples have been seen, with the gradient
+        # rescaled to match grad_steps full batches
+        args = self.train_args
+        if self.batch_planner is None:
+            step = (i+1) % args['grad_steps'] == 0 or i == (steps - 1)
+            with sync_gradients(self.model, step):
+                loss.backward()
+            if clip > 0:
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), clip)
+        else:
+            (loss * batch_size / self.batch_size).backward()
+            self.accum_examples += batch_size
+            target = self.batch_size * args['grad_steps']
+            step = self.accum_examples >= target or i == (steps - 1)
+            if step:
+                for p in self.model.parameters():
+                    if p.grad is not None:
+                        p.grad.mul_(target / self.accum_examples)
+                if clip > 0:
+                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), clip)
+                self.accum_examples = 0
+
+        if step:
+            self.optimizer.step()
+            if self.scheduler is not None:
+                self.scheduler.step()
+            self.optimizer.zero_grad()
+
+    def _train_step(self, i, steps, dataset):
+        track_memory = self.batch_planner is not None and self.batch_planner.max_memory > 0 and torch.device(self.device).type == 'cuda'
+        if track_memory:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.whitener.training = True
+        loss = self.train_step(i, steps, dataset)
+        self.whitener.training = False
+        if track_memory and self.last_plan is not None:
+            self.batch_planner.observe(*self.last_plan, torch.cuda.max_memory_allocated(self.device))
+        return loss
+
+    def _eval_data(self, steps, dataset, build_fct, **config):
+        # eval data (batches, labels, anything independent of the model) is generated by build_fct from a fixed seed,
+        # once per config, and reused by every evaluation and, with an eval_cache_dir, by later runs, so checkpoints are
+        # compared on identical data. the training rng state is left untouched
+        seed = self.eval_args.get('eval_seed', 0) + self.rank
+        config = dict(config, trainer=type(self).__name__, dataset=dataset, seed=seed, steps=steps)
+        with torch.no_grad():
+            return self.eval_cache.get(config, lambda: generate_seeded(seed, build_fct))
 
-        def _log(name, value, step=-1):
-            if name not in all_metrics:
-                all_metrics[name] = []
-            all_metrics[name].append(value)
-            if self.logger is not None and step >= 0:
-                self.logger.add_scalar(name, value, step)
-            wandb.log({name: value}, step)
+    def _eval_whiten_method(self, normalize):
+        # without running statistics each set is whitened by its own statistics, so eval sets are whitened once, along with
+        # the rest of the eval data, instead of at every evaluation
+        return self.whitener.method if normalize == 'whiten' and self.whitener.momentum is None else None
 
+    def _evaluate(self, steps, dataset):
+        # the eval steps are split over the ranks and the metrics, which are all averages over equally sized batches,
+        # are averaged back
+        return all_reduce_mean(self.evaluate(math.ceil(steps / self.world_size), dataset))
+
+    def train(self, train_steps, val_steps, test_steps):
         initial_step=0
 
-        if self.checkpoint_dir is not None:
-            if not os.path.exists(self.checkpoint_dir):
-                os.makedirs(self.checkpoint_dir)
-            else:
-                checkpoint_path = os.path.join(self.checkpoint_dir, "checkpoint.pt")
-                if os.path.exists(checkpoint_path):
-                    initial_step, metrics = self.load_checkpoint()
+        if self.checkpointer is not None and self.checkpointer.latest() is not None:
+            initial_step, metrics = self.load_checkpoint()
+            self.logger.history.update(metrics)
 
         avg_loss = 0
         loss_fct = nn.BCEWithLogitsLoss()
-        for i in tqdm.tqdm(range(initial_step, train_steps)):
-            if self.ss_schedule is not None:
-                set_size = self.ss_schedule.get_set_size(i)
-                self.train_args['data_kwargs']['set_size'] = set_size
-                self.eval_args['data_kwargs']['set_size'] = set_size
-
-            loss = self.train_step(i, train_steps, self.train_dataset)
+        for i in tqdm.tqdm(range(initial_step, train_steps), disable=self.rank > 0):
+            self.update_set_size(i)
+            loss = self._train_step(i, train_steps, self.train_dataset)
             
-            _log('train/loss', loss, i)
+            self.logger.log('train/loss', loss, i)
 
             if i > initial_step:
                 if self.eval_every > 0 and val_steps > 0 and self.val_dataset is not None and i % self.eval_every == 0:
-                    val_metrics = self.evaluate(val_steps, self.val_dataset)
-                    for k, v in val_metrics.items():
-                        key = "val/"+k
-                        _log(key, v, i)
+                    val_metrics = self._evaluate(val_steps, self.val_dataset)
+                    self.logger.log_scalars({"val/"+k: v for k, v in val_metrics.items()}, i)
 
-                if self.checkpoint_dir is not None and i % self.save_every == 0:
-                    self.save_checkpoint(i, all_metrics)
+                if self.checkpointer is not None and self.rank == 0 and i % self.save_every == 0:
+                    self.save_checkpoint(i, self.logger.snapshot())
             
 
         if self.test_dataset is not None:
-            test_metrics = evaluate(test_steps, self.test_dataset)
-            for k, v in test_metrics.items():
-                key = "test/"+k
-                _log(key, v, -1)
-
+            test_metrics = self._evaluate(test_steps, self.test_dataset)
+            self.logger.log_scalars({"test/"+k: v for k, v in test_metrics.items()}, -1)
 
-        return all_metrics
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+        return self.logger.close(train_steps - 1)
     
+    def _get_batch(self, dataset, args, **kwargs):
+        # with args['variable_size'] the generator pads each set to the largest size in the batch and also returns
+        # per-example lengths, which are turned into per-set element masks and the CSAB attention masks
+        batch_size, kwargs = self._plan_batch(args, kwargs)
+        if not args.get('variable_size', False):
+            return dataset(batch_size, **kwargs), None, None
+        *batch, lengths = dataset(batch_size, variable_size=True, **kwargs)
+        batch = batch if len(batch) > 1 else batch[0]
+        set_masks = tuple(length_mask(l).to(self.device) for l in lengths)
+        masks = generate_masks(*lengths, device=self.device) if len(lengths) == 2 else None
+        return batch, set_masks, masks
+
     def train_step(self, i, steps, dataset):
         args = self.train_args
-        (X,Y), target = dataset(args['batch_size'], **args['data_kwargs'])
+        ((X,Y), target), _, masks = self._get_batch(dataset, args, **args['data_kwargs'])
 
-        out = self.model(X.to(self.device),Y.to(self.device))
+        model_kwargs = {'masks': masks} if masks is not None else {}
+        out = self.model(X.to(self.device),Y.to(self.device), **model_kwargs)
         loss = self.criterion(out.squeeze(-1), target.to(self.device))
-        loss.backward()
-
-        if (i+1) % args['grad_steps'] == 0 or i == (steps - 1):
-            self.optimizer.step()
-            if self.scheduler is not None:
-                self.scheduler.step()
-            self.optimizer.zero_grad()
+        self._accumulate(loss, X.size(0), i, steps)
         
-        return loss.item()
+        return loss.detach()
 
     def evaluate(self, steps, dataset):
         args = self.eval_args
+        batches = self._eval_data(steps, dataset, lambda: [dataset(args['batch_size'], **args['data_kwargs']) for _ in range(steps)],
+            batch_size=args['batch_size'], data_kwargs=args['data_kwargs'])
         n_correct = 0
         with torch.no_grad():
-            for i in range(steps):
-                (X,Y), target = self.train_dataset(args['batch_size'], **args['data_kwargs'])
+            for (X,Y), target in batches:
                 out = self.model(X.to(self.device),Y.to(self.device)).squeeze(-1)
-                n_correct += torch.eq((out > 0), target.to(self.device)).sum().item()
+                n_correct += torch.eq((out > 0), target.to(self.device)).sum()
         
-        return {'acc': n_correct / (args['batch_size'] * steps)}
+        return {'acc': n_correct.item() / (args['batch_size'] * steps)}
 
 
 class CaptionTrainer(Trainer):
@@ -177,7 +349,7 @@ class CaptionTrainer(Trainer):
                 self.scheduler.step()
             self.optimizer.zero_grad()
         
-        return loss.item()
+        return loss.detach()
 
 
 class CountingTrainer(Trainer):
@@ -189,16 +361,18 @@ class CountingTrainer(Trainer):
         self.poisson=poisson
     
     def evaluate(self, steps, dataset):
+        args = self.eval_args
+        batches = self._eval_data(steps, dataset, lambda: [dataset(args['batch_size'], **args['data_kwargs']) for _ in range(steps)],
+            batch_size=args['batch_size'], data_kwargs=args['data_kwargs'])
         n_correct = 0
         with torch.no_grad():
-            for i in range(steps):
-                (X,Y), target = dataset(batch_size, **data_kwargs)
+            for (X,Y), target in batches:
                 out = self.model(X.to(self.device),Y.to(self.device)).squeeze(-1)
                 if self.poisson:
                     out = torch.exp(out)
                 target = target.to(self.device).int()
-                n_correct += torch.logical_or(torch.eq(out.ceil(), target), torch.eq(out.ceil()-1, target)).sum().item()
-        return {'acc':n_correct / (batch_size * steps)}
+                n_correct += torch.logical_or(torch.eq(out.ceil(), target), torch.eq(out.ceil()-1, target)).sum()
+        return {'acc':n_correct.item() / (args['batch_size'] * steps)}
 
 
 class MetaDatasetTrainer(Trainer):
@@ -213,65 +387,46 @@ class MetaDatasetTrainer(Trainer):
         self.episode_length = episode_length
     
     def train(self, train_steps, val_steps, test_steps):
-        metrics={
-            'train/loss': [],
-        }
-
-        def _log(name, value, step=-1):
-            if name not in all_metrics:
-                all_metrics[name] = []
-            all_metrics[name].append(value)
-            if self.logger is not None and step >= 0:
-                self.logger.add_scalar(name, value, step)
-
         initial_step=0
 
-        if self.checkpoint_dir is not None:
-            if not os.path.exists(checkpoint_dir):
-                os.makedirs(checkpoint_dir)
-            else:
-                initial_step, metrics = self.load_checkpoint()
+        if self.checkpointer is not None and self.checkpointer.latest() is not None:
+            initial_step, metrics = self.load_checkpoint()
+            self.logger.history.update(metrics)
 
         avg_loss = 0
         n_episodes = math.ceil((train_steps - initial_step) / self.episode_length)
         step = initial_step
-        for _ in tqdm.tqdm(range(n_episodes)):
+        for _ in tqdm.tqdm(range(n_episodes), disable=self.rank > 0):
             train_episode = self.train_dataset.get_episode(self.episode_classes, self.episode_datasets)
-            for i in range(episode_length):
-                if self.ss_schedule is not None:
-                    set_size = self.ss_schedule.get_set_size(step)
-                    self.train_args['data_kwargs']['set_size'] = set_size
-                    self.eval_args['data_kwargs']['set_size'] = set_size
-
-                loss = self.train_step(step, train_steps, train_episode)
+            for i in range(self.episode_length):
+                self.update_set_size(step)
+                loss = self._train_step(step, train_steps, train_episode)
                 
-                _log('train/loss', loss, step)
+                self.logger.log('train/loss', loss, step)
 
                 step += 1
 
                 if step > initial_step:
-                    if step % save_every == 0:
-                        self.save_checkpoint(step, metrics)
+                    if self.checkpointer is not None and self.rank == 0 and step % self.save_every == 0:
+                        self.save_checkpoint(step, self.logger.snapshot())
                     
                     if step >= train_steps:
                         break
             else:
                 val_episode = self.val_dataset.get_episode(self.episode_classes, self.episode_datasets)
-                val_metrics = self.evaluate(val_steps, val_episode)
-                for k, v in val_metrics.items():
-                    key = "val/"+k
-                    _log(key, v, step)
+                val_metrics = self._evaluate(val_steps, val_episode)
+                self.logger.log_scalars({"val/"+k: v for k, v in val_metrics.items()}, step)
                 continue
             break
              
         if self.test_dataset is not None:
             episode = self.test_dataset.get_episode(self.episode_classes, self.episode_datasets)
-            test_metrics = self.evaluate(val_steps, val_episode)
-            for k, v in test_metrics.items():
-                key = "test/"+k
-                _log(key, v, -1)
+            test_metrics = self._evaluate(val_steps, val_episode)
+            self.logger.log_scalars({"test/"+k: v for k, v in test_metrics.items()}, -1)
 
-        return metrics
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+        return self.logger.close(step)
 
     def evaluate(self, steps, dataset):
         args = self.eval_args
@@ -298,67 +453,83 @@ class StatisticalDistanceTrainer(Trainer):
     
     def train_step(self, i, steps, dataset):
         args = self.train_args
+        batch, set_masks, masks = self._get_batch(dataset, args, **args['sample_kwargs'])
         if self.exact_loss:
-            X, theta = dataset(args['batch_size'], **args['sample_kwargs'])
-            labels = self.label_fct(*theta, X=X[0], **args['label_kwargs']).squeeze(-1)
+            X, theta = batch
+            label_kwargs = args['label_kwargs'] if set_masks is None else dict(args['label_kwargs'], mask=set_masks[0])
+            labels = self.label_fct(*theta, X=X[0], **label_kwargs).squeeze(-1)
         else:
-            X = dataset(args['batch_size'], **args['sample_kwargs'])
+            X = batch
             if args['normalize'] == 'scale-linear':
-                X, avg_norm = normalize_sets(*X)
+                X, avg_norm = normalize_sets(*X, masks=set_masks)
             labels = self.label_fct(*X, **args['label_kwargs'])
         if args['normalize'] == 'scale-inv':
-            X, avg_norm = normalize_sets(*X)
+            X, avg_norm = normalize_sets(*X, masks=set_masks)
         elif args['normalize'] == 'whiten':
-            X = whiten_split(*X)
+            X = self.whitener(*X, masks=set_masks)
         
-        out = self.model(*X).squeeze(-1)
+        model_kwargs = {'masks': masks} if masks is not None else {}
+        out = self.model(*X, **model_kwargs).squeeze(-1)
 
         loss = self.criterion(out, labels)
-        loss.backward()
-
-        if (i+1) % args['grad_steps'] == 0 or i == (steps - 1):
-            self.optimizer.step()
-            if self.scheduler is not None:
-                self.scheduler.step()
-            self.optimizer.zero_grad()
+        self._accumulate(loss, out.size(0), i, steps)
+        if hasattr(self.label_fct, 'cost') and (i+1) % self.logger.flush_every == 0:
+            self.logger.log_scalars({'train/label_ms': self.label_fct.cost()}, i)
         
-        return loss.item()
+        return loss.detach()
 
-    def evaluate(self, steps, dataset):
+    def _eval_set(self, steps, dataset):
+        # besides the eval sets and their labels, the baseline losses don't depend on the model either, so they are
+        # computed once with them. sets are generated in chunks of eval_batch_size examples, covering at least steps batches
         args = self.eval_args
-        model_losses=[]
-        baseline_losses={baseline:[] for baseline in self.baselines.keys()}
-        with torch.no_grad():
-            for i in range(steps):
+        batch_size = args.get('eval_batch_size', args['batch_size'])
+        n_chunks = math.ceil(steps * args['batch_size'] / batch_size)
+        whiten_method = self._eval_whiten_method(args['normalize'])
+
+        def build():
+            chunks = []
+            baseline_losses = {baseline_name: 0 for baseline_name in self.baselines.keys()}
+            for _ in range(n_chunks):
                 if self.exact_loss:
-                    X, theta = dataset(args['batch_size'], **args['sample_kwargs'])
+                    X, theta = dataset(batch_size, **args['sample_kwargs'])
                     labels = self.label_fct(*theta, X=X[0], **args['label_kwargs']).squeeze(-1)
                 else:
-                    X = dataset(args['batch_size'], **args['sample_kwargs'])
+                    X = dataset(batch_size, **args['sample_kwargs'])
                     labels = self.label_fct(*X, **args['label_kwargs'])
-                
+
                 for baseline_name, baseline_fct in self.baselines.items():
                     baseline_out = baseline_fct(*X).squeeze(-1)
-                    baseline_loss = self.criterion(baseline_out, labels)
-                    baseline_losses[baseline_name].append(baseline_loss.item())
+                    baseline_losses[baseline_name] += self.criterion(baseline_out, labels)
 
                 if not self.exact_loss and args['normalize'] == 'scale-linear':
                     X, avg_norm = normalize_sets(*X)
                     labels = self.label_fct(*X, **args['label_kwargs'])
-
                 if args['normalize'] == 'scale-inv':
                     X, avg_norm = normalize_sets(*X)
-                elif args['normalize'] == 'whiten':
-                    X = whiten_split(*X)
-                
+                elif whiten_method is not None:
+                    X = whiten_split(*X, method=whiten_method)
+                chunks.append((X, labels))
+            baseline_metrics = {baseline_name + '/loss': (loss / n_chunks).item() for baseline_name, loss in baseline_losses.items()}
+            return chunks, baseline_metrics
+
+        return self._eval_data(n_chunks, dataset, build, batch_size=batch_size, sample_kwargs=args['sample_kwargs'], 
+            label_kwargs=args['label_kwargs'], normalize=args['normalize'], whiten_method=whiten_method, label_fct=self.label_fct, 
+            exact_loss=self.exact_loss, baselines=self.baselines, criterion=self.criterion)
+
+    def evaluate(self, steps, dataset):
+        args = self.eval_args
+        chunks, baseline_metrics = self._eval_set(steps, dataset)
+        whiten = args['normalize'] == 'whiten' and self._eval_whiten_method(args['normalize']) is None
+        model_loss = 0
+        with torch.no_grad():
+            for X, labels in chunks:
+                if whiten:
+                    X = self.whitener(*X)
                 out = self.model(*X).squeeze(-1)
-                loss = self.criterion(out, labels)
-                model_losses.append(loss.item())
+                model_loss += self.criterion(out, labels)
 
-        metrics = {'loss': sum(model_losses)/len(model_losses)}
-        for baseline_name, baseline_losses in baseline_losses.items():
-            key = baseline_name + '/loss'
-            metrics[key] = sum(baseline_losses)/len(baseline_losses)
+        metrics = {'loss': (model_loss / len(chunks)).item()}
+        metrics.update(baseline_metrics)
         return metrics
 
     def _forward(self, *X):
@@ -368,6 +539,9 @@ class StatisticalDistanceTrainer(Trainer):
 import math
 
 class DonskerVaradhanTrainer(Trainer):
+    # the decoder blocks build their self-attention even without decoder_self_attn
+    find_unused_parameters = True
+
     def __init__(self, model, optimizer, train_dataset, val_dataset, test_dataset, train_args, eval_args, device, criterion, label_fct, 
             logger=None, save_every=2000, eval_every=500, scheduler=None, checkpoint_dir=None, ss_schedule=-1, split_inputs=True, mode='kl'):
         super().__init__(model, optimizer, train_dataset, val_dataset, test_dataset, train_args, eval_args, device, logger=logger,
@@ -394,8 +568,8 @@ class DonskerVaradhanTrainer(Trainer):
         X0,X1 = X.chunk(2, dim=1)
         Y0,Y1 = Y.chunk(2, dim=1)
 
-        Z1 = self.model(X0, Y0)
-        Z2 = self.model(X0, Y1)
+        # one forward over both pairs, since DDP expects a single forward per backward
+        Z1, Z2 = self.model(torch.cat([X0, X0]), torch.cat([Y0, Y1])).chunk(2)
 
         return self._KL_estimate(Z1, Z2)
 
@@ -427,50 +601,53 @@ class DonskerVaradhanTrainer(Trainer):
     
     def train_step(self, i, steps, dataset):
         args = self.train_args
-        (X,Y), _ = dataset(args['batch_size'], **args['sample_kwargs'])
+        batch_size, sample_kwargs = self._plan_batch(args, args['sample_kwargs'])
+        (X,Y), _ = dataset(batch_size, **sample_kwargs)
         if args['normalize'] == 'whiten':
-            X,Y = whiten_split(X,Y)
+            X,Y = self.whitener(X,Y)
 
         X, Y = X.to(self.device),Y.to(self.device)
         
         d_out = self._forward(X,Y)
 
         loss = -1* d_out.mean()
-        loss.backward()
-
-        if args['clip'] > 0:
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), args['clip'])
-
-        if (i+1) % args['grad_steps'] == 0 or i == (steps - 1):
-            self.optimizer.step()
-            if self.scheduler is not None:
-                self.scheduler.step()
-            self.optimizer.zero_grad()
+        self._accumulate(loss, batch_size, i, steps, clip=args['clip'])
         
-        return loss.item()
+        return loss.detach()
 
     def _eval(self, steps, dataset, set_size):
         args = self.eval_args
         sample_kwargs = {k:v for k,v in args['sample_kwargs'].items() if k != "set_size"}
+        whiten_method = self._eval_whiten_method(args['normalize'])
+        def build():
+            batches = []
+            for i in range(steps):
+                (X,Y), theta = dataset(args['batch_size'], set_size=(set_size, set_size+1), **sample_kwargs)
+                d_true = self.label_fct(*theta, X=X, **args['label_kwargs']).squeeze(-1)
+                if whiten_method is not None:
+                    X, Y = whiten_split(X, Y, method=whiten_method)
+                batches.append((X, Y, d_true))
+            return batches
+        batches = self._eval_data(steps, dataset, build, batch_size=args['batch_size'], set_size=set_size, sample_kwargs=sample_kwargs,
+            label_kwargs=args['label_kwargs'], label_fct=self.label_fct, whiten_method=whiten_method)
+
         avg_loss = 0
         avg_diff = 0
         with torch.no_grad():
-            for i in range(steps):
-                (X,Y), theta = self.train_dataset(args['batch_size'], set_size=(set_size, set_size+1), **sample_kwargs)
-                d_true = self.label_fct(*theta, X=X, **args['label_kwargs']).squeeze(-1)
-                if args['normalize'] == 'whiten':
-                    X,Y = whiten_split(X,Y)
+            for X, Y, d_true in batches:
+                if args['normalize'] == 'whiten' and whiten_method is None:
+                    X,Y = self.whitener(X,Y)
                 
                 X, Y = X.to(self.device),Y.to(self.device)
                 
                 d_out = self._forward(X,Y)
 
                 avg_loss += self.criterion(d_out, d_true)
-                avg_diff += (d_out - d_true).mean().item()
+                avg_diff += (d_out - d_true).mean()
             avg_loss /= steps
             avg_diff /= steps
         
-        return avg_loss, avg_diff
+        return avg_loss, avg_diff.item()
         
 
     def evaluate(self, steps, dataset):
@@ -488,6 +665,8 @@ class DonskerVaradhanTrainer(Trainer):
 
 
 class DonskerVaradhanMITrainer(Trainer):
+    find_unused_parameters = True
+
     def __init__(self, model, optimizer, train_dataset, val_dataset, test_dataset, train_args, eval_args, device, criterion, label_fct, 
             x_marginal, y_marginal, logger=None, save_every=2000, eval_every=500, scheduler=None, checkpoint_dir=None, ss_schedule=-1,
             sample_marg=True, estimate_size=-1, scale='none', eps=1e-6, model_type='mst', split_inputs=True):
@@ -575,47 +754,53 @@ class DonskerVaradhanMITrainer(Trainer):
     
     def train_step(self, i, steps, dataset):
         args = self.train_args
-        (X,Y), _ = dataset(args['batch_size'], **args['sample_kwargs'])
+        batch_size, sample_kwargs = self._plan_batch(args, args['sample_kwargs'])
+        (X,Y), _ = dataset(batch_size, **sample_kwargs)
         if args['normalize'] == 'whiten':
-            X,Y = whiten_split(X,Y)
+            X,Y = self.whitener(X,Y)
 
         X, Y = X.to(self.device),Y.to(self.device)
         
         d_out = self._forward(X, Y)
 
         loss = -1* d_out.mean()
-        loss.backward()
-
-        if (i+1) % args['grad_steps'] == 0 or i == (steps - 1):
-            self.optimizer.step()
-            if self.scheduler is not None:
-                self.scheduler.step()
-            self.optimizer.zero_grad()
+        self._accumulate(loss, batch_size, i, steps)
         
-        return loss.item()
+        return loss.detach()
 
     def _eval(self, steps, dataset, set_size):
         args = self.eval_args
         sample_kwargs = {k:v for k,v in args['sample_kwargs'].items() if k != "set_size"}
-        avg_loss = 0
-        avg_diff = 0
-        with torch.no_grad():
+        whiten_method = self._eval_whiten_method(args['normalize'])
+        def build():
+            batches = []
             for i in range(steps):
                 (X,Y), theta = dataset(args['batch_size'], set_size=(set_size, set_size+1), **sample_kwargs)
                 d_true = self.label_fct(*theta, X=(X,Y), **args['label_kwargs']).squeeze(-1)
-                if args['normalize'] == 'whiten':
-                    X,Y = whiten_split(X,Y)
+                if whiten_method is not None:
+                    X, Y = whiten_split(X, Y, method=whiten_method)
+                batches.append((X, Y, d_true))
+            return batches
+        batches = self._eval_data(steps, dataset, build, batch_size=args['batch_size'], set_size=set_size, sample_kwargs=sample_kwargs,
+            label_kwargs=args['label_kwargs'], label_fct=self.label_fct, whiten_method=whiten_method)
+
+        avg_loss = 0
+        avg_diff = 0
+        with torch.no_grad():
+            for X, Y, d_true in batches:
+                if args['normalize'] == 'whiten' and whiten_method is None:
+                    X,Y = self.whitener(X,Y)
                 
                 X, Y = X.to(self.device),Y.to(self.device)
                 
                 d_out = self._forward(X,Y)
 
                 avg_loss += self.criterion(d_out, d_true)
-                avg_diff += (d_out - d_true).mean().item()
+                avg_diff += (d_out - d_true).mean()
             avg_loss /= steps
             avg_diff /= steps
         
-        return avg_loss, avg_diff
+        return avg_loss, avg_diff.item()
         
 
     def evaluate(self, steps, dataset):
@@ -717,7 +902,7 @@ class DonskerVaradhanTrainer2(Trainer):
         args = self.train_args
         (X,Y), _ = dataset(args['batch_size'], **args['sample_kwargs'])
         if args['normalize'] == 'whiten':
-            X,Y = whiten_split(X,Y)
+            X,Y = self.whitener(X,Y)
 
         X, Y = X.to(self.device),Y.to(self.device)
         
@@ -735,7 +920,7 @@ class DonskerVaradhanTrainer2(Trainer):
                 self.scheduler.step()
             self.optimizer.zero_grad()
         
-        return loss.item()
+        return loss.detach()
 
     def _eval(self, steps, dataset, set_size):
         args = self.eval_args
@@ -747,7 +932,7 @@ class DonskerVaradhanTrainer2(Trainer):
                 (X,Y), theta = self.train_dataset(args['batch_size'], set_size=(set_size, set_size+1), **sample_kwargs)
                 d_true = self.label_fct(*theta, X=X, **args['label_kwargs']).squeeze(-1)
                 if args['normalize'] == 'whiten':
-                    X,Y = whiten_split(X,Y)
+                    X,Y = self.whitener(X,Y)
                 
                 X, Y = X.to(self.device),Y.to(self.device)
                 
@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import time
+import collections
+from torch.distributions import MultivariateNormal
 
 use_cuda=torch.cuda.is_available()
 
@@ -34,13 +37,19 @@ def masked_softmax(x, mask, dim=-1, eps=1e-8):
     x_masked[mask == 0] = -float("inf")
     return torch.exp(x_masked) / (torch.exp(x_masked).sum(dim=dim, keepdim=True) + eps)
 
-def generate_masks(X_lengths, Y_lengths):
-    X_max, Y_max = max(X_lengths), max(Y_lengths)
+def length_mask(lengths, max_len=None):
+    # bs -> bs x max_len boolean mask of valid elements
+    max_len = max_len if max_len is not None else lengths.max().item()
+    return torch.arange(max_len, device=lengths.device)[None, :] < lengths[:, None]
 
-    X_mask = torch.arange(X_max)[None, :] < X_lengths[:, None]
-    Y_mask = torch.arange(Y_max)[None, :] < Y_lengths[:, None]
+def generate_masks(X_lengths, Y_lengths, device=None):
+    X_mask = length_mask(X_lengths)
+    Y_mask = length_mask(Y_lengths)
 
-    if use_cuda:
+    if device is not None:
+        X_mask = X_mask.to(device)
+        Y_mask = Y_mask.to(device)
+    elif use_cuda:
         X_mask = X_mask.cuda()
         Y_mask = Y_mask.cuda()
 
@@ -68,62 +77,395 @@ def linear_block(input_size, hidden_size, output_size, num_layers, activation_fc
     return nn.Sequential(*layers)
 
 
-def whiten(X):
-    mu = X.mean(dim=1, keepdim=True)
-    Sigma2 = (X-mu).transpose(1,2).matmul((X-mu)) / (X.size(1)-1)
-    evals, evecs = torch.linalg.eig(Sigma2)
-    lambd = (evecs.matmul(torch.diag_embed(evals.pow(-1./2))).matmul(evecs.transpose(1,2))).real
-    return (X-mu).matmul(lambd.transpose(1,2))
+def set_stats(X, mask=None):
+    # per-set mean (bs x 1 x d) and covariance (bs x d x d); mask: bs x N, nonzero for valid elements
+    if mask is not None:
+        mask = mask.unsqueeze(-1).to(X.dtype)
+        n = mask.sum(dim=1, keepdim=True)
+        mu = (X * mask).sum(dim=1, keepdim=True) / n
+        Xc = (X - mu) * mask
+    else:
+        n = X.size(1)
+        mu = X.mean(dim=1, keepdim=True)
+        Xc = X - mu
+    return mu, Xc.transpose(1,2).matmul(Xc) / (n-1)
+
+def whitening_matrix(cov, method='zca', eps=1e-8):
+    # W with W cov W^T = I for symmetric cov: zca is the symmetric cov^-1/2 (eigh), cholesky is L^-1 for cov = L L^T
+    if method == 'zca':
+        evals, evecs = torch.linalg.eigh(cov)
+        return (evecs * evals.clamp(min=eps).rsqrt().unsqueeze(-2)).matmul(evecs.transpose(-1,-2))
+    elif method == 'cholesky':
+        eye = torch.eye(cov.size(-1), dtype=cov.dtype, device=cov.device)
+        L = torch.linalg.cholesky(cov + eps * eye)
+        return torch.linalg.solve_triangular(L, eye.expand_as(L), upper=False)
+    else:
+        raise NotImplementedError("zca or cholesky")
 
-def whiten_split(X,Y):
+def whiten(X, mask=None, method='zca', eps=1e-8):
+    # padded elements (mask == 0) are excluded from the statistics and returned as zeros
+    mu, cov = set_stats(X, mask=mask)
+    Xc = X - mu
+    if mask is not None:
+        Xc = Xc * mask.unsqueeze(-1).to(X.dtype)
+    return Xc.matmul(whitening_matrix(cov, method=method, eps=eps).transpose(1,2))
+
+def whiten_split(X, Y, masks=None, method='zca'):
     n = X.size(1)
     D = torch.cat([X,Y],dim=1)
-    Dp = whiten(D)
+    mask = torch.cat(masks, dim=1) if masks is not None else None
+    Dp = whiten(D, mask=mask, method=method)
     return Dp[:, :n], Dp[:, n:]
 
-def normalize_sets(*X):
-    avg_norm = torch.cat(X, dim=1).norm(dim=-1,keepdim=True).mean(dim=1,keepdim=True)
+class Whitener():
+    '''
+    Stateful whiten_split. Outside training mode, caches the transform of the last cache_size inputs (keyed on tensor
+    identity), so sets that are reused, e.g. across estimate chunks, are only decomposed once. The trainers' cached eval
+    sets are whitened when they are generated instead, since an evaluation walks more chunks than the cache holds.
+    The cache holds on to the inputs themselves, so their memory can't be reused by other tensors while they are keyed.
+    Training batches are fresh every step and never cached. With momentum, sets are whitened with running statistics
+    pooled over all sets seen in training mode instead of each set's own.
+    '''
+    def __init__(self, method='zca', eps=1e-8, momentum=None, cache_size=4):
+        self.method = method
+        self.eps = eps
+        self.momentum = momentum
+        self.training = True
+        self.running_mean, self.running_cov = None, None
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    @staticmethod
+    def _key(*X):
+        return tuple((x.data_ptr(), x.size(), x.stride(), x._version) for x in X)
+
+    def _lookup(self, key, inputs):
+        entry = self.cache.get(key, None)
+        if entry is None or len(entry[0]) != len(inputs) or any(a is not b for a, b in zip(entry[0], inputs)):
+            return None
+        self.cache.move_to_end(key)
+        return entry[1:]
+
+    def _transform(self, D, mask):
+        if self.momentum is None:
+            mu, cov = set_stats(D, mask=mask)
+            return mu, whitening_matrix(cov, method=self.method, eps=self.eps)
+        if self.training or self.running_mean is None:
+            mu, cov = set_stats(D, mask=mask)
+            mu, cov = mu.mean(dim=0, keepdim=True), cov.mean(dim=0, keepdim=True)
+            if self.running_mean is None or self.running_mean.size(-1) != mu.size(-1):
+                self.running_mean, self.running_cov = mu, cov
+            else:
+                self.running_mean = (1 - self.momentum) * self.running_mean + self.momentum * mu
+                self.running_cov = (1 - self.momentum) * self.running_cov + self.momentum * cov
+        return self.running_mean, whitening_matrix(self.running_cov, method=self.method, eps=self.eps)
+
+    def __call__(self, X, Y, masks=None):
+        inputs = (X, Y, *(masks if masks is not None else ()))
+        key = self._key(*inputs)
+        n = X.size(1)
+        D = torch.cat([X,Y],dim=1)
+        mask = torch.cat(masks, dim=1) if masks is not None else None
+        use_cache = not self.training and self.momentum is None and self.cache_size > 0
+        cached = self._lookup(key, inputs) if use_cache else None
+        if cached is not None:
+            mu, W = cached
+        else:
+            mu, W = self._transform(D, mask)
+            if use_cache:
+                self.cache[key] = (inputs, mu, W)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        Dp = (D - mu)
+        if mask is not None:
+            Dp = Dp * mask.unsqueeze(-1).to(D.dtype)
+        Dp = Dp.matmul(W.transpose(-1,-2))
+        return Dp[:, :n], Dp[:, n:]
+
+def normalize_sets(*X, masks=None):
+    norms = torch.cat(X, dim=1).norm(dim=-1,keepdim=True)
+    if masks is not None:
+        mask = torch.cat(masks, dim=1).unsqueeze(-1).to(norms.dtype)
+        avg_norm = (norms * mask).sum(dim=1,keepdim=True) / mask.sum(dim=1,keepdim=True)
+    else:
+        avg_norm = norms.mean(dim=1,keepdim=True)
     return [x / avg_norm for x in X], avg_norm
 
 
 # distance functions
 
-def knn_dist(X, k, Y=None, bs=32):
+def tile_sizes(bs, N, M, element_size=4, device=None, max_bytes=None):
+    # (query rows, candidate columns) per tile so that one bs x rows x cols distance tile fits in max_bytes; defaults to
+    # a quarter of the free memory on cuda and 64MB on cpu
+    if max_bytes is None:
+        if device is not None and torch.device(device).type == 'cuda':
+            max_bytes = torch.cuda.mem_get_info(device)[0] // 4
+        else:
+            max_bytes = 2**26
+    max_elements = max(1, max_bytes // element_size // bs)
+    tile_cols = min(M, max(1, max_elements // min(N, 64)))
+    tile_rows = min(N, max(1, max_elements // tile_cols))
+    return tile_rows, tile_cols
+
+def sq_dists(X, Y, X_sq=None, Y_sq=None):
+    # squared euclidean distances bs x N x M as |x|^2 + |y|^2 - 2 x^T y, so the work is one batched matmul
+    X_sq = X.pow(2).sum(dim=-1) if X_sq is None else X_sq
+    Y_sq = Y.pow(2).sum(dim=-1) if Y_sq is None else Y_sq
+    return torch.baddbmm(X_sq.unsqueeze(-1) + Y_sq.unsqueeze(-2), X, Y.transpose(1,2), alpha=-2).clamp_(min=0)
+
+def _exclude_self(dists, i, j):
+    # masks the diagonal of the (i, j) tile of a distance matrix of a set with itself
+    rows = torch.arange(i, i + dists.size(1), device=dists.device)
+    cols = torch.arange(j, j + dists.size(2), device=dists.device)
+    return dists.masked_fill_((rows.unsqueeze(-1) == cols.unsqueeze(0)).unsqueeze(0), float('inf'))
+
+def knn(X, Y, k, exclude_self=False, tiles=None):
+    # ascending distances bs x N x k from each point of X to its k nearest neighbours in Y, streaming a running top-k over
+    # tiles of queries and candidates instead of building the full distance matrix. with exclude_self (Y is X), a point
+    # is not its own neighbour
+    bs, N, _ = X.size()
+    M = Y.size(1)
+    tile_rows, tile_cols = tiles if tiles is not None else tile_sizes(bs, N, M, X.element_size(), X.device)
+    X_sq, Y_sq = X.pow(2).sum(dim=-1), Y.pow(2).sum(dim=-1)
+    out = X.new_empty(bs, N, k)
+    for i in range(0, N, tile_rows):
+        best = None
+        for j in range(0, M, tile_cols):
+            dists = sq_dists(X[:,i:i+tile_rows], Y[:,j:j+tile_cols], X_sq[:,i:i+tile_rows], Y_sq[:,j:j+tile_cols])
+            if exclude_self:
+                dists = _exclude_self(dists, i, j)
+            if best is not None:
+                dists = torch.cat([best, dists], dim=-1)
+            best = dists.topk(min(k, dists.size(-1)), dim=-1, largest=False)[0]
+        out[:,i:i+tile_rows] = best
+    return out.sqrt_()
+
+def knn_kdtree(X, Y, k, exclude_self=False, eps=0):
+    # k nearest neighbour distances with a scipy kd-tree per set (cpu); exact for eps=0, otherwise each returned
+    # neighbour is within a factor (1+eps) of the true one. subquadratic in low dimension
+    from scipy.spatial import cKDTree
+    out = []
+    for x, y in zip(X.detach().cpu().numpy(), Y.detach().cpu().numpy()):
+        dists, _ = cKDTree(y).query(x, k=k+1 if exclude_self else k, eps=eps, workers=-1)
+        dists = dists.reshape(x.shape[0], -1)
+        out.append(torch.from_numpy(dists[:, 1:] if exclude_self else dists))
+    return torch.stack(out, dim=0).to(X.dtype).to(X.device)
+
+def _kmeans(Y, n_cells, n_iters=10):
+    # k-means of each set of Y (bs x M x d): centroids bs x n_cells x d and the cell of each point bs x M
+    bs, M, d = Y.size()
+    init = torch.rand(bs, M, device=Y.device).argsort(dim=-1)[:, :n_cells]
+    centroids = Y.gather(1, init.unsqueeze(-1).expand(-1, -1, d))
+    for _ in range(n_iters):
+        assign = sq_dists(Y, centroids).argmin(dim=-1)
+        counts = torch.zeros(bs, n_cells, dtype=Y.dtype, device=Y.device).scatter_add_(1, assign, torch.ones_like(Y[:,:,0]))
+        sums = torch.zeros_like(centroids).scatter_add_(1, assign.unsqueeze(-1).expand(-1, -1, d), Y)
+        centroids = torch.where(counts.unsqueeze(-1) > 0, sums / counts.clamp(min=1).unsqueeze(-1), centroids)
+    return centroids, sq_dists(Y, centroids).argmin(dim=-1)
+
+def _inverted_lists(lists, n_lists, pad):
+    # groups the entries j of each row by lists[:, j]: a bs x n_lists x L table of entry indices, padded with pad, and the
+    # number of entries of each list
+    bs, n = lists.size()
+    counts = torch.zeros(bs, n_lists, dtype=torch.long, device=lists.device).scatter_add_(1, lists, torch.ones_like(lists))
+    order = lists.argsort(dim=-1)
+    sorted_lists = lists.gather(1, order)
+    slots = torch.arange(n, device=lists.device) - (counts.cumsum(dim=-1) - counts).gather(1, sorted_lists)
+    L = counts.max().item()
+    table = torch.full((bs, n_lists * L), pad, dtype=torch.long, device=lists.device)
+    return table.scatter_(1, sorted_lists * L + slots, order).view(bs, n_lists, L), counts
+
+def knn_ivf(X, Y, k, exclude_self=False, n_cells=None, n_probe=8, n_iters=10):
+    # approximate k nearest neighbour distances with an inverted file index per set: candidates are clustered into
+    # n_cells (default sqrt(M)) k-means cells and each query only searches the n_probe cells with the closest centroids,
+    # or more when those hold fewer than k candidates. one GEMM per cell against the queries probing it, for all sets at
+    # once by padding the cells and query lists. only pays off on large sets, where a query searches a small part of them
+    bs, N, d = X.size()
+    M = Y.size(1)
+    C = min(M, n_cells if n_cells is not None else max(1, int(math.sqrt(M))))
+    centroids, assign = _kmeans(Y, C, n_iters=n_iters)
+    cells, cell_sizes = _inverted_lists(assign, C, M)
+
+    centroid_dists = sq_dists(X, centroids)
+    P = min(n_probe, C)
+    while True:
+        probes = centroid_dists.topk(P, dim=-1, largest=False)[1]
+        found = cell_sizes.gather(1, probes.flatten(1)).view(bs, N, P).sum(dim=-1)
+        if P == C or found.min().item() >= k + int(exclude_self):
+            break
+        P = min(C, 2 * P)
+    queries, query_counts = _inverted_lists(probes.flatten(1), C, N * P)
+    queries = queries // P
+
+    # padded queries index a row of best that is dropped, padded candidates a point at infinite distance
+    X_pad = torch.cat([X, X.new_zeros(bs, 1, d)], dim=1)
+    Y_pad = torch.cat([Y, Y.new_zeros(bs, 1, d)], dim=1)
+    X_sq = torch.cat([X.pow(2).sum(dim=-1), X.new_zeros(bs, 1)], dim=1)
+    Y_sq = torch.cat([Y.pow(2).sum(dim=-1), Y.new_full((bs, 1), float('inf'))], dim=1)
+    best = X.new_full((bs, N + 1, k), float('inf'))
+    for c, (n_queries, n_cands) in enumerate(zip(query_counts.max(dim=0)[0].tolist(), cell_sizes.max(dim=0)[0].tolist())):
+        if n_queries == 0 or n_cands == 0:
+            continue
+        q, cand = queries[:, c, :n_queries], cells[:, c, :n_cands]
+        dists = sq_dists(X_pad.gather(1, q.unsqueeze(-1).expand(-1, -1, d)), Y_pad.gather(1, cand.unsqueeze(-1).expand(-1, -1, d)),
+            X_sq.gather(1, q), Y_sq.gather(1, cand))
+        if exclude_self:
+            dists.masked_fill_(q.unsqueeze(-1) == cand.unsqueeze(1), float('inf'))
+        index = q.unsqueeze(-1).expand(-1, -1, k)
+        dists = torch.cat([best.gather(1, index), dists], dim=-1)
+        best.scatter_(1, index, dists.topk(k, dim=-1, largest=False)[0])
+    return best[:, :N].sqrt_()
+
+KNN_BACKENDS = ('exact', 'kdtree', 'ivf', 'approx')
+
+def knn_dist(X, k, Y=None, bs=None, backend='exact'):
+    # distance from each point of Y to its k-th nearest neighbour in X (excluding itself if Y is None); bs fixes the
+    # number of query rows per tile of the exact backend. approx picks kdtree for d <= 10 and ivf above
+    exclude_self = Y is None
     if Y is None:
         Y = X
-        k += 1
     X = X if type(X) == torch.Tensor else torch.Tensor(X)
     Y = Y if type(Y) == torch.Tensor else torch.Tensor(Y)
-    outer_bs = Y.size(0)
-    N = Y.size(1)
-    n_batches = int(math.ceil(N/bs))
-    dists = torch.zeros(outer_bs,N)
+    if backend == 'approx':
+        backend = 'kdtree' if X.size(-1) <= 10 else 'ivf'
+    if backend == 'kdtree':
+        return knn_kdtree(Y, X, k, exclude_self=exclude_self)[:,:,k-1]
     if torch.cuda.is_available():
         X = X.to('cuda')
         Y = Y.to('cuda')
-        dists=dists.to('cuda')
-    for i in range(n_batches):
-        j_min = i*bs
-        j_max = min(N, (i+1)*bs)
-        all_dists_i = (Y[:,j_min:j_max].unsqueeze(2) - X.unsqueeze(1)).norm(dim=-1)
-        topk_i = all_dists_i.topk(k, dim=-1, largest=False)[0][:,:,k-1]
-        dists[:,j_min:j_max] = topk_i
-    return dists
+    if backend == 'ivf':
+        return knn_ivf(Y, X, k, exclude_self=exclude_self)[:,:,k-1]
+    elif backend == 'exact':
+        tiles = (bs, X.size(1)) if bs is not None else None
+        return knn(Y, X, k, exclude_self=exclude_self, tiles=tiles)[:,:,k-1]
+    else:
+        raise NotImplementedError("exact, kdtree, ivf or approx")
 
-def kl_knn(X, Y, k=1, xi=1e-5):
+def kl_knn(X, Y, k=1, xi=1e-5, backend='exact'):
     n = X.size(1)
     m = Y.size(1)
     d = X.size(-1)
 
-    nu = knn_dist(X=Y, Y=X, k=k) + xi
-    eps = knn_dist(X=X, k=k) + xi
+    nu = knn_dist(X=Y, Y=X, k=k, backend=backend) + xi
+    eps = knn_dist(X=X, k=k, backend=backend) + xi
 
     return d/n * torch.log(nu/eps).sum(dim=1) + math.log(m/(n-1))
 
-def kl_mc(p, q, X=None, Y=None, N=500):
+def kl_mc(p, q, X=None, Y=None, N=500, mask=None, log_p=None):
+    # log_p: optional precomputed p.log_prob of X (N x bs), e.g. from GaussianMixture.sample_with_log_prob
     if X is None:
-        X = p.sample((N,)).transpose(0,1)
-    return (p.log_prob(X.transpose(0,1)) - q.log_prob(X.transpose(0,1))).mean(dim=0)  
+        if hasattr(p, 'sample_with_log_prob'):
+            X, log_p = p.sample_with_log_prob((N,))
+            X = X.transpose(0,1)
+        else:
+            X = p.sample((N,)).transpose(0,1)
+        mask = None
+    if log_p is None:
+        log_p = p.log_prob(X.transpose(0,1))
+    log_ratio = log_p - q.log_prob(X.transpose(0,1))
+    if mask is not None:
+        mask = mask.transpose(0,1).to(log_ratio.dtype)
+        return (log_ratio * mask).sum(dim=0) / mask.sum(dim=0)
+    return log_ratio.mean(dim=0)  
+
+def kl_gaussian_params(loc_p, scale_tril_p, loc_q, scale_tril_q):
+    # closed-form KL(N(loc_p, L_p L_p^T) || N(loc_q, L_q L_q^T)), broadcasting over batch dims
+    n = loc_p.size(-1)
+    M = torch.linalg.solve_triangular(scale_tril_q, scale_tril_p, upper=False)
+    diff = torch.linalg.solve_triangular(scale_tril_q, (loc_q - loc_p).unsqueeze(-1), upper=False).squeeze(-1)
+    half_log_det_p = scale_tril_p.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+    half_log_det_q = scale_tril_q.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+    return 0.5 * (M.pow(2).sum(dim=(-2,-1)) + diff.pow(2).sum(dim=-1) - n) + half_log_det_q - half_log_det_p
+
+def kl_gaussian(p, q, X=None, mask=None):
+    return kl_gaussian_params(p.loc, p.scale_tril, q.loc, q.scale_tril)
+
+def kl_gmm_variational(p, q, X=None, mask=None):
+    # variational approximation of the KL between two gaussian mixtures (Hershey & Olsen, 2007) from the closed-form
+    # KLs between their components
+    kl_pp = kl_gaussian_params(p.loc.unsqueeze(2), p.scale_tril.unsqueeze(2), p.loc.unsqueeze(1), p.scale_tril.unsqueeze(1))
+    kl_pq = kl_gaussian_params(p.loc.unsqueeze(2), p.scale_tril.unsqueeze(2), q.loc.unsqueeze(1), q.scale_tril.unsqueeze(1))
+    num = torch.logsumexp(p.log_weights.unsqueeze(1) - kl_pp, dim=-1)
+    denom = torch.logsumexp(q.log_weights.unsqueeze(1) - kl_pq, dim=-1)
+    return (p.log_weights.exp() * (num - denom)).sum(dim=-1)
+
+class KLLabels():
+    '''
+    Label function for KL tasks, dispatching on the distribution types:
+        set: monte carlo estimate over the input set X (kl_mc)
+        mc: monte carlo estimate over N samples drawn from p; with reuse_samples the standard normals/uniforms are drawn
+            once and mapped through each step's distributions
+        analytic: closed form for gaussians, mc otherwise
+        variational: closed form for gaussians, kl_gmm_variational for gaussian mixtures (biased when components overlap),
+            mc otherwise
+    Keeps track of the time spent computing labels (cost), without synchronizing the device.
+    '''
+    def __init__(self, mode='set', N=500, reuse_samples=False):
+        self.mode = mode
+        self.N = N
+        self.reuse_samples = reuse_samples
+        self.base_samples = {}
+        self.calls = 0
+        self.total_time = 0
+        self.events = []
+
+    def _base(self, bs, n, device):
+        if not self.reuse_samples:
+            return torch.randn(bs, self.N, n, device=device), torch.rand(bs, self.N, device=device)
+        key = (n, device)
+        if key not in self.base_samples:
+            self.base_samples[key] = (torch.randn(self.N, n, device=device), torch.rand(self.N, device=device))
+        z, u = self.base_samples[key]
+        return z.expand(bs, -1, -1), u.expand(bs, -1)
+
+    def _mc(self, p, q):
+        if isinstance(p, MultivariateNormal) and p.loc.dim() == 2:
+            z, _ = self._base(*p.loc.size(), p.loc.device)
+            X = p.loc.unsqueeze(1) + torch.einsum('bij,bsj->bsi', p.scale_tril, z)
+        elif hasattr(p, 'transform'):
+            z, u = self._base(p.loc.size(0), p.loc.size(-1), p.loc.device)
+            X = p.transform(z, u).transpose(0,1)
+        else:
+            return kl_mc(p, q, N=self.N)
+        return kl_mc(p, q, X=X)
+
+    def _labels(self, p, q, X=None, mask=None):
+        if self.mode == 'set' and X is not None:
+            return kl_mc(p, q, X=X, mask=mask)
+        if self.mode in ('analytic', 'variational'):
+            if isinstance(p, MultivariateNormal) and isinstance(q, MultivariateNormal):
+                return kl_gaussian(p, q)
+            if self.mode == 'variational' and hasattr(p, 'log_weights') and hasattr(q, 'log_weights'):
+                return kl_gmm_variational(p, q)
+        return self._mc(p, q)
+
+    def __call__(self, p, q, X=None, Y=None, mask=None):
+        # cuda calls are timed with events, which are only read by cost, so labelling never waits on the device
+        start_event = torch.cuda.Event(enable_timing=True) if torch.cuda.is_available() else None
+        if start_event is not None:
+            start_event.record()
+        start = time.perf_counter()
+        with torch.no_grad():
+            labels = self._labels(p, q, X=X, mask=mask)
+        if labels.is_cuda:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+            self.events.append((start_event, end_event))
+        else:
+            self.total_time += time.perf_counter() - start
+            self.calls += 1
+        return labels
+
+    def cost(self):
+        # average ms per label call since the last report. calls still running on the device are left for the next one
+        n_done = 0
+        while n_done < len(self.events) and self.events[n_done][1].query():
+            n_done += 1
+        done, self.events = self.events[:n_done], self.events[n_done:]
+        ms = 1000 * self.total_time + sum(start.elapsed_time(end) for start, end in done)
+        calls = self.calls + len(done)
+        self.calls, self.total_time = 0, 0
+        return ms / max(1, calls)
 
 def kl_mc_mixture(p, q, X=None, Y=None, N=500):
     if X is None:
@@ -134,64 +476,68 @@ def kl_mc_mixture(p, q, X=None, Y=None, N=500):
     return (p.log_prob(*X) - q.log_prob(*X)).mean(dim=0)  
 
 
-def mi_corr_gaussian(corr, d=None, X=None):
+def mi_corr_gaussian(corr, d=None, X=None, mask=None):
     assert (d is None) != (X is None)
     if X is not None:
         d = X[0].size(-1)
     return -d/2 * torch.log(1-torch.pow(corr, 2))
 
 
-def get_dists(X, Y=None, bs=32):
+def get_dists(X, Y=None, bs=None):
     if Y is None:
         Y = X
     X = X if type(X) == torch.Tensor else torch.Tensor(X)
     Y = Y if type(Y) == torch.Tensor else torch.Tensor(Y)
-    outer_bs = Y.size(0)
-    N = X.size(1)
-    M = Y.size(1)
-    n_batches = int(math.ceil(N/bs))
-    dists = torch.zeros(outer_bs, N, M)
     if torch.cuda.is_available():
         X = X.to('cuda')
         Y = Y.to('cuda')
-        dists=dists.to('cuda')
-    for i in range(n_batches):
-        j_min = i*bs
-        j_max = min(N, (i+1)*bs)
-        all_dists_i = (X[:,j_min:j_max].unsqueeze(2) - Y.unsqueeze(1)).norm(dim=-1)
-        dists[:,j_min:j_max] = all_dists_i
+    outer_bs, N, M = X.size(0), X.size(1), Y.size(1)
+    bs = bs if bs is not None else tile_sizes(outer_bs, N, M, X.element_size(), X.device)[0]
+    X_sq, Y_sq = X.pow(2).sum(dim=-1), Y.pow(2).sum(dim=-1)
+    dists = X.new_empty(outer_bs, N, M)
+    for i in range(0, N, bs):
+        dists[:,i:i+bs] = sq_dists(X[:,i:i+bs], Y, X_sq[:,i:i+bs], Y_sq).sqrt_()
     return dists
 
-def kraskov_mi1(X, Y, k=1):
+def _digamma(x):
+    # digamma of a python number (torch.digamma only takes float tensors)
+    return torch.digamma(torch.tensor(float(x), dtype=torch.float64)).item()
+
+def kraskov_counts(X, Y, k=1, variant=1, chunk=None):
+    # marginal neighbour counts of the KSG estimators (Kraskov et al., 2004), streamed over chunks of query points so
+    # only bs x chunk x N distances are held at a time. variant 1 counts points strictly inside the distance to the
+    # k-th max-norm neighbour; variant 2 counts points within the marginal extent of the k nearest max-norm neighbours
+    bs, N, _ = X.size()
+    chunk = chunk if chunk is not None else tile_sizes(bs, N, N, X.element_size(), X.device)[0] // 4
+    chunk = max(1, chunk)
+    X_sq, Y_sq = X.pow(2).sum(dim=-1), Y.pow(2).sum(dim=-1)
+    n_x, n_y = X.new_empty(bs, N), X.new_empty(bs, N)
+    for i in range(0, N, chunk):
+        Xdists = _exclude_self(sq_dists(X[:,i:i+chunk], X, X_sq[:,i:i+chunk], X_sq), i, 0).sqrt_()
+        Ydists = _exclude_self(sq_dists(Y[:,i:i+chunk], Y, Y_sq[:,i:i+chunk], Y_sq), i, 0).sqrt_()
+        Zdists = torch.maximum(Xdists, Ydists)
+        if variant == 1:
+            eps = Zdists.topk(k, dim=-1, largest=False)[0][:,:,k-1:]
+            n_x[:,i:i+chunk] = (Xdists < eps).sum(dim=-1)
+            n_y[:,i:i+chunk] = (Ydists < eps).sum(dim=-1)
+        else:
+            neighbours = Zdists.topk(k, dim=-1, largest=False)[1]
+            eps_x = Xdists.gather(-1, neighbours).max(dim=-1, keepdim=True)[0]
+            eps_y = Ydists.gather(-1, neighbours).max(dim=-1, keepdim=True)[0]
+            n_x[:,i:i+chunk] = (Xdists <= eps_x).sum(dim=-1)
+            n_y[:,i:i+chunk] = (Ydists <= eps_y).sum(dim=-1)
+    return n_x, n_y
+
+def kraskov_mi1(X, Y, k=1, chunk=None):
     assert X.size(1) == Y.size(1)
     N = X.size(1)
-    d = X.size(-1)
-    mask = (torch.eye(N)).to(X.device)
-    mask[mask==1] = float('inf')
-    Xdists = get_dists(X, X) + mask
-    Ydists = get_dists(Y, Y) + mask
-    Zdists = torch.maximum(Xdists, Ydists)
-    eps,_ = Zdists.topk(k, dim=-1, largest=False)
-    n_x = (Xdists < eps).float().sum(dim=-1)
-    n_y = (Ydists < eps).float().sum(dim=-1)
-    out = torch.digamma(torch.tensor([k], device=X.device)) + torch.digamma(torch.tensor([N], device=X.device)) - (torch.digamma(n_x+1) + torch.digamma(n_y+1)).mean(dim=1)
-    return out
-
-def kraskov_mi2(X, Y, k=1):
+    n_x, n_y = kraskov_counts(X, Y, k=k, variant=1, chunk=chunk)
+    return _digamma(k) + _digamma(N) - (torch.digamma(n_x+1) + torch.digamma(n_y+1)).mean(dim=1)
+
+def kraskov_mi2(X, Y, k=1, chunk=None):
     assert X.size(1) == Y.size(1)
     N = X.size(1)
-    d = X.size(-1)
-    mask = (torch.eye(N)).to(X.device)
-    mask[mask==1] = float('inf')
-    Xdists,_ = torch.sort(get_dists(X, X) + mask, dim=-1)
-    Ydists,_ = torch.sort(get_dists(Y, Y) + mask, dim=-1)
-    eps_x = Xdists[:,:,k]
-    eps_y = Ydists[:,:,k]
-    eps = torch.maximum(eps_x, eps_y)
-    n_x = (Xdists < eps_x.unsqueeze(-1)).float().sum(dim=-1)
-    n_y = (Ydists < eps_y.unsqueeze(-1)).float().sum(dim=-1)
-
-    out = torch.digamma(k) + torch.digamma(N) - (torch.digamma(n_x) + torch.digamma(n_y).mean(dim=1)) - 1/k
-    return out
+    n_x, n_y = kraskov_counts(X, Y, k=k, variant=2, chunk=chunk)
+    return _digamma(k) - 1/k + _digamma(N) - (torch.digamma(n_x) + torch.digamma(n_y)).mean(dim=1)
 
 